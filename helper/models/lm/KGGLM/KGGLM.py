@@ -2,10 +2,14 @@
 from typing import Optional, Tuple, Union
 
 import torch
+import torch.nn.functional as F
 from torch import nn
 from torch.nn import CrossEntropyLoss
 from transformers import GPT2LMHeadModel, GPT2Model
-from transformers.modeling_outputs import CausalLMOutputWithCrossAttentions
+from transformers.modeling_outputs import (BaseModelOutputWithPastAndCrossAttentions,
+                                           CausalLMOutputWithCrossAttentions)
+
+from helper.models.lm.KGGLM.collators import packed_attention_mask
 
 
 class KGGLM(GPT2LMHeadModel):
@@ -19,6 +23,12 @@ class KGGLM(GPT2LMHeadModel):
         self.transformer = GPT2Model(config)
         self.lm_head = nn.Linear(config.n_embd, config.vocab_size, bias=False)
 
+        self.num_kg_types = len(KGGLM.kg_categories)
+
+        # Create type embedding layer
+        self.type_embeddings = torch.nn.Embedding(num_embeddings=self.num_kg_types,
+                                                  embedding_dim=config.hidden_size)  # for entities, relations, and special tokens
+
         self.init_weights()
 
 
@@ -26,43 +36,196 @@ class KGGLM(GPT2LMHeadModel):
         self.model_parallel = False
         self.device_map = None
 
-        self.num_kg_types = len(KGGLM.kg_categories)
+        # Type of the token at every position of a path: [BOS] entity relation entity ... ,
+        # the special tokens ([EOS], [PAD], ...) are typed by id
+        position_type_ids = torch.where(torch.arange(config.n_positions) % 2 == 1, KGGLM.ENTITY_ID, KGGLM.RELATION_ID)
+        position_type_ids[0] = KGGLM.SPECIAL_ID
+        self.register_buffer('position_type_ids', position_type_ids, persistent=False)
+        special_token_ids = [token_id for token_id in (config.bos_token_id, config.eos_token_id, config.pad_token_id)
+                             if token_id is not None and token_id < config.vocab_size]
+        self.register_buffer('special_token_ids', torch.tensor(special_token_ids, dtype=torch.long), persistent=False)
+        # Candidate token ids of the typed output head, by device
+        self._head_groups = dict()
 
-        # Create type embedding layer
-        self.type_embeddings = torch.nn.Embedding(num_embeddings=self.num_kg_types,
-                                                  embedding_dim=config.hidden_size)  # for entities, relations, and special tokens
+    def type_embeds(self, input_ids, position_ids):
+        """Type embeddings of the tokens at position_ids, broadcast over the batch"""
+        type_ids = self.position_type_ids[position_ids]
+        if input_ids is not None:
+            type_ids = torch.where(torch.isin(input_ids, self.special_token_ids), KGGLM.SPECIAL_ID, type_ids)
+        return self.type_embeddings(type_ids)
 
-        self.type_ids_cache = dict()
-        self.type_embeds_cache = dict()
-        self.idx_mask_cache = dict()
-
-    def __init_type_embeddings(self, batch_size, num_hops):
-        # num_hops = self.config.num_hops
-        n_tokens = num_hops  # num_hops + 1 + num_hops + 2
-        type_ids = torch.ones((batch_size, n_tokens), dtype=torch.long)
-
-        for i in range(n_tokens):
-            if i == 0 or i == n_tokens - 1:
-                type_ids[:, i] = KGGLM.SPECIAL_ID
-            elif i % 2 == 1:
-                type_ids[:, i] = KGGLM.ENTITY_ID
-            elif i % 2 == 0:
-                type_ids[:, i] = KGGLM.RELATION_ID
-        type_ids = type_ids.to(self.type_embeddings.weight.device)
-        type_embeds = self.type_embeddings(type_ids)
-        return type_ids, type_embeds
-
-
-    def __get_type_embeds(self, n_rows, n_cols):
-        row = self.type_ids_row[:, :(n_cols - 1)]
-        row = torch.hstack([row, torch.ones((1, 1)) * KGGLM.SPECIAL_ID])
-        type_ids = torch.vstack([row for _ in range(n_rows)])
-        return type_ids, self.type_embeddings(type_ids.to(self.type_embeddings.weight.device))
-
-    def __get_even_idx_mask(self, n_rows, n_cols):
-        mask_key = (n_rows, n_cols)
-        cur_mask = self.even_idx_mask[:(n_cols)]
-        return torch.vstack([cur_mask for _ in range(n_rows)])
+    def head_groups(self, device):
+        """
+        Candidate groups of the typed output head and the entity group predicted after every token.
+        A group is (candidates, local_ids): the token ids that can be predicted and the index of every
+        vocabulary token among them (-100 if it cannot). Group 0 holds the relations, group 1 all the
+        entities, with config.next_entity_types ({relation token id: entity type letters}) the tails of a
+        relation are restricted to its entity types in a further group. Special tokens are in every group.
+        """
+        if device not in self._head_groups:
+            if getattr(self.config, 'ent_mask', None) is None or getattr(self.config, 'rel_mask', None) is None:
+                raise ValueError('The typed output head needs the ent_mask and rel_mask of the model config')
+            ent_mask = torch.tensor(self.config.ent_mask, dtype=torch.bool)
+            rel_mask = torch.tensor(self.config.rel_mask, dtype=torch.bool)
+            special_mask = ~(ent_mask | rel_mask)
+            masks = [rel_mask | special_mask, ent_mask | special_mask]
+            entity_group = torch.ones(self.config.vocab_size, dtype=torch.long)
+            next_entity_types = getattr(self.config, 'next_entity_types', None) or dict()
+            if next_entity_types:
+                letters = [''] * self.config.vocab_size
+                for token_id, token in self.config.token_id_to_token.items():
+                    letters[int(token_id)] = token[:1]
+                letters = torch.tensor([ord(letter) if letter else 0 for letter in letters])
+                type_groups = dict()
+                for rel_token_id, entity_types in next_entity_types.items():
+                    entity_types = ''.join(sorted(set(entity_types)))
+                    if entity_types not in type_groups:
+                        type_groups[entity_types] = len(masks)
+                        masks.append(ent_mask & torch.isin(letters, torch.tensor([ord(t) for t in entity_types]))
+                                     | special_mask)
+                    entity_group[int(rel_token_id)] = type_groups[entity_types]
+            groups = []
+            for mask in masks:
+                candidates = torch.nonzero(mask).flatten()
+                local_ids = torch.full((self.config.vocab_size,), -100, dtype=torch.long)
+                local_ids[candidates] = torch.arange(len(candidates))
+                groups.append((candidates.to(device), local_ids.to(device)))
+            self._head_groups[device] = (groups, entity_group.to(device))
+        return self._head_groups[device]
+
+    def head_group_ids(self, position_ids, input_ids=None):
+        """Candidate group (see head_groups) of the token following every position"""
+        _, entity_group = self.head_groups(position_ids.device)
+        next_entity_group = entity_group[input_ids] if input_ids is not None else torch.ones_like(position_ids)
+        return torch.where(position_ids % 2 == 1, 0, next_entity_group)
+
+    def typed_head(self, hidden_states, position_ids, input_ids=None, labels=None):
+        """
+        Output head restricted to the tokens of the type that can follow every position: relations after
+        an entity, entities after [BOS] or a relation (see head_groups). With labels returns (None, loss),
+        only computing the logits of the positions with a label (labels of the wrong type are ignored).
+        Otherwise returns the full vocabulary logits, the min value for the tokens that cannot follow.
+        """
+        groups, _ = self.head_groups(hidden_states.device)
+        group_ids = self.head_group_ids(position_ids.expand(hidden_states.shape[:2]), input_ids)
+        if labels is not None:
+            hidden_states, group_ids, labels = hidden_states[:, :-1], group_ids[:, :-1], labels[:, 1:].long()
+            loss, n_labels = 0., 0
+            for group_id, (candidates, local_ids) in enumerate(groups):
+                selected = (group_ids == group_id) & (labels != -100)
+                logits = F.linear(hidden_states[selected], self.lm_head.weight[candidates])
+                targets = local_ids[labels[selected]]
+                loss = loss + F.cross_entropy(logits.float(), targets, ignore_index=-100, reduction='sum')
+                n_labels = n_labels + (targets != -100).sum()
+            return None, loss / n_labels
+
+        scores = hidden_states.new_full((*hidden_states.shape[:2], self.config.vocab_size),
+                                        torch.finfo(hidden_states.dtype).min)
+        for group_id, (candidates, _) in enumerate(groups):
+            rows, cols = torch.nonzero(group_ids == group_id, as_tuple=True)
+            scores[rows[:, None], cols[:, None], candidates] = F.linear(hidden_states[rows, cols],
+                                                                        self.lm_head.weight[candidates]).to(scores.dtype)
+        return scores, None
+
+    def set_kg_neighbours(self, indptr, indices):
+        """Token level csr adjacency of the kg (see get_kg_neighbours), the hard negatives of the 'kg' training loss"""
+        self.register_buffer('kg_indptr', indptr.to(self.lm_head.weight.device), persistent=False)
+        self.register_buffer('kg_indices', indices.to(self.lm_head.weight.device), persistent=False)
+
+    def sampled_loss(self, hidden_states, position_ids, input_ids, labels):
+        """
+        Softmax loss over the gold token and config.n_negatives negatives of the candidate group of each
+        position (see head_groups), so the negatives have the type of the gold token. The negatives are
+        sampled uniformly and shared by the positions of a group, with config.training_loss == 'kg'
+        config.n_kg_negatives more are sampled per position among the kg neighbours of the previous entity.
+        Groups with no more candidates than negatives are computed exactly.
+        """
+        groups, _ = self.head_groups(hidden_states.device)
+        group_ids = self.head_group_ids(position_ids.expand(hidden_states.shape[:2]), input_ids)[:, :-1]
+        # Entity before the relation preceding every predicted entity
+        prev_entities = F.pad(input_ids[:, :-2], (1, 0), value=self.config.pad_token_id or 0)
+        hidden_states, labels = hidden_states[:, :-1], labels[:, 1:].long()
+        weight = self.lm_head.weight
+        n_negatives = self.config.n_negatives
+        use_kg = getattr(self.config, 'training_loss', 'full') == 'kg' and hasattr(self, 'kg_indptr')
+        loss, n_labels = 0., 0
+        for group_id, (candidates, local_ids) in enumerate(groups):
+            selected = (group_ids == group_id) & (labels != -100)
+            selected &= local_ids[labels.clamp(min=0)] != -100
+            hidden, gold = hidden_states[selected], labels[selected]
+            if len(candidates) <= n_negatives:
+                loss = loss + F.cross_entropy(F.linear(hidden, weight[candidates]).float(), local_ids[gold], reduction='sum')
+                n_labels = n_labels + len(gold)
+                continue
+            negatives = candidates[torch.randint(len(candidates), (n_negatives,), device=candidates.device)]
+            logits = [(hidden * weight[gold]).sum(-1, keepdim=True),
+                      F.linear(hidden, weight[negatives]).masked_fill(negatives[None] == gold[:, None], float('-inf'))]
+            if use_kg and group_id > 0:
+                heads = prev_entities[selected]
+                start, degree = self.kg_indptr[heads], self.kg_indptr[heads + 1] - self.kg_indptr[heads]
+                offsets = (torch.rand((len(heads), self.config.n_kg_negatives), device=heads.device)
+                           * degree[:, None]).long()
+                neighbours = self.kg_indices[(start[:, None] + offsets).clamp(max=len(self.kg_indices) - 1)]
+                invalid = (degree[:, None] == 0) | (local_ids[neighbours] == -100) | (neighbours == gold[:, None])
+                logits.append(torch.einsum('nd,nkd->nk', hidden, weight[neighbours]).masked_fill(invalid, float('-inf')))
+            loss = loss + F.cross_entropy(torch.cat(logits, dim=-1).float(), torch.zeros_like(gold), reduction='sum')
+            n_labels = n_labels + len(gold)
+        return loss / n_labels
+
+    def packed_transformer(self, input_ids, inputs_embeds, position_ids, segment_ids, output_hidden_states=False):
+        """
+        GPT2Model forward of a packed batch (PackedPathCollator). GPT2Model only takes (batch, seq) padding masks,
+        so the embeddings and the blocks are run here and every block gets the block diagonal causal mask of
+        segment_ids (packed_attention_mask) as the bias added to its attention scores.
+        """
+        transformer = self.transformer
+        if inputs_embeds is None:
+            inputs_embeds = transformer.wte(input_ids)
+        if position_ids is None:
+            position_ids = self.default_position_ids(None, inputs_embeds.shape[1], inputs_embeds.device)
+        hidden_states = transformer.drop(inputs_embeds + transformer.wpe(position_ids))
+        attention_mask = packed_attention_mask(segment_ids, hidden_states.dtype)
+        all_hidden_states = ()
+        for block in transformer.h:
+            if output_hidden_states:
+                all_hidden_states += (hidden_states,)
+            outputs = block(hidden_states, attention_mask=attention_mask)
+            # A tuple (hidden_states, ...) up to transformers 4.x, the hidden states afterwards
+            hidden_states = outputs[0] if isinstance(outputs, tuple) else outputs
+        hidden_states = transformer.ln_f(hidden_states)
+        if output_hidden_states:
+            all_hidden_states += (hidden_states,)
+        return BaseModelOutputWithPastAndCrossAttentions(last_hidden_state=hidden_states,
+                                                         hidden_states=all_hidden_states or None)
+
+    @torch.no_grad()
+    def check_packed_attention(self, atol=1e-4):
+        """
+        Raises ValueError if the paths of a packed batch are not encoded as they are alone, e.g. when the
+        attention of the installed GPT2 does not add the mask of packed_transformer to its scores.
+        """
+        training = self.training
+        self.eval()
+        try:
+            tokens = torch.arange(1, 5, device=self.lm_head.weight.device) % self.config.vocab_size
+            packed = self(input_ids=tokens[None], position_ids=torch.tensor([[0, 1, 0, 1]], device=tokens.device),
+                          segment_ids=torch.tensor([[1, 1, 2, 2]], device=tokens.device)).logits
+            alone = self(input_ids=tokens[None, 2:]).logits
+            error = None if torch.allclose(packed[:, 2:], alone, atol=atol) else 'the paths attend to each other'
+        except Exception as e:
+            error = f'{type(e).__name__}: {e}'
+        finally:
+            self.train(training)
+        if error is not None:
+            raise ValueError(f'--packing is not supported by the installed transformers GPT2 ({error})')
+
+    def default_position_ids(self, past_key_values, seq_len, device):
+        """Positions following the cached ones, as GPT2Model computes them when no position_ids are given"""
+        past_length = 0
+        if past_key_values is not None:
+            past_length = (past_key_values.get_seq_length() if hasattr(past_key_values, 'get_seq_length')
+                           else past_key_values[0][0].size(-2))
+        return torch.arange(past_length, past_length + seq_len, device=device)[None]
 
     def forward(
             self,
@@ -80,54 +243,76 @@ class KGGLM(GPT2LMHeadModel):
             output_attentions: Optional[bool] = None,
             output_hidden_states: Optional[bool] = None,
             return_dict: Optional[bool] = None,
+            segment_ids: Optional[torch.LongTensor] = None,
     ) -> Union[Tuple, CausalLMOutputWithCrossAttentions]:
 
-        batch_size, seq_len = input_ids.shape
-        k = (batch_size, seq_len)
-        if k not in self.type_ids_cache:
-            type_ids, type_embeds = self.__init_type_embeddings(batch_size, seq_len)
-
-            self.type_ids_cache[k], self.type_embeds_cache[k] = type_ids, type_embeds
-
-        type_ids, type_embeds = self.type_ids_cache[k], self.type_embeds_cache[k]
-
-
-        if inputs_embeds is not None:
-            inputs_embeds += type_embeds
+        typed_head = getattr(self.config, 'output_head', 'full') == 'typed'
+        use_type_embeddings = getattr(self.config, 'use_type_embeddings', False)
+        if position_ids is None and (typed_head or use_type_embeddings):
+            inputs = input_ids if input_ids is not None else inputs_embeds
+            position_ids = self.default_position_ids(past_key_values, inputs.shape[1], inputs.device)
 
+        token_ids = input_ids
+        # Type embeddings are added to the token embeddings, at every step when decoding incrementally
+        if use_type_embeddings:
+            if inputs_embeds is None:
+                inputs_embeds = self.transformer.wte(input_ids)
+            inputs_embeds = inputs_embeds + self.type_embeds(input_ids, position_ids)
+            input_ids = None
 
         return_dict = return_dict if return_dict is not None else self.config.use_return_dict
         if labels is not None:
             use_cache = False
 
-
-        transformer_outputs = self.transformer(
-            input_ids,
-            past_key_values=past_key_values,
-            attention_mask=attention_mask,
-            token_type_ids=token_type_ids,
-            position_ids=position_ids,
-            head_mask=head_mask,
-            inputs_embeds=inputs_embeds,
-            encoder_hidden_states=encoder_hidden_states,
-            encoder_attention_mask=encoder_attention_mask,
-            use_cache=use_cache,
-            output_attentions=output_attentions,
-            output_hidden_states=output_hidden_states,
-            return_dict=return_dict,
-        )
+        # Packed batches (PackedPathCollator): block diagonal causal attention between the paths of a row
+        if segment_ids is not None:
+            unsupported = {'past_key_values': past_key_values, 'head_mask': head_mask, 'use_cache': use_cache,
+                           'output_attentions': output_attentions, 'token_type_ids': token_type_ids,
+                           'encoder_hidden_states': encoder_hidden_states}
+            unsupported = [name for name, value in unsupported.items() if value is not None and value is not False]
+            if unsupported:
+                raise ValueError(f'segment_ids (packed batches) cannot be combined with {", ".join(unsupported)}')
+            transformer_outputs = self.packed_transformer(input_ids, inputs_embeds, position_ids, segment_ids,
+                                                          output_hidden_states=output_hidden_states)
+            if not return_dict:
+                # The tuple of GPT2Model: the (here empty) presents at index 1, the hidden states after them
+                transformer_outputs = (transformer_outputs.last_hidden_state, None) + (
+                    (transformer_outputs.hidden_states,) if output_hidden_states else ())
+        else:
+            transformer_outputs = self.transformer(
+                input_ids,
+                past_key_values=past_key_values,
+                attention_mask=attention_mask,
+                token_type_ids=token_type_ids,
+                position_ids=position_ids,
+                head_mask=head_mask,
+                inputs_embeds=inputs_embeds,
+                encoder_hidden_states=encoder_hidden_states,
+                encoder_attention_mask=encoder_attention_mask,
+                use_cache=use_cache,
+                output_attentions=output_attentions,
+                output_hidden_states=output_hidden_states,
+                return_dict=return_dict,
+            )
 
         sequence_output = transformer_outputs[0]
-        prediction_scores = self.lm_head(sequence_output)
 
         lm_loss = None
-        if labels is not None:
-            # we are doing next-token prediction; shift prediction scores and input ids by one
-            shifted_prediction_scores = prediction_scores[:,:-1, :].contiguous()
-            labels = labels[:, 1:].contiguous()
-            loss_fct = CrossEntropyLoss()
-            lm_loss = loss_fct(
-                shifted_prediction_scores.view(-1, self.config.vocab_size), labels.view(-1))
+        if labels is not None and getattr(self.config, 'training_loss', 'full') != 'full':
+            if position_ids is None:
+                position_ids = self.default_position_ids(past_key_values, token_ids.shape[1], token_ids.device)
+            prediction_scores, lm_loss = None, self.sampled_loss(sequence_output, position_ids, token_ids, labels)
+        elif typed_head:
+            prediction_scores, lm_loss = self.typed_head(sequence_output, position_ids, token_ids, labels)
+        else:
+            prediction_scores = self.lm_head(sequence_output)
+            if labels is not None:
+                # we are doing next-token prediction; shift prediction scores and input ids by one
+                shifted_prediction_scores = prediction_scores[:,:-1, :].contiguous()
+                labels = labels[:, 1:].long().contiguous()
+                loss_fct = CrossEntropyLoss()
+                lm_loss = loss_fct(
+                    shifted_prediction_scores.view(-1, self.config.vocab_size), labels.view(-1))
 
         if not return_dict:
             output = (prediction_scores,) + transformer_outputs[2:]
@@ -0,0 +1,278 @@
+import argparse
+import time
+
+import torch
+from transformers import GPT2Config, LogitsProcessorList
+
+from helper.models.lm.KGGLM.decoding_constraints import VectorizedConstrainedLogitsProcessorREC
+from helper.models.lm.KGGLM.KGGLM import KGGLM
+from helper.models.lm.KGGLM.lm_utils import get_kg_neighbours
+from helper.models.lm.KGGLM.path_search import PathBeamSearch
+from helper.models.lm.KGGLM.ranker import CumulativeSequenceScoreRanker
+from helper.utils import SEED
+
+SPECIAL_TOKENS = ['[UNK]', '[PAD]', '[BOS]', '[EOS]', '[MASK]']
+PAD_ID, BOS_ID, EOS_ID = 1, 2, 3
+
+
+class SyntheticVocab:
+    """
+    Vocabulary of the special tokens, n_relations relations and users, products and other entities,
+    and a random kg over it with degree edges per entity: users interact (R0) with products, the other
+    relations lead alternately to products and to entities. Paths [BOS] U R P R E ... [EOS] are random walks.
+    """
+    def __init__(self, n_users, n_products, n_entities, n_relations, degree=8, seed=SEED):
+        tokens = (SPECIAL_TOKENS + [f'R{i}' for i in range(n_relations)] + [f'U{i}' for i in range(n_users)]
+                  + [f'P{i}' for i in range(n_products)] + [f'E{i}' for i in range(n_entities)])
+        self.token_id_to_token = dict(enumerate(tokens))
+        self.vocab_size = len(tokens)
+        self.rel_mask = [int(token[0] == 'R') for token in tokens]
+        self.ent_mask = [int(token[0] in 'UPE') for token in tokens]
+        self.first_ids = {letter: next(i for i, token in enumerate(tokens) if token[0] == letter) for letter in 'RUPE'}
+        self.sizes = dict(R=n_relations, U=n_users, P=n_products, E=n_entities)
+        self.next_entity_types = {self.first_ids['R'] + i: 'P' if i % 2 == 0 else 'E' for i in range(n_relations)}
+
+        generator = torch.Generator().manual_seed(seed)
+        n_tokens = (self.vocab_size, degree)
+        self.edge_rels = self.first_ids['R'] + 1 + torch.randint(max(n_relations - 1, 1), n_tokens, generator=generator)
+        self.edge_rels[self.first_ids['U']:self.first_ids['U'] + n_users] = self.first_ids['R']
+        self.edge_tails = torch.where((self.edge_rels - self.first_ids['R']) % 2 == 0,
+                                      self.sample('P', n_tokens, generator), self.sample('E', n_tokens, generator))
+
+    def get_vocab(self):
+        """{token: id}, the vocabulary as the tokenizer gives it"""
+        return {token: token_id for token_id, token in self.token_id_to_token.items()}
+
+    def decode(self, token_ids):
+        return ' '.join(self.token_id_to_token[int(token_id)] for token_id in token_ids)
+
+    def sample(self, letter, shape, generator):
+        return self.first_ids[letter] + torch.randint(self.sizes[letter], shape, generator=generator)
+
+    def tokenized_kg(self):
+        """{head token: {relation token: tail tokens}} of the entities, as tokenize_augmented_kg"""
+        tokenized_kg = dict()
+        for head in range(self.first_ids['U'], self.vocab_size):
+            for rel, tail in zip(self.edge_rels[head].tolist(), self.edge_tails[head].tolist()):
+                tokenized_kg.setdefault(head, dict()).setdefault(rel, set()).add(tail)
+        return tokenized_kg
+
+    def paths(self, batch_size, path_length, generator):
+        paths = torch.empty((batch_size, path_length), dtype=torch.long)
+        paths[:, 0], paths[:, -1] = BOS_ID, EOS_ID
+        paths[:, 1] = self.sample('U', (batch_size,), generator)
+        for i in range(2, path_length - 1, 2):
+            edges = torch.randint(self.edge_rels.shape[1], (batch_size,), generator=generator)
+            paths[:, i] = self.edge_rels[paths[:, i - 1], edges]
+            if i + 1 < path_length - 1:
+                paths[:, i + 1] = self.edge_tails[paths[:, i - 1], edges]
+        return paths
+
+
+def build_model(args, vocab, **config_kwargs):
+    config = GPT2Config(vocab_size=vocab.vocab_size, n_positions=args.context_length, n_embd=args.n_embd,
+                        n_layer=args.n_layer, n_head=args.n_head, bos_token_id=BOS_ID, eos_token_id=EOS_ID,
+                        pad_token_id=PAD_ID, ent_mask=vocab.ent_mask, rel_mask=vocab.rel_mask,
+                        token_id_to_token=vocab.token_id_to_token, **config_kwargs)
+    torch.manual_seed(SEED)
+    return KGGLM(config).to(args.device)
+
+
+def time_steps(model, batches, optimizer=None):
+    """Seconds per training step (forward, backward, AdamW update), the peak CUDA memory (if on a GPU) and the losses"""
+    if optimizer is None:
+        optimizer = torch.optim.AdamW(model.parameters(), lr=1e-3)
+    model.train()
+    if torch.cuda.is_available():
+        torch.cuda.reset_peak_memory_stats()
+    losses, elapsed = [], 0.
+    # The first batch is a warm up and is not timed
+    for i, batch in enumerate(batches):
+        start = time.time()
+        loss = model(input_ids=batch, labels=batch).loss
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+        if batch.is_cuda:
+            torch.cuda.synchronize()
+        if i > 0:
+            elapsed += time.time() - start
+        losses.append(loss.item())
+    peak_memory = torch.cuda.max_memory_allocated() if torch.cuda.is_available() else None
+    return elapsed / max(len(batches) - 1, 1), peak_memory, losses
+
+
+def head_cost(model, batch):
+    """Multiply-add FLOPs and fp32 logits bytes of the output head for the predicted positions of a batch"""
+    n_embd = model.config.n_embd
+    n_predicted = batch.shape[0] * (batch.shape[1] - 1)
+    if getattr(model.config, 'output_head', 'full') != 'typed':
+        n_logits = n_predicted * model.config.vocab_size
+    else:
+        groups, _ = model.head_groups(batch.device)
+        position_ids = torch.arange(batch.shape[1], device=batch.device).expand(batch.shape)
+        group_ids = model.head_group_ids(position_ids, batch)[:, :-1]
+        n_logits = sum(int((group_ids == group_id).sum()) * len(candidates)
+                       for group_id, (candidates, _) in enumerate(groups))
+    return dict(flops=2 * n_logits * n_embd, logits_bytes=4 * n_logits)
+
+
+def benchmark_output_head(args):
+    """Full vocabulary vs typed output head, with and without the entity types split"""
+    vocab = SyntheticVocab(args.n_users, args.n_products, args.n_entities, args.n_relations)
+    generator = torch.Generator().manual_seed(SEED)
+    batches = [vocab.paths(args.batch_size, args.path_length, generator).to(args.device) for _ in range(args.steps + 1)]
+    variants = dict(full=dict(output_head='full'), typed=dict(output_head='typed'),
+                    typed_split=dict(output_head='typed', next_entity_types=vocab.next_entity_types))
+    results = dict()
+    for name, config_kwargs in variants.items():
+        model = build_model(args, vocab, **config_kwargs)
+        seconds, peak_memory, losses = time_steps(model, batches)
+        results[name] = dict(seconds_per_step=seconds, peak_memory=peak_memory, final_loss=losses[-1],
+                             **head_cost(model, batches[0]))
+    for name, result in results.items():
+        print(f"{name:>11}: {result['flops'] / 1e9:8.2f} GFLOPs/step in the head, "
+              f"{result['logits_bytes'] / 2 ** 20:8.1f} MiB of logits, {result['seconds_per_step'] * 1000:8.1f} ms/step"
+              + (f", {result['peak_memory'] / 2 ** 20:.1f} MiB peak" if result['peak_memory'] is not None else "")
+              + f", loss {result['final_loss']:.3f}")
+        if name != 'full':
+            print(f"{'':>11}  head FLOPs and logits / {results['full']['flops'] / result['flops']:.1f}, "
+                  f"step time / {results['full']['seconds_per_step'] / result['seconds_per_step']:.2f}")
+    return results
+
+
+def validation_loss(model, batches):
+    """Full vocabulary softmax loss of the model on held out batches, whatever the training loss"""
+    training_loss, model.config.training_loss = getattr(model.config, 'training_loss', 'full'), 'full'
+    model.eval()
+    with torch.no_grad():
+        loss = sum(model(input_ids=batch, labels=batch).loss.item() for batch in batches) / len(batches)
+    model.train()
+    model.config.training_loss = training_loss
+    return loss
+
+
+def benchmark_training_loss(args):
+    """Full softmax vs sampled and kg negatives softmax losses: step time and full softmax validation loss"""
+    vocab = SyntheticVocab(args.n_users, args.n_products, args.n_entities, args.n_relations)
+    generator = torch.Generator().manual_seed(SEED)
+    batches = [vocab.paths(args.batch_size, args.path_length, generator).to(args.device) for _ in range(args.steps + 1)]
+    valid_batches = [vocab.paths(args.batch_size, args.path_length, generator).to(args.device) for _ in range(4)]
+    results = dict()
+    for training_loss in ('full', 'sampled', 'kg'):
+        model = build_model(args, vocab, training_loss=training_loss, n_negatives=args.n_negatives,
+                            n_kg_negatives=args.n_kg_negatives)
+        if training_loss == 'kg':
+            model.set_kg_neighbours(*get_kg_neighbours(vocab.tokenized_kg(), vocab.vocab_size))
+        optimizer = torch.optim.AdamW(model.parameters(), lr=args.lr)
+        curve, seconds = [validation_loss(model, valid_batches)], 0.
+        for start in range(0, args.steps, args.eval_steps):
+            # Every chunk of steps starts with an untimed warm up step on its first batch
+            chunk_seconds, _, _ = time_steps(model, batches[start:start + args.eval_steps + 1], optimizer)
+            seconds += chunk_seconds * len(batches[start + 1:start + args.eval_steps + 1])
+            curve.append(validation_loss(model, valid_batches))
+        results[training_loss] = dict(seconds_per_step=seconds / args.steps, validation_loss=curve)
+    for training_loss, result in results.items():
+        print(f"{training_loss:>7}: {result['seconds_per_step'] * 1000:8.1f} ms/step "
+              f"({results['full']['seconds_per_step'] / result['seconds_per_step']:.2f}x), full softmax validation loss "
+              + ' '.join(f'{loss:.3f}' for loss in result['validation_loss']))
+    return results
+
+
+def benchmark_path_search(args):
+    """
+    generate (group beam search, as the recommendation evaluation) vs PathBeamSearch with the same constraints:
+    seconds per batch of users, whether they return the same paths and scores and whether
+    CumulativeSequenceScoreRanker gives the same top-k items from both. Paths scored -inf (dead ends) are left out
+    of the comparison of the paths, generate fills them with arbitrary tokens.
+    """
+    vocab = SyntheticVocab(args.n_users, args.n_products, args.n_entities, args.n_relations, degree=args.degree)
+    generator = torch.Generator().manual_seed(SEED)
+    first_user, first_product = vocab.first_ids['U'], vocab.first_ids['P']
+    # Candidate products of every user (the user negatives of the evaluation): a random half of the products
+    products = torch.rand((args.n_users, args.n_products), generator=generator).argsort(-1)[:, :args.n_products // 2]
+    force_token_map = {uid: (first_product + products[uid]).tolist() for uid in range(args.n_users)}
+    user_negatives = {uid: set(products[uid].tolist()) for uid in range(args.n_users)}
+    rankers = {name: CumulativeSequenceScoreRanker(vocab, user_negatives, K=10, max_new_tokens=args.path_length - 4)
+               for name in ('generate', 'path_search')}
+    processor = VectorizedConstrainedLogitsProcessorREC(
+        tokenized_kg=vocab.tokenized_kg(), force_token_map=force_token_map, total_length=args.path_length - 1,
+        tokenizer=vocab, num_return_sequences=args.n_return_sequences,
+        id_to_uid_token_map={first_user + uid: uid for uid in range(args.n_users)}, eos_token_ids=[EOS_ID])
+    model = build_model(args, vocab, use_type_embeddings=True).eval()
+    search = PathBeamSearch(model, processor.candidates, args.path_length - 1, args.n_beams, args.n_beam_groups,
+                            args.diversity_penalty, args.n_return_sequences, PAD_ID, share_prompt=args.share_prompt,
+                            output_scores=True)
+    results = dict(generate=0., path_search=0., paths=0, same_paths=0, max_score_difference=0.)
+    for step in range(args.steps):
+        users = first_user + torch.arange(step * args.batch_size, (step + 1) * args.batch_size) % args.n_users
+        prompts = torch.stack([torch.full_like(users, BOS_ID), users, torch.full_like(users, vocab.first_ids['R'])], -1)
+        prompts = prompts.to(args.device)
+        start = time.time()
+        with torch.no_grad():
+            outputs = model.generate(input_ids=prompts, attention_mask=torch.ones_like(prompts),
+                                     max_length=args.path_length - 1, min_length=args.path_length - 1,
+                                     num_return_sequences=args.n_return_sequences, num_beams=args.n_beams,
+                                     length_penalty=0., num_beam_groups=args.n_beam_groups,
+                                     diversity_penalty=args.diversity_penalty, do_sample=False,
+                                     logits_processor=LogitsProcessorList([processor]), return_dict_in_generate=True,
+                                     output_scores=True, pad_token_id=PAD_ID)
+        results['generate'] += time.time() - start
+        start = time.time()
+        sequences, scores, step_scores = search(prompts)
+        results['path_search'] += time.time() - start
+        rankers['path_search'].update_topk_paths(sequences, step_scores)
+        finite = torch.isfinite(outputs.sequences_scores)
+        same = (sequences == outputs.sequences).all(-1) & (torch.isfinite(scores) == finite)
+        results['paths'] += int(finite.sum())
+        results['same_paths'] += int((same & finite).sum())
+        results['max_score_difference'] = max(results['max_score_difference'],
+                                              float((scores[finite] - outputs.sequences_scores[finite]).abs().max()))
+        rankers['generate'].update_topk(outputs)
+    topks = {name: ranker.topk for name, ranker in rankers.items()}
+    results['users'] = len(topks['generate'])
+    results['same_topks'] = sum(topks['path_search'].get(uid) == topk for uid, topk in topks['generate'].items())
+    print(f"generate: {results['generate'] / args.steps * 1000:8.1f} ms/batch, "
+          f"PathBeamSearch: {results['path_search'] / args.steps * 1000:8.1f} ms/batch "
+          f"({results['generate'] / results['path_search']:.2f}x), same paths {results['same_paths']}/{results['paths']}, "
+          f"max score difference {results['max_score_difference']:.2e}, "
+          f"same top-k items {results['same_topks']}/{results['users']} users")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--benchmark", type=str, default="output_head", help="{output_head, training_loss, path_search}")
+    parser.add_argument("--n_users", type=int, default=6000)
+    parser.add_argument("--n_products", type=int, default=4000)
+    parser.add_argument("--n_entities", type=int, default=20000)
+    parser.add_argument("--n_relations", type=int, default=20)
+    parser.add_argument("--degree", type=int, default=8, help="Edges of every entity of the synthetic kg")
+    parser.add_argument("--path_length", type=int, default=9, help="Tokens of a path, [BOS] and [EOS] included")
+    parser.add_argument("--context_length", type=int, default=24)
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument("--steps", type=int, default=20)
+    parser.add_argument("--n_embd", type=int, default=768)
+    parser.add_argument("--n_layer", type=int, default=6)
+    parser.add_argument("--n_head", type=int, default=12)
+    parser.add_argument("--eval_steps", type=int, default=5, help="Steps between validation losses")
+    parser.add_argument("--lr", type=float, default=1e-3)
+    parser.add_argument("--n_negatives", type=int, default=256)
+    parser.add_argument("--n_kg_negatives", type=int, default=32)
+    parser.add_argument("--n_beams", type=int, default=50)
+    parser.add_argument("--n_beam_groups", type=int, default=5)
+    parser.add_argument("--diversity_penalty", type=float, default=0.3)
+    parser.add_argument("--n_return_sequences", type=int, default=30)
+    parser.add_argument('--share_prompt', default=False, action='store_true',
+                        help="PathBeamSearch encodes the prompt once per user instead of once per beam")
+    parser.add_argument("--device", type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    if args.benchmark == 'output_head':
+        benchmark_output_head(args)
+    elif args.benchmark == 'training_loss':
+        benchmark_training_loss(args)
+    elif args.benchmark == 'path_search':
+        benchmark_path_search(args)
+    else:
+        raise ValueError(f'Unknown benchmark {args.benchmark}')
@@ -0,0 +1,139 @@
+import time
+
+import torch
+from transformers import DataCollatorForLanguageModeling, TrainerCallback
+
+
+class FixedShapePathCollator:
+    """
+    Collator of PreBatchedPathDataset, whose items are already (batch_size, width) int32 batches.
+    The batch is passed as it is, a view of the dataset tensor, and is its own labels (KGGLM shifts them).
+    Only batches that contain padding get an attention mask and -100 labels on the padding.
+    """
+    def __init__(self, pad_token_id):
+        self.pad_token_id = pad_token_id
+
+    def __call__(self, batches):
+        input_ids = batches[0] if len(batches) == 1 else torch.cat(batches)
+        padding = input_ids == self.pad_token_id
+        if not padding.any():
+            return dict(input_ids=input_ids, labels=input_ids)
+        return dict(input_ids=input_ids, attention_mask=(~padding).long(),
+                    labels=input_ids.masked_fill(padding, -100))
+
+
+class PackedPathCollator:
+    """
+    Packs several paths in every context window instead of padding each of them to the longest one.
+    Paths are appended to the current row while they fit in context_length tokens. Every path gets
+    its own segment id (0 is padding) and positions restarting from 0. KGGLM turns the segment ids
+    into a block diagonal causal mask, so a path never attends to the others. The labels of padding
+    and of the first token of every path are -100, the loss does not predict a path from the previous one.
+    """
+    def __init__(self, tokenizer, context_length):
+        self.pad_token_id = tokenizer.pad_token_id
+        self.context_length = context_length
+        # Tokens, packed slots and the slots of the padded batches, for the throughput report
+        self.stats = dict(tokens=0, slots=0, padded_slots=0)
+
+    def segments(self, examples):
+        for example in examples:
+            input_ids = example["input_ids"]
+            if "attention_mask" in example:
+                n_tokens = int(sum(example["attention_mask"]))
+            else:
+                n_tokens = sum(1 for token_id in input_ids if token_id != self.pad_token_id)
+            yield list(input_ids[:min(n_tokens, self.context_length)])
+
+    def __call__(self, examples):
+        rows, widths = [[]], [0]
+        for segment in self.segments(examples):
+            if widths[-1] + len(segment) > self.context_length:
+                rows.append([])
+                widths.append(0)
+            rows[-1].append(segment)
+            widths[-1] += len(segment)
+        width = max(widths)
+
+        input_ids = torch.full((len(rows), width), self.pad_token_id, dtype=torch.long)
+        segment_ids = torch.zeros((len(rows), width), dtype=torch.long)
+        position_ids = torch.zeros((len(rows), width), dtype=torch.long)
+        labels = torch.full((len(rows), width), -100, dtype=torch.long)
+        n_tokens, longest = 0, 0
+        for i, row in enumerate(rows):
+            start = 0
+            for j, segment in enumerate(row):
+                end = start + len(segment)
+                input_ids[i, start:end] = torch.tensor(segment, dtype=torch.long)
+                segment_ids[i, start:end] = j + 1
+                position_ids[i, start:end] = torch.arange(len(segment))
+                labels[i, start + 1:end] = input_ids[i, start + 1:end]
+                start = end
+                n_tokens += len(segment)
+                longest = max(longest, len(segment))
+
+        self.stats['tokens'] += n_tokens
+        self.stats['slots'] += input_ids.numel()
+        self.stats['padded_slots'] += len(examples) * longest
+        return dict(input_ids=input_ids, segment_ids=segment_ids, position_ids=position_ids, labels=labels)
+
+
+def packed_attention_mask(segment_ids, dtype):
+    """
+    Additive (batch, 1, seq, seq) mask: a token attends to the previous tokens of its own segment.
+    Padding (segment 0) only attends to itself, so that no softmax row is empty.
+    """
+    seq_len = segment_ids.shape[1]
+    causal = torch.ones((seq_len, seq_len), dtype=torch.bool, device=segment_ids.device).tril()
+    allowed = (segment_ids[:, :, None] == segment_ids[:, None, :]) & causal
+    allowed |= torch.eye(seq_len, dtype=torch.bool, device=segment_ids.device)
+    mask = torch.zeros(allowed.shape, dtype=dtype, device=segment_ids.device)
+    mask.masked_fill_(~allowed, torch.finfo(dtype).min)
+    return mask[:, None, :, :]
+
+
+class PackingStatsCallback(TrainerCallback):
+    """Logs the share of real tokens in the packed and in the padded batches and the real tokens per second"""
+    def __init__(self, collator):
+        self.collator = collator
+        self.start = None
+
+    def on_train_begin(self, args, state, control, **kwargs):
+        self.start = time.time()
+
+    def on_log(self, args, state, control, logs=None, **kwargs):
+        stats = self.collator.stats
+        if logs is None or stats['slots'] == 0:
+            return
+        logs['packing_efficiency'] = stats['tokens'] / stats['slots']
+        logs['padding_efficiency'] = stats['tokens'] / max(stats['padded_slots'], 1)
+        logs['effective_tokens_per_second'] = stats['tokens'] / max(time.time() - self.start, 1e-9)
+
+
+def measure_throughput(model, collator, examples, batch_size, n_batches=10):
+    """Real (non padding) tokens per second of forward and backward passes over n_batches batches of examples"""
+    model.train()
+    device = next(model.parameters()).device
+    n_tokens, elapsed = 0, 0.
+    # The first batch is a warm up and is not timed
+    for i in range(n_batches + 1):
+        start = i * batch_size % len(examples)
+        batch = collator(examples[start:start + batch_size])
+        real = batch["segment_ids"] > 0 if "segment_ids" in batch else batch["attention_mask"] > 0
+        inputs = {k: v.to(device) for k, v in batch.items()}
+        start = time.time()
+        model(**inputs).loss.backward()
+        model.zero_grad(set_to_none=True)
+        if i > 0:
+            elapsed += time.time() - start
+            n_tokens += int(real.sum())
+    return n_tokens / elapsed
+
+
+def packing_gain(model, tokenizer, dataset, context_length, batch_size, n_batches=10):
+    """Effective tokens/s of padded and packed batches of the first examples of a tokenized dataset"""
+    examples = [dataset[i] for i in range(min(len(dataset), batch_size * n_batches))]
+    padded = measure_throughput(model, DataCollatorForLanguageModeling(tokenizer=tokenizer, mlm=False),
+                                examples, batch_size, n_batches)
+    packed = measure_throughput(model, PackedPathCollator(tokenizer, context_length), examples, batch_size, n_batches)
+    return dict(padded_tokens_per_second=padded, packed_tokens_per_second=packed, gain=packed / padded)
@@ -1,5 +1,7 @@
 
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
+
+import numpy as np
 
 
 def visit(node):
@@ -283,3 +285,96 @@ class LRUCache():
             # update the value.
             node.value = value
             self._move_to_head(node)
+
+
+class MaskCache:
+    """
+    LRU cache of the full vocabulary boolean masks of constrained decoding bounded by capacity_bytes. A mask is
+    stored bit-packed (vocab / 8 bytes) or, when smaller, as the int32 positions of its minority value (e.g. the
+    few candidates of a banned tokens mask). stats counts hits, misses, evictions, rejected puts and the bytes.
+
+    Admission is tuned from the stats of the last window requests: while the entries are evicted without being
+    hit (evictions of the window over half of its admissions and hit rate under min_hit_rate) a key needs one
+    more miss before its mask is stored, up to max_admission_misses, and one less once nothing is evicted.
+    The one-off keys of a long tail of beams then stop flushing the masks that are reused.
+    """
+    def __init__(self, capacity_bytes, window=10 ** 4, min_hit_rate=0.5, max_admission_misses=4):
+        self.capacity_bytes = capacity_bytes
+        self.window = window
+        self.min_hit_rate = min_hit_rate
+        self.max_admission_misses = max_admission_misses
+        self.admission_misses = 1
+        self.entries = OrderedDict()
+        self.key_misses = defaultdict(int)
+        self.stats = dict(hits=0, misses=0, evictions=0, rejected=0, bytes=0)
+        self._window_start = dict(self.stats, admitted=0)
+        self._admitted = 0
+
+    @staticmethod
+    def encode(mask):
+        mask = np.asarray(mask, dtype=np.bool_)
+        majority = bool(np.count_nonzero(mask) * 2 >= len(mask))
+        positions = np.flatnonzero(mask != majority).astype(np.int32)
+        if positions.nbytes < (len(mask) + 7) // 8:
+            return 'positions', positions, len(mask), majority
+        return 'bits', np.packbits(mask), len(mask), majority
+
+    @staticmethod
+    def decode(entry):
+        kind, payload, length, majority = entry
+        if kind == 'bits':
+            return np.unpackbits(payload, count=length).view(np.bool_)
+        mask = np.full(length, majority, dtype=np.bool_)
+        mask[payload] = not majority
+        return mask
+
+    def get(self, key):
+        self.maybe_tune()
+        entry = self.entries.get(key)
+        if entry is None:
+            self.stats['misses'] += 1
+            self.key_misses[key] += 1
+            return None
+        self.stats['hits'] += 1
+        self.entries.move_to_end(key)
+        return self.decode(entry)
+
+    def put(self, key, mask):
+        if key in self.entries:
+            self.stats['bytes'] -= self.entries.pop(key)[1].nbytes
+        elif self.key_misses.get(key, 0) < self.admission_misses:
+            self.stats['rejected'] += 1
+            return
+        entry = self.encode(mask)
+        if entry[1].nbytes > self.capacity_bytes:
+            self.stats['rejected'] += 1
+            return
+        self.key_misses.pop(key, None)
+        self.entries[key] = entry
+        self.stats['bytes'] += entry[1].nbytes
+        self._admitted += 1
+        while self.stats['bytes'] > self.capacity_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.stats['bytes'] -= evicted[1].nbytes
+            self.stats['evictions'] += 1
+
+    def maybe_tune(self):
+        start = self._window_start
+        requests = self.stats['hits'] + self.stats['misses'] - start['hits'] - start['misses']
+        if requests < self.window:
+            return
+        hit_rate = (self.stats['hits'] - start['hits']) / requests
+        evictions = self.stats['evictions'] - start['evictions']
+        admitted = self._admitted - start['admitted']
+        if evictions > admitted / 2 and hit_rate < self.min_hit_rate:
+            self.admission_misses = min(self.admission_misses + 1, self.max_admission_misses)
+        elif evictions == 0:
+            self.admission_misses = max(self.admission_misses - 1, 1)
+        # Miss counts only of the last window, a key must be missed again soon to be admitted
+        self.key_misses.clear()
+        self._window_start = dict(self.stats, admitted=self._admitted)
+
+    def summary(self):
+        requests = self.stats['hits'] + self.stats['misses']
+        return dict(self.stats, entries=len(self.entries), hit_rate=self.stats['hits'] / max(requests, 1),
+                    admission_misses=self.admission_misses)
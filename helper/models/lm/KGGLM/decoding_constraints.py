@@ -1,11 +1,15 @@
 import math
+import time
 from collections import defaultdict
+from contextlib import contextmanager
 
 import numpy as np
 import torch
 from transformers import LogitsProcessor
 
-from helper.models.lm.KGGLM.decoding_cache import LFUCache
+from helper.models.lm.KGGLM.decoding_cache import LFUCache, MaskCache
+from helper.models.lm.KGGLM.transition_table import (KGTransitionTable, PaddedTokenSets, TokenPairIndex,
+                                                      TokenSets)
 
 """LP logit processor forces last token to reachable ones"""
 
@@ -50,6 +54,79 @@ class ConstrainedLogitsProcessorLP(LogitsProcessor):
         return scores
 
 
+class VectorizedConstrainedLogitsProcessorLP(LogitsProcessor):
+    """
+    Same constraints as ConstrainedLogitsProcessorLP for all the rows of a step at once: the positive tails and the
+    special tokens of every (head, relation) pair are precomputed as padded candidate id tensors, a step is one
+    gather and one scatter of -inf into the scores. The CSR layout of TokenSets replaces the padded one when
+    padding to the longest set would take more than max_padded_elements ids.
+    """
+    def __init__(self, tokenized_kg, positive_token_map, total_length, tokenizer, num_return_sequences,
+                 eos_token_ids, max_padded_elements=25 * 10 ** 6, **kwargs):
+        super().__init__()
+        self.total_length = total_length
+        self.num_return_sequences = num_return_sequences
+        self.eos_token_ids = eos_token_ids
+        self.special_tokens_ids = [tokenizer.encode(x, add_special_tokens=False)[0]
+                                   for x in tokenizer.all_special_tokens_extended]
+        pairs = list(positive_token_map.keys())
+        self.pairs = TokenPairIndex(pairs, len(tokenizer.get_vocab()))
+        positives = {key: positive_token_map[pair] for key, pair in enumerate(pairs)}
+        if (len(pairs) + 1) * PaddedTokenSets.longest(positives, self.special_tokens_ids) <= max_padded_elements:
+            self.positives = PaddedTokenSets(positives, len(pairs), pad_token_id=self.special_tokens_ids[0],
+                                             shared_tokens=self.special_tokens_ids)
+        else:
+            self.positives = TokenSets(positives, len(pairs))
+
+    def __call__(self, input_ids, scores):
+        cur_len = input_ids.shape[-1]
+        if cur_len == self.total_length:
+            scores[:, :] = -math.inf
+            scores[:, self.eos_token_ids] = 0.
+        elif cur_len % 2 == 1:
+            keys = self.pairs.keys(input_ids[:, -2], input_ids[:, -1])
+            if isinstance(self.positives, PaddedTokenSets):
+                scores.scatter_(1, self.positives.ids(keys), -math.inf)
+            else:
+                scores[self.positives.entries(keys)] = -math.inf
+                scores[:, self.special_tokens_ids] = -math.inf
+        return scores
+
+
+class TimedLogitsProcessor(LogitsProcessor):
+    """
+    Stats hook of a logits processor: adds up its calls and seconds, and the seconds of the generate calls run
+    inside generation(), processor_share is the share of the generation time spent in the processor.
+    """
+    def __init__(self, processor):
+        super().__init__()
+        self.processor = processor
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stats = dict(calls=0, processor_seconds=0., generate_seconds=0.)
+
+    def __call__(self, input_ids, scores):
+        if scores.is_cuda:
+            torch.cuda.synchronize(scores.device)
+        start = time.perf_counter()
+        scores = self.processor(input_ids, scores)
+        if scores.is_cuda:
+            torch.cuda.synchronize(scores.device)
+        self.stats['calls'] += 1
+        self.stats['processor_seconds'] += time.perf_counter() - start
+        return scores
+
+    @contextmanager
+    def generation(self):
+        start = time.perf_counter()
+        yield
+        self.stats['generate_seconds'] += time.perf_counter() - start
+
+    def processor_share(self):
+        return self.stats['processor_seconds'] / max(self.stats['generate_seconds'], 1e-9)
+
+
 """
 Force the last token to be one of the force_tokens if the total length is reached, in the path generation stage this means
 to limit the hop size. This is a word-level constraint, does not work with piece tokenizers.
@@ -58,7 +135,7 @@ to limit the hop size. This is a word-level constraint, does not work with piece
 
 class ConstrainedLogitsProcessorREC(LogitsProcessor):
     def __init__(self, tokenized_kg, force_token_map, total_length, tokenizer, num_return_sequences,
-                 id_to_uid_token_map, eos_token_ids, mask_cache_size=3*10**4, cand_cache_size=1*10**5, **kwargs):
+                 id_to_uid_token_map, eos_token_ids, mask_cache_bytes=256 * 2 ** 20, cand_cache_size=1*10**5, **kwargs):
         super().__init__(**kwargs)
         self.kg = tokenized_kg
         self.force_token_map = force_token_map
@@ -71,8 +148,7 @@ class ConstrainedLogitsProcessorREC(LogitsProcessor):
         self.eos_token_ids = eos_token_ids
         self.vocab_tokens = [i for i in range(len(self.tokenizer.get_vocab()))]
         self.cache = LFUCache(cand_cache_size)  # dict()
-        # self.mask_cache = dict()
-        self.mask_cache = LFUCache(mask_cache_size)
+        self.mask_cache = MaskCache(mask_cache_bytes)
 
     def __call__(self, input_ids, scores):
         cur_len = input_ids.shape[-1]
@@ -147,3 +223,55 @@ class ConstrainedLogitsProcessorREC(LogitsProcessor):
             scores[banned_tokens_mask] = -math.inf
         return scores
 
+
+
+class VectorizedConstrainedLogitsProcessorREC(LogitsProcessor):
+    """
+    Same constraints as ConstrainedLogitsProcessorREC, with the masks of all the rows of a step built at once on
+    the device of the scores from a KGTransitionTable and the candidate products of every user token,
+    without per-row python: the cost of a step does not grow with the number of beams.
+    """
+    def __init__(self, tokenized_kg, force_token_map, total_length, tokenizer, num_return_sequences,
+                 id_to_uid_token_map, eos_token_ids, **kwargs):
+        super().__init__()
+        self.total_length = total_length
+        self.num_return_sequences = num_return_sequences
+        self.eos_token_ids = eos_token_ids
+        self.vocab_size = len(tokenizer.get_vocab())
+        self.transitions = KGTransitionTable(tokenized_kg, self.vocab_size)
+        self.user_products = TokenSets({token_id: force_token_map[uid] for token_id, uid in id_to_uid_token_map.items()
+                                        if uid in force_token_map}, self.vocab_size)
+
+    def __call__(self, input_ids, scores):
+        cur_len = input_ids.shape[-1]
+        if cur_len == self.total_length:
+            scores[:, :] = -math.inf
+            scores[:, self.eos_token_ids] = 0.
+            return scores
+        width = scores.shape[1]
+        if cur_len % 2 == 1:
+            allowed = self.transitions.tails_mask(input_ids[:, -2], input_ids[:, -1], width)
+            if cur_len == self.total_length - 1:  # Only products in the user negatives
+                allowed &= self.user_products.mask(input_ids[:, 1], width)
+        else:
+            allowed = self.transitions.relations_mask(input_ids[:, -1], width)
+        scores.masked_fill_(~allowed, -math.inf)
+        return scores
+
+    def candidates(self, input_ids):
+        """
+        (row, token) indices of the tokens allowed after every row of input_ids, the same as the scores left by
+        __call__. PathBeamSearch only scores these tokens.
+        """
+        cur_len = input_ids.shape[-1]
+        if cur_len >= self.total_length:
+            eos_token_ids = torch.tensor(self.eos_token_ids, device=input_ids.device)
+            rows = torch.arange(len(input_ids), device=input_ids.device).repeat_interleave(len(eos_token_ids))
+            return rows, eos_token_ids.repeat(len(input_ids))
+        if cur_len % 2 == 0:
+            return self.transitions.relations.entries(input_ids[:, -1])
+        rows, tokens = self.transitions.tails.entries(self.transitions.pairs.keys(input_ids[:, -2], input_ids[:, -1]))
+        if cur_len == self.total_length - 1:
+            keep = self.user_products.mask(input_ids[:, 1], self.vocab_size)[rows, tokens]
+            rows, tokens = rows[keep], tokens[keep]
+        return rows, tokens
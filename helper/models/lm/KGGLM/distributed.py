@@ -0,0 +1,65 @@
+import os
+from contextlib import contextmanager
+from datetime import timedelta
+
+import torch
+import torch.distributed as dist
+
+
+def world_size():
+    return int(os.environ.get('WORLD_SIZE', 1))
+
+
+def rank():
+    return int(os.environ.get('RANK', 0))
+
+
+def init_cpu_distributed(timeout_minutes=30):
+    """
+    Joins the gloo process group of a torchrun launch (torchrun --nproc_per_node=N main.py --cpu_ddp ...),
+    the Trainer reuses it. Every process gets an equal share of the cores for its intra-op pool, with one
+    process per socket (and numactl --cpunodebind) each process runs on the memory of its own socket.
+    timeout_minutes bounds every collective, the other ranks wait in one for the whole evaluation of rank 0.
+    """
+    local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', 1))
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // local_world_size))
+    if world_size() > 1 and not dist.is_initialized():
+        dist.init_process_group(backend='gloo', rank=rank(), world_size=world_size(),
+                                timeout=timedelta(minutes=timeout_minutes))
+
+
+def cpu_bf16_supported():
+    """Whether the cpu has native bf16 instructions (AVX512-BF16 or AMX), where bf16 autocast is faster than fp32"""
+    try:
+        with open('/proc/cpuinfo') as f:
+            flags = next((line for line in f if line.startswith('flags')), '').split()
+    except OSError:
+        return False
+    return 'avx512_bf16' in flags or 'amx_bf16' in flags
+
+
+@contextmanager
+def main_process_first():
+    """Rank 0 runs the block first (e.g. filling a cache), the other ranks after it, reusing its output"""
+    if world_size() > 1 and dist.is_initialized() and rank() != 0:
+        dist.barrier()
+    yield
+    if world_size() > 1 and dist.is_initialized() and rank() == 0:
+        dist.barrier()
+
+
+def broadcast_object(obj):
+    """The obj of rank 0 on every rank"""
+    if world_size() == 1 or not dist.is_initialized():
+        return obj
+    shared = [obj]
+    dist.broadcast_object_list(shared, src=0)
+    return shared[0]
+
+
+def evaluate_on_main_process(trainer):
+    """Runs trainer.evaluate on the unwrapped (not DDP) model on rank 0 only and shares its metrics with the other ranks"""
+    metrics = None
+    if trainer.args.process_index == 0:
+        metrics = trainer.evaluate(trainer.model)
+    return broadcast_object(metrics)
@@ -0,0 +1,90 @@
+import multiprocessing
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import torch
+import wandb
+from transformers import TrainingArguments
+
+from helper.models.lm.KGGLM.KGGLM import KGGLM
+
+# Trainer used by an evaluator process, built on its first checkpoint
+_worker_trainer = None
+_worker_trainer_cls = None
+_worker_trainer_kwargs = None
+
+
+def _init_worker(trainer_cls, trainer_kwargs):
+    global _worker_trainer_cls, _worker_trainer_kwargs
+    _worker_trainer_cls, _worker_trainer_kwargs = trainer_cls, trainer_kwargs
+
+
+def _evaluate_snapshot(snapshot_dir):
+    """Metrics of the trainer evaluate (top-k generation and ranking) of the model saved in snapshot_dir"""
+    global _worker_trainer
+    eval_device = _worker_trainer_kwargs['eval_device']
+    model = KGGLM.from_pretrained(snapshot_dir).to(eval_device)
+    if _worker_trainer is None:
+        fields = TrainingArguments.__dataclass_fields__
+        device_kwargs = {} if str(eval_device).startswith('cuda') else {'use_cpu' if 'use_cpu' in fields else 'no_cuda': True}
+        args = TrainingArguments(output_dir=os.path.join(snapshot_dir, os.pardir, 'evaluator'), report_to='none',
+                                 **device_kwargs)
+        _worker_trainer = _worker_trainer_cls(model=model, args=args, **_worker_trainer_kwargs)
+    with torch.no_grad():
+        return _worker_trainer.evaluate(model)
+
+
+class AsyncCheckpointEvaluator:
+    """
+    Evaluates the saved checkpoints of a trainer in a pool of n_workers separate processes while training goes on.
+    submit saves a snapshot of the model weights, collect feeds the metrics back in submission order as they
+    arrive: logs, wandb, the on_evaluate callbacks (early stopping) and the best metric. Only the snapshot of
+    the best model is kept, finish waits for the pending evaluations and loads it if load_best_model_at_end.
+    trainer_cls and trainer_kwargs build the trainer of every evaluator process, without training data.
+    """
+    def __init__(self, trainer_cls, trainer_kwargs, snapshot_dir, n_workers=1):
+        self.snapshot_dir = snapshot_dir
+        self.pool = ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context('spawn'),
+                                        initializer=_init_worker, initargs=(trainer_cls, trainer_kwargs))
+        self.pending = []
+        self.best_snapshot = None
+
+    def submit(self, trainer):
+        snapshot = os.path.join(self.snapshot_dir, f'snapshot-{trainer.state.global_step}')
+        trainer.model.save_pretrained(snapshot)
+        self.pending.append((trainer.state.global_step, snapshot, self.pool.submit(_evaluate_snapshot, snapshot)))
+
+    def collect(self, trainer, wait=False):
+        """Feeds back the metrics of the finished evaluations, with wait=True of all the pending ones"""
+        while self.pending and (wait or self.pending[0][2].done()):
+            step, snapshot, future = self.pending.pop(0)
+            metrics = future.result()
+            logs = dict(metrics, eval_checkpoint_step=step)
+            if trainer.cmd_args.wandb:
+                wandb.log(logs)
+            trainer.log(logs)
+            trainer.control = trainer.callback_handler.on_evaluate(trainer.args, trainer.state, trainer.control, metrics)
+            self.update_best(trainer, metrics, snapshot)
+
+    def update_best(self, trainer, metrics, snapshot):
+        metric_name = trainer.args.metric_for_best_model
+        if metric_name is not None and not metric_name.startswith('eval_'):
+            metric_name = f'eval_{metric_name}'
+        operator = np.greater if trainer.args.greater_is_better else np.less
+        if metric_name in metrics and (trainer.state.best_metric is None
+                                       or operator(metrics[metric_name], trainer.state.best_metric)):
+            trainer.state.best_metric = metrics[metric_name]
+            snapshot, self.best_snapshot = self.best_snapshot, snapshot
+        if snapshot is not None:
+            shutil.rmtree(snapshot, ignore_errors=True)
+
+    def finish(self, trainer):
+        self.collect(trainer, wait=True)
+        self.pool.shutdown()
+        if trainer.args.load_best_model_at_end and self.best_snapshot is not None:
+            best_model = KGGLM.from_pretrained(self.best_snapshot)
+            trainer.model.load_state_dict(best_model.state_dict())
+            print(f'Loaded the best model ({trainer.args.metric_for_best_model}: {trainer.state.best_metric}) '
+                  f'from {self.best_snapshot}')
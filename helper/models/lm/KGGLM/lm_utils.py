@@ -1,6 +1,8 @@
 import time
 from typing import Dict, List, Tuple
 
+import numpy as np
+import torch
 from tqdm import tqdm
 from transformers import TrainerCallback
 
@@ -48,8 +50,6 @@ def tokenize_augmented_kg(kg, tokenizer, use_token_ids=False):
     type_id_to_subtype_mapping[RELATION] = {
         int(k): v for k, v in rel_id2type.items()}
 
-    aug_kg = kg.aug_kg
-
     token_id_to_token = dict()
     kg_to_vocab_mapping = dict()
     tokenized_kg = dict()
@@ -73,29 +73,60 @@ def tokenize_augmented_kg(kg, tokenizer, use_token_ids=False):
             value = token_id
         kg_to_vocab_mapping[(subtype, cur_id)] = token_id
 
-    for head_type in aug_kg:
-        for head_id in aug_kg[head_type]:
-            head_key = head_type, head_id
-            if head_key not in kg_to_vocab_mapping:
-                continue
-            head_ent_token = kg_to_vocab_mapping[head_key]
-            tokenized_kg[head_ent_token] = dict()
-
-            for rel in aug_kg[head_type][head_id]:
-                rel_token = kg_to_vocab_mapping[rel, None]
-                tokenized_kg[head_ent_token][rel_token] = set()
-
-                for tail_type in aug_kg[head_type][head_id][rel]:
-                    for tail_id in aug_kg[head_type][head_id][rel][tail_type]:
-                        tail_key = tail_type, tail_id
-                        if tail_key not in kg_to_vocab_mapping:
-                            continue
-                        tail_token = kg_to_vocab_mapping[tail_key]
-                        tokenized_kg[head_ent_token][rel_token].add(tail_token)
+    # Token id of every node and relation of the csr graph, -1 if not in the vocabulary
+    csr_kg = kg.csr_kg
+    node_tokens = np.full(csr_kg.n_nodes, -1, dtype=np.int64)
+    for code, ent_type in enumerate(csr_kg.ent_types):
+        start = csr_kg.type_start[code]
+        for row, ent_id in enumerate(csr_kg.ids(ent_type).tolist(), start):
+            node_tokens[row] = kg_to_vocab_mapping.get((ent_type, ent_id), -1)
+    rel_tokens = {rel_id: kg_to_vocab_mapping[rel, None] for rel_id, rel in csr_kg.rel_id2type.items()
+                  if (rel, None) in kg_to_vocab_mapping}
+
+    heads = np.repeat(node_tokens, csr_kg.degrees())
+    tails = node_tokens[csr_kg.indices]
+    rels = csr_kg.rels.astype(np.int64)
+    # Nodes without outgoing edges still get an (empty) entry
+    for head_ent_token in node_tokens[node_tokens >= 0].tolist():
+        tokenized_kg[head_ent_token] = dict()
+    # Edges are grouped by head and relation, add the tails of each group at once
+    valid = heads >= 0
+    heads, rels, tails = heads[valid], rels[valid], tails[valid]
+    bounds = np.flatnonzero((heads[1:] != heads[:-1]) | (rels[1:] != rels[:-1])) + 1
+    for begin, end in zip(np.r_[0, bounds], np.r_[bounds, len(heads)]):
+        if begin == end:
+            continue
+        rel_token = rel_tokens[int(rels[begin])]
+        group_tails = tails[begin:end]
+        tokenized_kg[int(heads[begin])].setdefault(rel_token, set()).update(group_tails[group_tails >= 0].tolist())
 
     return tokenized_kg, kg_to_vocab_mapping
 
 
+def get_next_entity_types(tokenized_kg, tokenizer):
+    """Type letters (U, P, E) of the tail entities of every relation token of the tokenized kg"""
+    token_types = {token_id: token[0] for token, token_id in tokenizer.get_vocab().items()}
+    next_entity_types = dict()
+    for relations in tokenized_kg.values():
+        for rel_token_id, tails in relations.items():
+            next_entity_types.setdefault(rel_token_id, set()).update(token_types[tail] for tail in tails)
+    return {rel_token_id: ''.join(sorted(types)) for rel_token_id, types in next_entity_types.items() if types}
+
+
+def get_kg_neighbours(tokenized_kg, vocab_size):
+    """Token level csr adjacency (indptr, indices) of the tokenized kg, the tail tokens of every head token"""
+    heads, tails = [], []
+    for head, relations in tokenized_kg.items():
+        neighbours = sorted(set().union(*relations.values()))
+        heads.extend([head] * len(neighbours))
+        tails.extend(neighbours)
+    heads, tails = np.array(heads, dtype=np.int64), np.array(tails, dtype=np.int64)
+    order = np.argsort(heads, kind='stable')
+    indptr = np.zeros(vocab_size + 1, dtype=np.int64)
+    np.cumsum(np.bincount(heads, minlength=vocab_size), out=indptr[1:])
+    return torch.from_numpy(indptr), torch.from_numpy(tails[order])
+
+
 class TimingCallback(TrainerCallback):
     def __init__(self):
         self.epoch_times = []
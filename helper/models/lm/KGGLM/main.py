@@ -1,22 +1,35 @@
 import argparse
+import math
 import os
 from datetime import datetime
 
 import wandb
-from datasets import load_from_disk
+from datasets import DatasetDict
 from transformers import (AutoConfig, AutoModelForCausalLM,
                           DataCollatorForLanguageModeling,
                           EarlyStoppingCallback, PreTrainedTokenizerFast,
                           TrainingArguments, set_seed)
 
+from helper.models.lm.KGGLM.collators import FixedShapePathCollator, packing_gain
+from helper.models.lm.KGGLM.distributed import (broadcast_object,
+                                                cpu_bf16_supported,
+                                                init_cpu_distributed,
+                                                main_process_first, rank,
+                                                world_size)
+from helper.models.lm.KGGLM.evaluator import AsyncCheckpointEvaluator
 from helper.models.lm.KGGLM.KGGLM import KGGLM
 from helper.models.lm.KGGLM.lm_utils import (TimingCallback,
                                              _initialise_type_masks,
+                                             get_kg_neighbours,
+                                             get_next_entity_types,
                                              tokenize_augmented_kg)
 from helper.models.lm.KGGLM.parser import parser_kgglm_args
 from helper.models.lm.KGGLM.trainer import (PathFinetuneExplainableRecTrainer,
                                             PathFinetuneLinkPredictionTrainer,
                                             PathPretrainTrainer)
+from helper.models.lm.path_dataset import (PathDataset, PreBatchedPathDataset,
+                                           TokenizedPathDataset)
+from helper.models.lm.tokenized_cache import TokenizedPathCache
 from helper.sampling import KGsampler
 from helper.utils import (SEED, check_dir, get_data_dir, get_root_data_dir,
                           get_weight_dir)
@@ -37,6 +50,10 @@ def update_model_config(model, tokenizer, args):
         'ent_mask': ent_mask,
         'rel_mask': rel_mask,
         'token_id_to_token': token_id_to_token,
+        'output_head': args.output_head,
+        'training_loss': args.training_loss,
+        'n_negatives': args.n_negatives,
+        'n_kg_negatives': args.n_kg_negatives,
         # Any other configurations derived directly from args
     })
 
@@ -58,7 +75,7 @@ def initialize_model_and_update_config(tokenizer, args):
         print('Loading from checkpoint for resuming training:', args.pretrain_ckpt)
     else:
         # New model training logic
-        model = KGGLM(AutoConfig.from_pretrained(args.model, **config_kwargs))
+        model = KGGLM(AutoConfig.from_pretrained(args.model, use_type_embeddings=True, **config_kwargs))
         print('[+] Training from Scratch')
 
     update_model_config(model, tokenizer, args)
@@ -69,6 +86,15 @@ def prepare_training_arguments(args):
     trainer_logging_root = os.path.join(
         args.output_dir, args.exp_name, 'train_checkpoints')
     check_dir(trainer_logging_root)
+    device_kwargs = dict(fp16=True, bf16=False)
+    if args.cpu_ddp:
+        # Gloo data parallel over the torchrun processes, the distributed sampler shards the dataset by rank
+        fields = TrainingArguments.__dataclass_fields__
+        device_kwargs = {'fp16': False, 'bf16': cpu_bf16_supported(),
+                         'use_cpu' if 'use_cpu' in fields else 'no_cuda': True,
+                         'ddp_backend' if 'ddp_backend' in fields else 'xpu_backend': 'gloo'}
+        if 'ddp_timeout' in fields:
+            device_kwargs['ddp_timeout'] = args.dist_timeout * 60
     return TrainingArguments(
         output_dir=trainer_logging_root,
         evaluation_strategy="steps",
@@ -77,11 +103,12 @@ def prepare_training_arguments(args):
         logging_steps=min(args.logging_interval, args.validation_interval),
         learning_rate=2e-4,
         weight_decay=0.01,
-        bf16=False,
-        fp16=True,
+        **device_kwargs,
         logging_first_step=True,
         num_train_epochs=args.num_epochs,
-        per_device_train_batch_size=args.batch_size,
+        max_steps=getattr(args, 'max_steps', -1),
+        # Every item of a pre-batched dataset is already a whole batch
+        per_device_train_batch_size=1 if args.prebatched else args.batch_size,
         per_device_eval_batch_size=args.test_batch_size,
         warmup_steps=250,
         save_steps=args.validation_interval,
@@ -100,70 +127,70 @@ def train(args: argparse.Namespace, tokenizer, tokenized_dataset, kg):
     # Instantiate the TimingCallback
     timing_callback = TimingCallback()
     tokenized_kg, _ = tokenize_augmented_kg(kg, tokenizer, use_token_ids=True)
+    if args.output_head == 'typed' and args.split_entity_types:
+        # The typed head only predicts the entity types a relation can lead to
+        model.config.update({'next_entity_types': get_next_entity_types(tokenized_kg, tokenizer)})
+    if args.training_loss == 'kg':
+        model.set_kg_neighbours(*get_kg_neighbours(tokenized_kg, len(tokenizer)))
+    if args.packing and args.task != 'pretrain':
+        # Fails before training rather than at the first packed batch
+        model.check_packed_attention()
     training_args = prepare_training_arguments(args)
+    if args.prebatched:
+        data_collator = FixedShapePathCollator(tokenizer.pad_token_id)
+    else:
+        data_collator = DataCollatorForLanguageModeling(tokenizer=tokenizer, mlm=False)
+    # Everything the trainers need to evaluate, also used to build the trainers of the evaluator processes
+    eval_kwargs = dict(
+        cmd_args=args,
+        dataset_name=args.dataset,
+        tokenized_kg=tokenized_kg,
+        n_hop=args.n_hop,
+        infer_batch_size=args.infer_batch_size,
+        tokenizer=tokenizer,
+        eval_device=args.eval_device,
+        experiment_name=args.experiment_model_name,
+    )
     if args.task == 'pretrain':
-        trainer = PathPretrainTrainer(
-            cmd_args=args,
-            dataset_name=args.dataset,
-            tokenized_kg=tokenized_kg,
-            n_hop=args.n_hop,
-            infer_batch_size=args.infer_batch_size,
+        trainer_cls = PathPretrainTrainer
+        eval_kwargs.update(
             n_sequences_per_user=args.n_seq_infer,
             n_sequences_lp=args.n_seq_infer_lp,
             n_beams=args.n_beams,
             n_beams_lp=args.n_beams_lp,
-            tokenizer=tokenizer,
-            eval_device=args.eval_device,
-            model=model,
-            args=training_args,
-            train_dataset=tokenized_dataset["train"],
-            experiment_name=args.experiment_model_name,
-            data_collator=DataCollatorForLanguageModeling(
-                tokenizer=tokenizer, mlm=False),
-            callbacks=[EarlyStoppingCallback(
-                early_stopping_patience=3), timing_callback]
         )
     elif args.task == 'finetuneLP':
-        trainer = PathFinetuneLinkPredictionTrainer(
-            cmd_args=args,
-            dataset_name=args.dataset,
-            tokenized_kg=tokenized_kg,
-            n_hop=args.n_hop,
-            infer_batch_size=args.infer_batch_size,
+        trainer_cls = PathFinetuneLinkPredictionTrainer
+        eval_kwargs.update(
             n_sequences_lp=args.n_seq_infer_lp,
             n_beams_lp=args.n_beams_lp,
-            tokenizer=tokenizer,
-            eval_device=args.eval_device,
-            model=model,
-            args=training_args,
-            train_dataset=tokenized_dataset["train"],
-            experiment_name=args.experiment_model_name,
-            data_collator=DataCollatorForLanguageModeling(
-                tokenizer=tokenizer, mlm=False),
-            callbacks=[EarlyStoppingCallback(
-                early_stopping_patience=3), timing_callback]
         )
     elif args.task == 'finetuneRec':
-        trainer = PathFinetuneExplainableRecTrainer(
-            cmd_args=args,
-            dataset_name=args.dataset,
-            tokenized_kg=tokenized_kg,
-            n_hop=args.n_hop,
-            infer_batch_size=args.infer_batch_size,
+        trainer_cls = PathFinetuneExplainableRecTrainer
+        eval_kwargs.update(
             n_sequences_per_user=args.n_seq_infer,
             n_beams=args.n_beams,
-            tokenizer=tokenizer,
-            eval_device=args.eval_device,
-            model=model,
-            args=training_args,
-            train_dataset=tokenized_dataset["train"],
-            experiment_name=args.experiment_model_name,
-            data_collator=DataCollatorForLanguageModeling(
-                tokenizer=tokenizer, mlm=False),
-            callbacks=[EarlyStoppingCallback(
-                early_stopping_patience=3), timing_callback]
         )
+    trainer = trainer_cls(
+        **eval_kwargs,
+        model=model,
+        args=training_args,
+        train_dataset=tokenized_dataset["train"],
+        data_collator=data_collator,
+        callbacks=[EarlyStoppingCallback(
+            early_stopping_patience=3), timing_callback]
+    )
+    if args.async_eval_workers > 0:
+        trainer.async_evaluator = AsyncCheckpointEvaluator(
+            trainer_cls, eval_kwargs, os.path.join(args.output_dir, args.exp_name, 'eval_snapshots'),
+            n_workers=args.async_eval_workers)
+    if args.packing and args.task != 'pretrain' and not args.streaming:
+        gain = packing_gain(model, tokenizer, tokenized_dataset["train"], args.context_length, args.batch_size)
+        print(f"Effective tokens/s: {gain['padded_tokens_per_second']:.0f} padded, "
+              f"{gain['packed_tokens_per_second']:.0f} packed ({gain['gain']:.2f}x)")
     trainer.train()
+    if trainer.async_evaluator is not None:
+        trainer.async_evaluator.finish(trainer)
     weight_path = get_weight_dir(args.experiment_model_name, args.dataset)
     trainer.save_model(weight_path)
 
@@ -176,9 +203,18 @@ def train(args: argparse.Namespace, tokenizer, tokenized_dataset, kg):
 if __name__ == "__main__":
     args=parser_kgglm_args()
     set_seed(SEED)
+    if args.cpu_ddp and args.async_eval_workers > 0:
+        raise ValueError('--async_eval_workers cannot be combined with --cpu_ddp, ranks would stop at different steps')
+    if args.native_beam_search and not args.vectorized_constraints:
+        raise ValueError('--native_beam_search needs the candidates of --vectorized_constraints')
+    if args.cpu_ddp:
+        init_cpu_distributed(args.dist_timeout)
+        args.eval_device = 'cpu'
 
     project_name = f'from_scratch_llm_v7@{args.dataset}'
-    run_name = f"{args.exp_name}@{args.dataset}@{args.model}@{args.n_hop}@{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}"
+    # Every rank logs and saves in the run directory of rank 0
+    run_time = broadcast_object(datetime.now().strftime('%Y-%m-%d_%H-%M-%S'))
+    run_name = f"{args.exp_name}@{args.dataset}@{args.model}@{args.n_hop}@{run_time}"
     log_dir = os.path.join(project_name, run_name)
     os.makedirs(log_dir, exist_ok=True)
 
@@ -187,7 +223,7 @@ if __name__ == "__main__":
     args.output_dir = log_dir
     args.experiment_model_name = f"{args.task}@{args.dataset}@{args.model}@{args.sample_size}@{args.n_hop}@{args.logit_processor_type}"
 
-    if args.wandb:
+    if args.wandb and rank() == 0:
         wandb.init(
             # set the wandb project where this run will be logged
             project=project_name,
@@ -209,20 +245,50 @@ if __name__ == "__main__":
     kg = KGsampler(args.dataset)
     sample_size = args.sample_size
     dataset_hop_size = args.n_hop
-    TOKENIZED_DATASET_PATH = os.path.join(
-        dataset_root_dir, f"{TOKENIZER_TYPE}/{args.task}_{sample_size}_{dataset_hop_size}_tokenized_dataset.hf")
+    TOKENIZED_CACHE_DIR = os.path.join(dataset_root_dir, TOKENIZER_TYPE, 'tokenized_cache')
     TOKEN_INDEX_PATH = os.path.join(dirpath, KGsampler.TOKEN_INDEX_FILE)
-    # Try to load the dataset from disk if it has been already tokenized otherwise load it from scratch
-    if os.path.exists(TOKENIZED_DATASET_PATH) and os.path.exists(tokenizer_file):
-        task = args.task
-        tokenized_dataset = load_from_disk(
-            TOKENIZED_DATASET_PATH)
+    if args.binary_corpus and os.path.exists(tokenizer_file):
+        # Token id shards written by the sampler, no tokenization pass
+        tokenizer = PreTrainedTokenizerFast(tokenizer_file=tokenizer_file, max_len=args.context_length,
+                                            eos_token="[EOS]", bos_token="[BOS]",
+                                            pad_token="[PAD]", unk_token="[UNK]",
+                                            mask_token="[MASK]", use_fast=True)
+        train_dataset = TokenizedPathDataset(dataset_name, dataset_root_dir, task=args.task,
+                                             sample_size=sample_size, n_hop=dataset_hop_size)
+        if train_dataset.pad_token_id != tokenizer.pad_token_id:
+            raise ValueError(f'Corpus sampled with a different tokenizer than {tokenizer_file}')
+        tokenized_dataset = {"train": train_dataset}
+    elif args.streaming and os.path.exists(tokenizer_file):
+        tokenizer = PreTrainedTokenizerFast(tokenizer_file=tokenizer_file, max_len=args.context_length,
+                                            eos_token="[EOS]", bos_token="[BOS]",
+                                            pad_token="[PAD]", unk_token="[UNK]",
+                                            mask_token="[MASK]", use_fast=True)
+        path_dataset = PathDataset(dataset_name, dataset_root_dir, task=args.task, sample_size=sample_size,
+                                   n_hop=dataset_hop_size, streaming=True, shuffle_buffer=args.shuffle_buffer)
+        # The length of a streamed dataset is unknown to the trainer, train for a number of steps instead
+        args.max_steps = math.ceil(len(path_dataset) / (args.batch_size * world_size())) * args.num_epochs
+        tokenized_dataset = {"train": path_dataset.tokenize(tokenizer, args.context_length)}
+    elif os.path.exists(tokenizer_file):
         tokenizer = PreTrainedTokenizerFast(tokenizer_file=tokenizer_file, max_len=args.context_length,
                                             eos_token="[EOS]", bos_token="[BOS]",
                                             pad_token="[PAD]", unk_token="[UNK]",
                                             mask_token="[MASK]", use_fast=True)
+        # Keyed on the corpus, tokenizer and context length, only new or changed shards are tokenized
+        cache = TokenizedPathCache(TOKENIZED_CACHE_DIR, tokenizer_file, args.context_length)
+        # With several ranks, rank 0 tokenizes the missing shards and the others read its cache
+        with main_process_first():
+            tokenized_dataset = DatasetDict({
+                "train": cache.load(os.path.join(dataset_root_dir, 'paths_random_walk'),
+                                    f'paths_{args.task}_{sample_size}_{dataset_hop_size}', tokenizer)
+            })
     else:
-        print("Tokenizer not found, run tokenization process before training")
+        raise FileNotFoundError(f"Tokenizer file {tokenizer_file} not found, train it with tokenize_dataset.py first")
+
+    if args.prebatched:
+        if args.streaming or args.packing:
+            raise ValueError('--prebatched cannot be combined with --streaming or --packing')
+        tokenized_dataset = {"train": PreBatchedPathDataset.from_tokenized(tokenized_dataset["train"], args.batch_size,
+                                                                           tokenizer.pad_token_id)}
 
     # Train the model
     if args.load_model:
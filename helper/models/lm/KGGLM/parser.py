@@ -14,9 +14,25 @@ def parser_kgglm_args():
                         help="Number of sampled path in the chosen dataset")
     parser.add_argument("--n_hop", type=int, default=5,
                         help="Number of elements in a predicted sequence (considering only the ids)")
+    parser.add_argument('--binary_corpus', default=False, action='store_true',
+                        help="Train on the int32 token id shards written by the sampler with --tokenizer_file")
+    parser.add_argument('--streaming', default=False, action='store_true',
+                        help="Read and tokenize the path corpus lazily instead of loading it in memory")
+    parser.add_argument("--shuffle_buffer", type=int, default=10000,
+                        help="Paths shuffled together when streaming, the order changes deterministically at every epoch")
+    parser.add_argument('--packing', default=False, action='store_true',
+                        help="Pack several paths in every context window when fine-tuning (finetuneLP, finetuneRec)")
+    parser.add_argument('--prebatched', default=False, action='store_true',
+                        help="Train on batches sliced from one contiguous token id tensor, no per row collation")
 
     parser.add_argument("--logit_processor_type", type=str, default="gcd",
                         help="Path sequence deconding method: default to Graph Constrained Decoding")
+    parser.add_argument('--vectorized_constraints', default=False, action='store_true',
+                        help="Build the decoding constraint masks of all the beams of a step at once on the device,"
+                             " from csr tensors of the kg transitions")
+    parser.add_argument('--native_beam_search', default=False, action='store_true',
+                        help="With --vectorized_constraints, generate the recommendation paths with PathBeamSearch"
+                             " instead of generate, the same paths and top-k")
     # Model arguments
     parser.add_argument("--model", type=str, default="distilgpt2",
                         help="Model to use from HuggingFace pretrained models")
@@ -28,7 +44,28 @@ def parser_kgglm_args():
                         default=64, help="Test batch size")
     parser.add_argument("--context_length", type=int, default=24,
                         help="Context length value when training a tokenizer from scratch")
+    parser.add_argument("--output_head", type=str, default="full",
+                        help="{full, typed}: logits over the whole vocabulary or only over the relations or the"
+                             " entities that can follow each position")
+    parser.add_argument('--split_entity_types', default=False, action='store_true',
+                        help="With the typed output head, only predict the entity types a relation leads to in the kg")
+    parser.add_argument("--training_loss", type=str, default="full",
+                        help="{full, sampled, kg}: softmax over the whole vocabulary, or over the gold token and"
+                             " negatives of its type, sampled uniformly or also among the kg neighbours")
+    parser.add_argument("--n_negatives", type=int, default=256,
+                        help="Uniform negatives of the sampled and kg training losses")
+    parser.add_argument("--n_kg_negatives", type=int, default=32,
+                        help="Kg neighbour negatives per position of the kg training loss")
     parser.add_argument("--load_model", type=bool, default=False, help="")
+    parser.add_argument('--cpu_ddp', default=False, action='store_true',
+                        help="Data parallel training on cpu over the processes of a torchrun launch (gloo),"
+                             " bf16 autocast where the cpu supports it, evaluation on rank 0")
+    parser.add_argument("--dist_timeout", type=int, default=180,
+                        help="Timeout in minutes of the --cpu_ddp collectives, longer than an evaluation on rank 0"
+                             " since the other ranks wait for its metrics")
+    parser.add_argument("--async_eval_workers", type=int, default=0,
+                        help="Evaluate the checkpoints in this many separate processes while training goes on"
+                             " (0 evaluates in the training process)")
     parser.add_argument("--eval_device", type=str, default='cuda:0', help="")
     parser.add_argument("--eval_ckpt_iter", type=int, default='1', help="")
     parser.add_argument("--infer_batch_size", type=int,
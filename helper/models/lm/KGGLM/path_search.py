@@ -0,0 +1,142 @@
+import torch
+import torch.nn.functional as F
+
+
+def select_cache(past_key_values, indices):
+    """Rows indices of a KV cache, a Cache object or the legacy tuple of (key, value) per layer"""
+    if hasattr(past_key_values, 'reorder_cache'):
+        past_key_values.reorder_cache(indices)
+        return past_key_values
+    return tuple(tuple(state.index_select(0, indices.to(state.device)) for state in layer) for layer in past_key_values)
+
+
+class PathBeamSearch:
+    """
+    Beam search of fixed length kg paths, the group (diverse) beam search of generate without its generic bookkeeping.
+    candidates_fn(input_ids) -> (row, token) indices gives the tokens allowed after every row, following the type
+    schedule of the paths (e.g. VectorizedConstrainedLogitsProcessorREC.candidates), only they are scored and ranked.
+    The prompt is encoded for every beam as generate does, or with share_prompt once per input row, the KV cache being
+    expanded to the beams (faster, but the batched matmuls of another size change the scores in the last digits).
+    The KV cache is reordered at every step.
+    Every step scores the candidates with the log softmax over the vocabulary and the hamming diversity penalty of the
+    tokens picked by the previous groups, and keeps the best num_beams // num_beam_groups per group, all rows at once.
+    Returns the num_return_sequences best paths of every input row and their scores (sum of the log probabilities),
+    the sequences and sequences_scores of generate with length_penalty=0. Candidates with the same score are taken
+    by beam and token id, the ties of the topk of generate may be broken otherwise. A group with fewer candidates
+    than beams is filled with pad_token_id paths scored -inf.
+    With output_scores the processed scores of every step are returned too, the scores of generate without their
+    -inf entries: a (rows, tokens, scores) tuple per step of the candidate log probabilities with the diversity
+    penalty, rows indexing the rows * num_beams beams. No vocabulary wide tensor is built.
+    CumulativeSequenceScoreRanker.update_topk_paths ranks the paths with them as update_topk ranks those of generate.
+    """
+    def __init__(self, model, candidates_fn, max_length, num_beams, num_beam_groups=1, diversity_penalty=0.,
+                 num_return_sequences=1, pad_token_id=0, share_prompt=False, output_scores=False):
+        if num_beams % num_beam_groups != 0:
+            raise ValueError(f'num_beams ({num_beams}) must be divisible by num_beam_groups ({num_beam_groups})')
+        if num_return_sequences > num_beams:
+            raise ValueError(f'num_return_sequences ({num_return_sequences}) cannot exceed num_beams ({num_beams})')
+        self.model = model
+        self.candidates_fn = candidates_fn
+        self.max_length = max_length
+        self.num_beams = num_beams
+        self.num_beam_groups = num_beam_groups
+        self.group_size = num_beams // num_beam_groups
+        self.diversity_penalty = diversity_penalty
+        self.num_return_sequences = num_return_sequences
+        self.pad_token_id = pad_token_id
+        self.share_prompt = share_prompt
+        self.output_scores = output_scores
+
+    def forward(self, input_ids, past_key_values, attention_mask):
+        position_ids = torch.arange(attention_mask.shape[1] - input_ids.shape[1], attention_mask.shape[1],
+                                    device=input_ids.device).expand(input_ids.shape)
+        outputs = self.model(input_ids=input_ids, past_key_values=past_key_values, attention_mask=attention_mask,
+                             position_ids=position_ids, use_cache=True, return_dict=True)
+        return outputs.logits[:, -1], outputs.past_key_values
+
+    def select_group(self, group, rows, tokens, scores, vocab_size, n_rows):
+        """Best group_size (score, row, token) of the candidates of every input row in group, by score, beam and token"""
+        device = scores.device
+        batch = rows // self.num_beams
+        flat = (rows % self.num_beams - group * self.group_size) * vocab_size + tokens
+        order = torch.argsort(flat, stable=True)
+        order = order[torch.argsort(scores[order], descending=True, stable=True)]
+        order = order[torch.argsort(batch[order], stable=True)]
+        counts = torch.bincount(batch, minlength=n_rows)
+        ranks = torch.arange(len(order), device=device) - torch.repeat_interleave(counts.cumsum(0) - counts, counts)
+        order = order[ranks < self.group_size]
+        slots = batch[order] * self.group_size + ranks[ranks < self.group_size]
+
+        first_rows = torch.arange(n_rows, device=device).repeat_interleave(self.group_size) * self.num_beams
+        new_scores = torch.full((n_rows * self.group_size,), float('-inf'), dtype=scores.dtype, device=device)
+        new_rows = first_rows + group * self.group_size
+        new_tokens = torch.full((n_rows * self.group_size,), self.pad_token_id, dtype=torch.long, device=device)
+        new_scores[slots], new_rows[slots], new_tokens[slots] = scores[order], rows[order], tokens[order]
+        return new_scores, new_rows, new_tokens
+
+    @torch.no_grad()
+    def __call__(self, input_ids, attention_mask=None):
+        n_rows, device = input_ids.shape[0], input_ids.device
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        beam_rows = torch.arange(n_rows, device=device).repeat_interleave(self.num_beams)
+        if self.share_prompt:
+            logits, past_key_values = self.forward(input_ids, None, attention_mask)
+            logits, past_key_values = logits[beam_rows], select_cache(past_key_values, beam_rows)
+            input_ids, attention_mask = input_ids[beam_rows], attention_mask[beam_rows]
+        else:
+            input_ids, attention_mask = input_ids[beam_rows], attention_mask[beam_rows]
+            logits, past_key_values = self.forward(input_ids, None, attention_mask)
+        # Only the first beam of every group is live at the first step, as in generate
+        beam_scores = torch.full((n_rows, self.num_beams), -1e9, dtype=torch.float, device=device)
+        beam_scores[:, ::self.group_size] = 0
+        beam_scores = beam_scores.view(-1)
+
+        group_of_row = torch.arange(self.num_beams, device=device).repeat(n_rows) // self.group_size
+        step_scores = ()
+        while True:
+            log_probs = F.log_softmax(logits, dim=-1)
+            vocab_size = log_probs.shape[-1]
+            rows, tokens = self.candidates_fn(input_ids)
+            candidate_scores = log_probs[rows, tokens]
+            candidate_groups = group_of_row[rows]
+            next_scores = torch.empty_like(beam_scores)
+            next_rows = torch.empty_like(beam_rows)
+            next_tokens = torch.empty_like(beam_rows)
+            processed_scores = torch.empty_like(candidate_scores)
+            for group in range(self.num_beam_groups):
+                selected = candidate_groups == group
+                scores = candidate_scores[selected]
+                if group > 0 and self.diversity_penalty > 0:
+                    # Hamming diversity: tokens picked by the previous groups of the same input row at this step
+                    previous = next_tokens.view(n_rows, self.num_beams)[:, :group * self.group_size]
+                    frequency = (previous[rows[selected] // self.num_beams] == tokens[selected, None]).sum(-1)
+                    scores = scores - self.diversity_penalty * frequency
+                processed_scores[selected] = scores
+                scores = scores + beam_scores[rows[selected]]
+                group_scores, group_rows, group_tokens = self.select_group(group, rows[selected], tokens[selected],
+                                                                           scores, vocab_size, n_rows)
+                slots = (torch.arange(n_rows, device=device)[:, None] * self.num_beams + group * self.group_size
+                         + torch.arange(self.group_size, device=device)).flatten()
+                next_scores[slots], next_rows[slots], next_tokens[slots] = group_scores, group_rows, group_tokens
+            if self.output_scores:
+                step_scores += ((rows, tokens, processed_scores),)
+
+            beam_scores = next_scores
+            input_ids = torch.cat([input_ids[next_rows], next_tokens[:, None]], dim=-1)
+            attention_mask = torch.cat([attention_mask[next_rows], attention_mask.new_ones((len(next_rows), 1))], dim=-1)
+            if input_ids.shape[1] >= self.max_length:
+                break
+            past_key_values = select_cache(past_key_values, next_rows)
+            logits, past_key_values = self.forward(input_ids[:, -1:], past_key_values, attention_mask)
+
+        # Best beams first, the last beam first among equal scores as the beam hypotheses of generate
+        scores = beam_scores.view(n_rows, self.num_beams)
+        beam_ids = torch.arange(self.num_beams, device=device).expand_as(scores)
+        order = torch.argsort(beam_ids, dim=-1, descending=True)
+        order = order.gather(1, torch.argsort(scores.gather(1, order), dim=-1, descending=True, stable=True))
+        best = order[:, :self.num_return_sequences]
+        sequences = input_ids.view(n_rows, self.num_beams, -1).gather(1, best[..., None].expand(-1, -1, input_ids.shape[1]))
+        if self.output_scores:
+            return sequences.flatten(0, 1), scores.gather(1, best).flatten(), step_scores
+        return sequences.flatten(0, 1), scores.gather(1, best).flatten()
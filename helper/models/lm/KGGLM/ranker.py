@@ -72,9 +72,39 @@ class CumulativeSequenceScoreRanker():
         generate_outputs.scores = normalize_tuple(generate_outputs.scores)
         generate_outputs.sequences_scores = self.sequence_scorer_fnc(
             generate_outputs.scores, generate_outputs.sequences)
+        # Stable: equal (or nan) scores keep the order of the sequences, whatever the other sequences are
         sorted_indices = generate_outputs.sequences_scores.argsort(
-            descending=True)
-        sorted_sequences = generate_outputs.sequences[sorted_indices]
+            descending=True, stable=True)
+        self.add_sorted_sequences(generate_outputs.sequences[sorted_indices])
+
+    def calculate_candidate_sequence_scores(self, candidate_scores, sequences):
+        """
+        calculate_sequence_scores from the (rows, tokens, scores) candidates of every step of PathBeamSearch: the
+        softmax of a row is taken over its candidates (logsumexp), the other tokens have probability 0 and a row
+        without candidates is nan, as the softmax of the -inf scores of generate
+        """
+        n_sequences = len(sequences)
+        sequence_scores = []
+        for i, (rows, tokens, scores) in enumerate(candidate_scores[:self.max_new_tokens]):
+            # Row j of the step scores for sequence j, as the gather of calculate_sequence_scores
+            kept = rows < n_sequences
+            rows, tokens, scores = rows[kept], tokens[kept], scores[kept]
+            row_max = scores.new_full((n_sequences,), float('-inf')).scatter_reduce(0, rows, scores, 'amax')
+            row_sum = scores.new_zeros(n_sequences).index_add(0, rows, torch.exp(scores - row_max[rows]))
+            logsumexp = row_max + torch.log(row_sum)
+            picked = tokens == sequences[rows, i - self.max_new_tokens]
+            probs = scores.new_zeros(n_sequences).index_add(
+                0, rows[picked], torch.exp(scores[picked] - logsumexp[rows[picked]]))
+            probs[row_sum == 0] = float('nan')
+            sequence_scores.append(probs)
+        return torch.stack(sequence_scores, dim=-1).mean(dim=-1)
+
+    def update_topk_paths(self, sequences, candidate_scores):
+        """Top-k of the paths of PathBeamSearch with output_scores, ranked from the candidate scores as update_topk"""
+        sequences_scores = self.calculate_candidate_sequence_scores(candidate_scores, sequences)
+        self.add_sorted_sequences(sequences[sequences_scores.argsort(descending=True, stable=True)])
+
+    def add_sorted_sequences(self, sorted_sequences):
         for sequence in sorted_sequences:
             sequence = self.tokenizer.decode(sequence).split(' ')
             uid_token = sequence[1]
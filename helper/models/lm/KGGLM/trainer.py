@@ -12,8 +12,13 @@ from helper.evaluation.eval_utils import (get_set, save_topks_items_results,
                                           save_topks_paths_results)
 from helper.models.kge.utils import (get_kg_positives_and_tokens_ids_lp,
                                      get_set_lp, metrics_lp)
-from helper.models.lm.KGGLM.decoding_constraints import ConstrainedLogitsProcessorLP, ConstrainedLogitsProcessorREC
+from helper.models.lm.KGGLM.collators import PackedPathCollator, PackingStatsCallback
+from helper.models.lm.KGGLM.decoding_constraints import (ConstrainedLogitsProcessorLP, ConstrainedLogitsProcessorREC,
+                                                          TimedLogitsProcessor, VectorizedConstrainedLogitsProcessorLP,
+                                                          VectorizedConstrainedLogitsProcessorREC)
+from helper.models.lm.KGGLM.distributed import evaluate_on_main_process
 from helper.models.lm.KGGLM.lm_utils import get_user_negatives_and_tokens_ids
+from helper.models.lm.KGGLM.path_search import PathBeamSearch
 from helper.models.lm.KGGLM.ranker import CumulativeSequenceScoreRanker, RankerLP
 from helper.utils import get_dataset_id2eid
 
@@ -39,6 +44,8 @@ class PathPretrainTrainer(Trainer):
         super().__init__(**kwargs)
 
         self.cmd_args = cmd_args
+        # AsyncCheckpointEvaluator, set by the caller to evaluate in separate processes
+        self.async_evaluator = None
         self.model = kwargs['model']
         self.tokenizer = tokenizer
         self.dataset_name = dataset_name
@@ -88,40 +95,55 @@ class PathPretrainTrainer(Trainer):
         print(f'Sequence length rec: {self.SEQUENCE_LEN_REC}, lp: {self.SEQUENCE_LEN_LP}')
 
 
+        processor_rec_cls = (VectorizedConstrainedLogitsProcessorREC if getattr(cmd_args, 'vectorized_constraints', False)
+                             else ConstrainedLogitsProcessorREC)
         self.logits_processor_rec = LogitsProcessorList([
-            ConstrainedLogitsProcessorREC(tokenized_kg=tokenized_kg,
-                                force_token_map=self.user_negatives_token_ids,
-                                tokenizer=tokenizer,
-                                total_length=self.SEQUENCE_LEN_REC,
-                                num_return_sequences=self.N_SEQUENCES_PER_USER,
-                                id_to_uid_token_map=self.token_id_to_uid_token_map,
-                                eos_token_ids=[
-                                    self.tokenizer.convert_tokens_to_ids(self.tokenizer.eos_token)]
-                                )
+            processor_rec_cls(tokenized_kg=tokenized_kg,
+                              force_token_map=self.user_negatives_token_ids,
+                              tokenizer=tokenizer,
+                              total_length=self.SEQUENCE_LEN_REC,
+                              num_return_sequences=self.N_SEQUENCES_PER_USER,
+                              id_to_uid_token_map=self.token_id_to_uid_token_map,
+                              eos_token_ids=[
+                                  self.tokenizer.convert_tokens_to_ids(self.tokenizer.eos_token)]
+                              )
         ])
 
         # Logit Processor Link Prediction
-        self.logits_processor_lp = LogitsProcessorList([
-            ConstrainedLogitsProcessorLP(tokenized_kg=tokenized_kg,
-                                         positive_token_map=self.positive_triplets_token_ids,
-                                         tokenizer=tokenizer,
-                                         total_length=self.SEQUENCE_LEN_LP,
-                                         num_return_sequences=self.N_SEQUENCES_PER_USER,
-                                         eos_token_ids=[
-                                             self.tokenizer.convert_tokens_to_ids(self.tokenizer.eos_token)]
-                                         )
-        ])
+        processor_lp_cls = (VectorizedConstrainedLogitsProcessorLP if getattr(cmd_args, 'vectorized_constraints', False)
+                            else ConstrainedLogitsProcessorLP)
+        self.lp_processor_stats = TimedLogitsProcessor(
+            processor_lp_cls(tokenized_kg=tokenized_kg,
+                             positive_token_map=self.positive_triplets_token_ids,
+                             tokenizer=tokenizer,
+                             total_length=self.SEQUENCE_LEN_LP,
+                             num_return_sequences=self.N_SEQUENCES_PER_USER,
+                             eos_token_ids=[
+                                 self.tokenizer.convert_tokens_to_ids(self.tokenizer.eos_token)]
+                             ))
+        self.logits_processor_lp = LogitsProcessorList([self.lp_processor_stats])
     
     
     def __generate_topks_rec(self, model):
         if isinstance(model, torch.nn.DataParallel):
             model = model.module
         batch_size = self.INFERENCE_BATCH_SIZE
+        path_search = None
+        if getattr(self.cmd_args, 'native_beam_search', False):
+            path_search = PathBeamSearch(model, self.logits_processor_rec[0].candidates, self.SEQUENCE_LEN_REC,
+                                         self.N_BEAMS, num_beam_groups=5, diversity_penalty=0.3,
+                                         num_return_sequences=self.N_RET_SEQ, pad_token_id=self.tokenizer.pad_token_id,
+                                         output_scores=True)
         with tqdm(initial=0, desc="Generating topks", colour="green", total=len(self.user_negatives)) as pbar:
             for i in range(0, len(self.test_dataset_rec), batch_size):
                 batch = self.test_dataset_rec[i:i + batch_size]
                 inputs = self.tokenizer(batch["uid"], return_tensors='pt', add_special_tokens=False, ).to(
                     self.eval_device)
+                if path_search is not None:
+                    sequences, _, scores = path_search(inputs['input_ids'], inputs['attention_mask'])
+                    self.ranker_rec.update_topk_paths(sequences, scores)
+                    pbar.update(batch_size)
+                    continue
 
                 outputs = model.generate(
                     **inputs,
@@ -141,6 +163,9 @@ class PathPretrainTrainer(Trainer):
                 self.ranker_rec.update_topk(outputs)
                 pbar.update(batch_size)
         print("Average topk length:", sum(len(v) for v in self.ranker_rec.topk.values()) / max(len(self.ranker_rec.topk), 1))
+        mask_cache = getattr(self.logits_processor_rec[0], 'mask_cache', None)
+        if mask_cache is not None:
+            print("Mask cache:", mask_cache.summary())
         # print("Percentage of sequence that contain invalid item:", count/len(sorted_sequences))
         topks, topk_sequences = self.ranker_rec.topk, self.ranker_rec.topk_sequences
         save_topks_items_results(self.dataset_name, self.experiment_name + '_zeroshot_rec_'+str(self.n_epochs), topks, self.ranker_rec.K)
@@ -157,23 +182,27 @@ class PathPretrainTrainer(Trainer):
             for i in range(0, len(self.test_set_lp), batch_size):
                 batch = self.test_dataset_lp[i:i + batch_size]
                 inputs = self.tokenizer(batch["eid_rid"], return_tensors='pt', add_special_tokens=False, ).to(self.eval_device)
-                outputs = model.generate(
-                    **inputs,
-                    max_length=self.SEQUENCE_LEN_LP,
-                    min_length=self.SEQUENCE_LEN_LP,
-                    num_return_sequences=self.N_RET_SEQ_LP,
-                    num_beams=self.N_BEAMS_LP,
-                    length_penalty=0.,
-                    num_beam_groups=5,
-                    diversity_penalty=0.3,
-                    do_sample=False,
-                    logits_processor=self.logits_processor_lp,
-                    return_dict_in_generate=True,
-                    output_scores=True,
-                )
+                with self.lp_processor_stats.generation():
+                    outputs = model.generate(
+                        **inputs,
+                        max_length=self.SEQUENCE_LEN_LP,
+                        min_length=self.SEQUENCE_LEN_LP,
+                        num_return_sequences=self.N_RET_SEQ_LP,
+                        num_beams=self.N_BEAMS_LP,
+                        length_penalty=0.,
+                        num_beam_groups=5,
+                        diversity_penalty=0.3,
+                        do_sample=False,
+                        logits_processor=self.logits_processor_lp,
+                        return_dict_in_generate=True,
+                        output_scores=True,
+                    )
                 self.ranker_lp.update_topk(outputs)
                 pbar.update(batch_size)
         print("Average topk length:", sum(len(v) for v in self.ranker_lp.topk.values()) / max(len(self.ranker_lp.topk), 1))
+        print(f"Logits processor: {self.lp_processor_stats.stats['processor_seconds']:.2f}s, "
+              f"{self.lp_processor_stats.processor_share():.1%} of the generation time")
+        self.lp_processor_stats.reset_stats()
         # print("Percentage of sequence that contain invalid item:", count/len(sorted_sequences))
         topks, topk_sequences = self.ranker_lp.topk, self.ranker_lp.topk_sequences
         save_topks_items_results(self.dataset_name, self.experiment_name+ '_zeroshot_lp_'+str(self.n_epochs), topks, self.ranker_rec.K)
@@ -222,8 +251,13 @@ class PathPretrainTrainer(Trainer):
             self.store_flos()
 
         metrics = None
-        if self.control.should_evaluate and self.control.should_save:
-            metrics = self.evaluate(model)
+        if self.async_evaluator is not None:
+            # The checkpoint is evaluated by another process, its metrics are fed back when ready
+            if self.control.should_evaluate and self.control.should_save:
+                self.async_evaluator.submit(self)
+            self.async_evaluator.collect(self)
+        elif self.control.should_evaluate and self.control.should_save:
+            metrics = evaluate_on_main_process(self)
             logs.update(metrics)
             if self.cmd_args.wandb:
                 wandb.log(logs)
@@ -260,6 +294,8 @@ class PathFinetuneLinkPredictionTrainer(Trainer):
         super().__init__(**kwargs)
 
         self.cmd_args = cmd_args
+        # AsyncCheckpointEvaluator, set by the caller to evaluate in separate processes
+        self.async_evaluator = None
         model = kwargs['model']
         self.tokenizer = tokenizer
         self.dataset_name = dataset_name
@@ -275,6 +311,11 @@ class PathFinetuneLinkPredictionTrainer(Trainer):
         self.n_epochs=n_epochs
         self.eval_device = eval_device
 
+        # Short fixed length paths, several of them are packed in every context window
+        if getattr(cmd_args, 'packing', False):
+            self.data_collator = PackedPathCollator(tokenizer, cmd_args.context_length)
+            self.add_callback(PackingStatsCallback(self.data_collator))
+
         # Link Prediction Data
         self.SEQUENCE_LEN_LP = 3 + 1
         self.test_set_lp = get_set_lp(dataset_name,'test')
@@ -291,20 +332,21 @@ class PathFinetuneLinkPredictionTrainer(Trainer):
         self.test_dataset_lp = Dataset.from_dict(self.inference_paths_lp)
         print(f'Sequence length lp: {self.SEQUENCE_LEN_LP}')
 
-        print('Using: ', ConstrainedLogitsProcessorLP)
         logit_proc_kwargs = {}
         # Logit Processor Link Prediction
-        self.logits_processor_lp = LogitsProcessorList([
-            ConstrainedLogitsProcessorLP(tokenized_kg=tokenized_kg,
-                                         positive_token_map=self.positive_triplets_token_ids,
-                                         tokenizer=tokenizer,
-                                         total_length=self.SEQUENCE_LEN_LP,
-                                         num_return_sequences=self.N_SEQUENCES_PER_USER,
-                                         eos_token_ids=[
-                                             self.tokenizer.convert_tokens_to_ids(self.tokenizer.eos_token)],
-                                         **logit_proc_kwargs
-                                         )
-        ])
+        processor_lp_cls = (VectorizedConstrainedLogitsProcessorLP if getattr(cmd_args, 'vectorized_constraints', False)
+                            else ConstrainedLogitsProcessorLP)
+        self.lp_processor_stats = TimedLogitsProcessor(
+            processor_lp_cls(tokenized_kg=tokenized_kg,
+                             positive_token_map=self.positive_triplets_token_ids,
+                             tokenizer=tokenizer,
+                             total_length=self.SEQUENCE_LEN_LP,
+                             num_return_sequences=self.N_SEQUENCES_PER_USER,
+                             eos_token_ids=[
+                                 self.tokenizer.convert_tokens_to_ids(self.tokenizer.eos_token)],
+                             **logit_proc_kwargs
+                             ))
+        self.logits_processor_lp = LogitsProcessorList([self.lp_processor_stats])
 
 
     
@@ -318,24 +360,28 @@ class PathFinetuneLinkPredictionTrainer(Trainer):
                 inputs = self.tokenizer(batch["eid_rid"], return_tensors='pt', add_special_tokens=False, ).to(
                     self.eval_device)
 
-                outputs = model.generate(
-                    **inputs,
-                    max_length=self.SEQUENCE_LEN_LP,
-                    min_length=self.SEQUENCE_LEN_LP,
-                    num_return_sequences=self.N_RET_SEQ,
-                    num_beams=self.N_BEAMS,
-                    length_penalty=0.,
-                    num_beam_groups=5,
-                    diversity_penalty=0.3,
-                    do_sample=False,
-                    # top_p=0.4,
-                    logits_processor=self.logits_processor_lp,
-                    return_dict_in_generate=True,
-                    output_scores=True,
-                )
+                with self.lp_processor_stats.generation():
+                    outputs = model.generate(
+                        **inputs,
+                        max_length=self.SEQUENCE_LEN_LP,
+                        min_length=self.SEQUENCE_LEN_LP,
+                        num_return_sequences=self.N_RET_SEQ,
+                        num_beams=self.N_BEAMS,
+                        length_penalty=0.,
+                        num_beam_groups=5,
+                        diversity_penalty=0.3,
+                        do_sample=False,
+                        # top_p=0.4,
+                        logits_processor=self.logits_processor_lp,
+                        return_dict_in_generate=True,
+                        output_scores=True,
+                    )
                 self.ranker_lp.update_topk(outputs)
                 pbar.update(batch_size)
         print("Average topk length:", sum(len(v) for v in self.ranker_lp.topk.values()) / max(len(self.ranker_lp.topk), 1))
+        print(f"Logits processor: {self.lp_processor_stats.stats['processor_seconds']:.2f}s, "
+              f"{self.lp_processor_stats.processor_share():.1%} of the generation time")
+        self.lp_processor_stats.reset_stats()
         # print("Percentage of sequence that contain invalid item:", count/len(sorted_sequences))
         topks, topk_sequences = self.ranker_lp.topk, self.ranker_lp.topk_sequences
         save_topks_items_results(self.dataset_name, self.experiment_name+ '_lp_'+ str(self.n_epochs), topks, self.ranker_lp.K)
@@ -376,8 +422,13 @@ class PathFinetuneLinkPredictionTrainer(Trainer):
             self.store_flos()
 
         metrics = None
-        if self.control.should_evaluate and self.control.should_save:
-            metrics = self.evaluate(model)
+        if self.async_evaluator is not None:
+            # The checkpoint is evaluated by another process, its metrics are fed back when ready
+            if self.control.should_evaluate and self.control.should_save:
+                self.async_evaluator.submit(self)
+            self.async_evaluator.collect(self)
+        elif self.control.should_evaluate and self.control.should_save:
+            metrics = evaluate_on_main_process(self)
             logs.update(metrics)
             if self.cmd_args.wandb:
                 wandb.log(logs)
@@ -414,6 +465,8 @@ class PathFinetuneExplainableRecTrainer(Trainer):
         super().__init__(**kwargs)
 
         self.cmd_args = cmd_args
+        # AsyncCheckpointEvaluator, set by the caller to evaluate in separate processes
+        self.async_evaluator = None
         model = kwargs['model']
         self.tokenizer = tokenizer
         self.dataset_name = dataset_name
@@ -428,6 +481,11 @@ class PathFinetuneExplainableRecTrainer(Trainer):
         self.n_hop = n_hop
         self.eval_device = eval_device
 
+        # Short fixed length paths, several of them are packed in every context window
+        if getattr(cmd_args, 'packing', False):
+            self.data_collator = PackedPathCollator(tokenizer, cmd_args.context_length)
+            self.add_callback(PackingStatsCallback(self.data_collator))
+
         # Recommendation data
         self.test_set = get_set(dataset_name, set_str='test')
         uids = list(self.test_set.keys())
@@ -446,16 +504,18 @@ class PathFinetuneExplainableRecTrainer(Trainer):
 
 
 
+        processor_rec_cls = (VectorizedConstrainedLogitsProcessorREC if getattr(cmd_args, 'vectorized_constraints', False)
+                             else ConstrainedLogitsProcessorREC)
         self.logits_processor_rec = LogitsProcessorList([
-            ConstrainedLogitsProcessorREC(tokenized_kg=tokenized_kg,
-                                force_token_map=self.user_negatives_token_ids,
-                                tokenizer=tokenizer,
-                                total_length=self.SEQUENCE_LEN_REC,
-                                num_return_sequences=self.N_SEQUENCES_PER_USER,
-                                id_to_uid_token_map=self.token_id_to_uid_token_map,
-                                eos_token_ids=[
-                                    self.tokenizer.convert_tokens_to_ids(self.tokenizer.eos_token)]
-                                )
+            processor_rec_cls(tokenized_kg=tokenized_kg,
+                              force_token_map=self.user_negatives_token_ids,
+                              tokenizer=tokenizer,
+                              total_length=self.SEQUENCE_LEN_REC,
+                              num_return_sequences=self.N_SEQUENCES_PER_USER,
+                              id_to_uid_token_map=self.token_id_to_uid_token_map,
+                              eos_token_ids=[
+                                  self.tokenizer.convert_tokens_to_ids(self.tokenizer.eos_token)]
+                              )
         ])
 
 
@@ -464,11 +524,22 @@ class PathFinetuneExplainableRecTrainer(Trainer):
         if isinstance(model, torch.nn.DataParallel):
             model = model.module
         batch_size = self.INFERENCE_BATCH_SIZE
+        path_search = None
+        if getattr(self.cmd_args, 'native_beam_search', False):
+            path_search = PathBeamSearch(model, self.logits_processor_rec[0].candidates, self.SEQUENCE_LEN_REC,
+                                         self.N_BEAMS, num_beam_groups=5, diversity_penalty=0.3,
+                                         num_return_sequences=self.N_RET_SEQ, pad_token_id=self.tokenizer.pad_token_id,
+                                         output_scores=True)
         with tqdm(initial=0, desc="Generating topks", colour="green", total=len(self.user_negatives)) as pbar:
             for i in range(0, len(self.test_dataset_rec), batch_size):
                 batch = self.test_dataset_rec[i:i + batch_size]
                 inputs = self.tokenizer(batch["uid"], return_tensors='pt', add_special_tokens=False, ).to(
                     self.eval_device)
+                if path_search is not None:
+                    sequences, _, scores = path_search(inputs['input_ids'], inputs['attention_mask'])
+                    self.ranker_rec.update_topk_paths(sequences, scores)
+                    pbar.update(batch_size)
+                    continue
 
                 outputs = model.generate(
                     **inputs,
@@ -488,6 +559,9 @@ class PathFinetuneExplainableRecTrainer(Trainer):
                 self.ranker_rec.update_topk(outputs)
                 pbar.update(batch_size)
         print("Average topk length:", sum(len(v) for v in self.ranker_rec.topk.values()) / max(len(self.ranker_rec.topk), 1))
+        mask_cache = getattr(self.logits_processor_rec[0], 'mask_cache', None)
+        if mask_cache is not None:
+            print("Mask cache:", mask_cache.summary())
         # print("Percentage of sequence that contain invalid item:", count/len(sorted_sequences))
         topks, topk_sequences = self.ranker_rec.topk, self.ranker_rec.topk_sequences
         save_topks_items_results(self.dataset_name, self.experiment_name + '_rec_'+str(self.n_epochs), topks, self.ranker_rec.K)
@@ -529,8 +603,13 @@ class PathFinetuneExplainableRecTrainer(Trainer):
             self.store_flos()
 
         metrics = None
-        if self.control.should_evaluate and self.control.should_save:
-            metrics = self.evaluate(model)
+        if self.async_evaluator is not None:
+            # The checkpoint is evaluated by another process, its metrics are fed back when ready
+            if self.control.should_evaluate and self.control.should_save:
+                self.async_evaluator.submit(self)
+            self.async_evaluator.collect(self)
+        elif self.control.should_evaluate and self.control.should_save:
+            metrics = evaluate_on_main_process(self)
             logs.update(metrics)
             if self.cmd_args.wandb:
                 wandb.log(logs)
@@ -0,0 +1,120 @@
+import torch
+
+
+class TokenSets:
+    """
+    Sets of token ids keyed by the integers in [0, n_keys) as a CSR tensor: the set of key k is
+    indices[indptr[k]:indptr[k + 1]]. mask builds the membership masks of a batch of keys with a gather
+    and a scatter, keys out of range (e.g. -1 for a missing pair) have the empty set.
+    """
+    def __init__(self, sets, n_keys):
+        counts = torch.zeros(n_keys, dtype=torch.long)
+        chunks = []
+        for key in sorted(sets):
+            tokens = sorted(set(sets[key]))
+            counts[key] = len(tokens)
+            chunks.append(torch.tensor(tokens, dtype=torch.long))
+        self.n_keys = n_keys
+        self.indptr = torch.cat([torch.zeros(1, dtype=torch.long), counts.cumsum(0)])
+        self.indices = torch.cat(chunks) if chunks else torch.zeros(0, dtype=torch.long)
+        self._on_device = {self.indptr.device: (self.indptr, self.indices)}
+
+    def tensors(self, device):
+        """indptr and indices on device, copied once"""
+        if device not in self._on_device:
+            self._on_device[device] = (self.indptr.to(device), self.indices.to(device))
+        return self._on_device[device]
+
+    def entries(self, keys):
+        """(row, token) indices of the members of the sets of keys, row indexes keys"""
+        if self.n_keys == 0:
+            empty = torch.zeros(0, dtype=torch.long, device=keys.device)
+            return empty, empty
+        indptr, indices = self.tensors(keys.device)
+        valid = (keys >= 0) & (keys < self.n_keys)
+        keys = keys.clamp(0, self.n_keys - 1)
+        starts = indptr[keys]
+        counts = torch.where(valid, indptr[keys + 1] - starts, 0)
+        rows = torch.repeat_interleave(torch.arange(len(keys), device=keys.device), counts)
+        offsets = torch.arange(len(rows), device=keys.device) - torch.repeat_interleave(counts.cumsum(0) - counts, counts)
+        return rows, indices[starts[rows] + offsets]
+
+    def mask(self, keys, width):
+        """(len(keys), width) bool mask, True at the tokens of the set of every key"""
+        mask = torch.zeros((len(keys), width), dtype=torch.bool, device=keys.device)
+        mask[self.entries(keys)] = True
+        return mask
+
+
+class PaddedTokenSets:
+    """
+    Sets of token ids keyed by the integers in [0, n_keys) as a (n_keys + 1, longest set) tensor padded with
+    pad_token_id, the last row is the set of the keys out of range. Every set gets the shared_tokens too.
+    ids is a single gather, the caller scatters them directly into the scores: pad_token_id must be a token
+    handled like the members of every set, e.g. one of the shared tokens.
+    Faster than the CSR layout of TokenSets while the sets have similar sizes, it takes n_keys * longest set ids.
+    """
+    def __init__(self, sets, n_keys, pad_token_id, shared_tokens=()):
+        shared_tokens = set(shared_tokens)
+        longest = self.longest(sets, shared_tokens)
+        self.n_keys = n_keys
+        self.padded = torch.full((n_keys + 1, longest), pad_token_id, dtype=torch.int32)
+        self.padded[n_keys, :len(shared_tokens)] = torch.tensor(sorted(shared_tokens), dtype=torch.int32)
+        for key, tokens in sets.items():
+            tokens = sorted(set(tokens) | shared_tokens)
+            self.padded[key, :len(tokens)] = torch.tensor(tokens, dtype=torch.int32)
+        self._on_device = {self.padded.device: self.padded.long()}
+
+    @staticmethod
+    def longest(sets, shared_tokens=()):
+        shared_tokens = set(shared_tokens)
+        return max([len(set(tokens) | shared_tokens) for tokens in sets.values()] + [len(shared_tokens), 1])
+
+    def ids(self, keys):
+        """(len(keys), longest set) token ids of the set of every key, padded with pad_token_id"""
+        if keys.device not in self._on_device:
+            self._on_device[keys.device] = self.padded.to(keys.device).long()
+        keys = torch.where((keys >= 0) & (keys < self.n_keys), keys, self.n_keys)
+        return self._on_device[keys.device][keys]
+
+
+class TokenPairIndex:
+    """Numbers (head, relation) token pairs through a dense (vocab, relations) table, -1 for the pairs not in it"""
+    def __init__(self, pairs, vocab_size):
+        pairs = list(pairs)
+        relations = sorted({rel for _, rel in pairs})
+        self.rel_index = torch.full((vocab_size,), -1, dtype=torch.long)
+        self.rel_index[relations] = torch.arange(len(relations))
+        self.pair_index = torch.full((vocab_size, max(len(relations), 1)), -1, dtype=torch.long)
+        for key, (head, rel) in enumerate(pairs):
+            self.pair_index[head, self.rel_index[rel]] = key
+        self._on_device = {self.rel_index.device: (self.rel_index, self.pair_index)}
+
+    def keys(self, heads, rels):
+        if heads.device not in self._on_device:
+            self._on_device[heads.device] = (self.rel_index.to(heads.device), self.pair_index.to(heads.device))
+        rel_index, pair_index = self._on_device[heads.device]
+        n_tokens = len(rel_index)
+        valid = (heads >= 0) & (heads < n_tokens) & (rels >= 0) & (rels < n_tokens)
+        local_rels = rel_index[rels.clamp(0, n_tokens - 1)]
+        keys = pair_index[heads.clamp(0, n_tokens - 1), local_rels.clamp(min=0)]
+        return torch.where(valid & (local_rels >= 0), keys, -1)
+
+
+class KGTransitionTable:
+    """
+    Token transitions of a tokenized kg ({head token: {relation token: tail tokens}}) split by hop position:
+    the relations leaving every entity token (even positions of a path) and the tails of every
+    (entity, relation) pair (odd positions).
+    """
+    def __init__(self, tokenized_kg, vocab_size):
+        pairs = [(head, rel) for head, rels in tokenized_kg.items() for rel in rels]
+        self.pairs = TokenPairIndex(pairs, vocab_size)
+        self.relations = TokenSets({head: rels.keys() for head, rels in tokenized_kg.items()}, vocab_size)
+        self.tails = TokenSets({key: tokenized_kg[head][rel] for key, (head, rel) in enumerate(pairs)}, len(pairs))
+
+    def relations_mask(self, heads, width):
+        return self.relations.mask(heads, width)
+
+    def tails_mask(self, heads, rels, width):
+        return self.tails.mask(self.pairs.keys(heads, rels), width)
@@ -5,7 +5,7 @@ from datetime import datetime
 
 import torch
 import wandb
-from datasets import load_from_disk
+from datasets import DatasetDict
 from transformers import (AutoConfig, AutoModelForCausalLM,
                           DataCollatorForLanguageModeling,
                           EarlyStoppingCallback, PreTrainedTokenizerFast,
@@ -21,6 +21,7 @@ from helper.models.lm.PLM.lm_utils import (EmbeddingMapper,
 from helper.models.lm.PLM.parser import parser_plm_args
 from helper.models.lm.PLM.plmrec import PLMRec
 from helper.models.lm.PLM.trainer import PathCLMTrainer
+from helper.models.lm.tokenized_cache import TokenizedPathCache
 from helper.sampling.samplers.sampler import KGsampler
 from helper.utils import SEED, check_dir, get_weight_dir
 
@@ -187,18 +188,21 @@ if __name__ == "__main__":
     kg = KGsampler(args.dataset)
     sample_size = args.sample_size
     dataset_hop_size = args.n_hop
-    TOKENIZED_DATASET_PATH = os.path.join(args.data_dir, f"{dataset_name}/{TOKENIZER_TYPE}/{args.task}_{sample_size}_{dataset_hop_size}_tokenized_dataset.hf")
+    TOKENIZED_CACHE_DIR = os.path.join(args.data_dir, dataset_name, TOKENIZER_TYPE, 'tokenized_cache')
     TOKEN_INDEX_PATH = os.path.join(dirpath, KGsampler.TOKEN_INDEX_FILE)
-    # Try to load the dataset from disk if it has been already tokenized otherwise load it from scratch
-    if os.path.exists(TOKENIZED_DATASET_PATH) and os.path.exists(tokenizer_file):
-        task = args.task
-        tokenized_dataset = load_from_disk(TOKENIZED_DATASET_PATH)
+    if os.path.exists(tokenizer_file):
         tokenizer = PreTrainedTokenizerFast(tokenizer_file=tokenizer_file, max_len=args.context_length,
                                             eos_token="[EOS]", bos_token="[BOS]",
                                             pad_token="[PAD]", unk_token="[UNK]",
                                             mask_token="[MASK]", use_fast=True)
+        # Keyed on the corpus, tokenizer and context length, only new or changed shards are tokenized
+        cache = TokenizedPathCache(TOKENIZED_CACHE_DIR, tokenizer_file, args.context_length)
+        tokenized_dataset = DatasetDict({
+            "train": cache.load(os.path.join(dataset_dir, 'paths_random_walk'),
+                                f'paths_{args.task}_{sample_size}_{dataset_hop_size}', tokenizer)
+        })
     else:
-        print("Tokenizer not found, run tokenization process before training")
+        raise FileNotFoundError(f"Tokenizer file {tokenizer_file} not found, train it with tokenize_dataset.py first")
 
     # Train the model
     if args.load_model:
@@ -1,19 +1,13 @@
 import argparse
 import os
 
-from datasets import DatasetDict
 from transformers import PreTrainedTokenizerFast, set_seed
 
-from helper.models.lm.path_dataset import PathDataset
+from helper.models.lm.tokenized_cache import TokenizedPathCache
 from helper.sampling.samplers.sampler import KGsampler
-from helper.utils import SEED, check_dir, get_data_dir, get_root_data_dir
+from helper.utils import SEED, get_data_dir, get_root_data_dir
 from tokenizers import Tokenizer, models, pre_tokenizers, processors, trainers
 
-# Read an example and return the tokenized version
-
-def tokenize_function(examples: str, context_length: int = 200):
-    return tokenizer(examples["path"], truncation=True, padding=True, max_length=context_length)
-
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     # Data arguments
@@ -27,9 +21,7 @@ if __name__ == "__main__":
     parser.add_argument("--n_hop", type=int, default=5,
                         help="Number of elements in a predicted sequence (considering only the ids)")
     parser.add_argument("--context_length", type=int, default=24,
-                        help="Context length value when training a tokenizer from scratch")
-    parser.add_argument("--nproc", type=int, default=8,
-                        help="Number of processes for dataset mapping")
+                        help="Context length of the tokenized paths, the --context_length of main.py")
 
     args = parser.parse_args()
 
@@ -49,20 +41,8 @@ if __name__ == "__main__":
     kg = KGsampler(args.dataset)
     sample_size = args.sample_size
     dataset_hop_size = args.n_hop
-    TOKENIZED_DATASET_PATH = os.path.join(
-        dataset_root_dir, f"{TOKENIZER_TYPE}/{args.task}_{sample_size}_{dataset_hop_size}_tokenized_dataset.hf")
+    TOKENIZED_CACHE_DIR = os.path.join(dataset_root_dir, TOKENIZER_TYPE, 'tokenized_cache')
     TOKEN_INDEX_PATH = os.path.join(dirpath, KGsampler.TOKEN_INDEX_FILE)
-    # Try to load the dataset from disk if it has been already tokenized otherwise load it from scratch
-    plain_text_path = True
-
-    print("Loading and processing path sequences...")
-    dataset = PathDataset(dataset_name, dataset_root_dir, task=args.task, sample_size=sample_size, n_hop=dataset_hop_size,
-                          plain_text_path=plain_text_path)
-
-    dataset.show_random_examples()
-    dataset = dataset.dataset
-    print(type(dataset))
-
     # Word level tokenizer
     if args.train_tokenizer:
         print("Training tokenizer...")
@@ -98,16 +78,9 @@ if __name__ == "__main__":
                                         pad_token="[PAD]", unk_token="[UNK]",
                                         mask_token="[MASK]", use_fast=True)
 
+    # Fills the cache main.py loads the train split from, only the new or changed corpus shards are tokenized
     print("Tokenizing dataset...")
-    tokenized_dataset = dataset.map(tokenize_function,
-                                    batched=True,
-                                    num_proc=args.nproc,
-                                    remove_columns=["path"]
-                                    )
-    tokenized_dataset = DatasetDict({
-        "train": tokenized_dataset,
-    })
-    # Create a dir if does not exist for the hf dataset and save the tokenized dataset to disk
-    check_dir(TOKENIZED_DATASET_PATH)
-    tokenized_dataset.save_to_disk(
-        TOKENIZED_DATASET_PATH)
+    cache = TokenizedPathCache(TOKENIZED_CACHE_DIR, tokenizer_file, args.context_length)
+    tokenized_dataset = cache.load(os.path.join(dataset_root_dir, 'paths_random_walk'),
+                                   f'paths_{args.task}_{sample_size}_{dataset_hop_size}', tokenizer)
+    print(f"{len(tokenized_dataset)} tokenized paths in {TOKENIZED_CACHE_DIR}")
@@ -1,13 +1,25 @@
 from os.path import join
 
+import numpy as np
 import pandas as pd
-from datasets import Dataset
+import pyarrow as pa
+import pyarrow.compute as pc
+import torch
+from datasets import Dataset, Features, IterableDataset, Value
 
-from helper.utils import get_eid_to_name_map, get_rid_to_name_map
+from helper.models.lm.path_tokenizer import WordLevelIdMapper, tokenize_paths
+from helper.sampling.samplers.path_writer import corpus_files, iter_paths, load_token_shards, read_manifest
+from helper.utils import SEED, get_eid_to_name_map, get_rid_to_name_map
 
 
 class PathDataset:
-    def __init__(self, dataset_name: str, base_data_dir: str = "", task: str = None, sample_size: str = None, n_hop: str = None, plain_text_path=False):
+    """
+    Sampled paths as a HF dataset with a path column. With streaming=True the corpus shards are read
+    lazily, line by line, as an IterableDataset with bounded memory; shuffle_buffer > 0 shuffles the
+    shard order and a buffer of paths, differently but reproducibly at every epoch (see set_epoch).
+    """
+    def __init__(self, dataset_name: str, base_data_dir: str = "", task: str = None, sample_size: str = None, n_hop: str = None, plain_text_path=False,
+                 streaming=False, shuffle_buffer=0, seed=SEED):
         self.dataset_name = dataset_name
         self.base_data_dir = base_data_dir
         self.data_dir = join(self.base_data_dir, "paths_random_walk")
@@ -16,19 +28,141 @@ class PathDataset:
         self.n_hop = n_hop
         # Currently not used, experimental parameter
         self.plain_text_path = plain_text_path
-        self.read_single_csv_to_hf_dataset()
-        # Get eid2name and rid2name
-        self.eid2name = get_eid_to_name_map(self.dataset_name)
-        self.rid2name = get_rid_to_name_map(self.dataset_name)
+        self.streaming = streaming
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.corpus_name = f'paths_{self.task}_{self.sample_size}_{self.n_hop}'
+        if streaming:
+            self.read_streaming_hf_dataset()
+        else:
+            self.read_single_csv_to_hf_dataset()
+        self._eid2name = None
+        self._rid2name = None
 
-    def read_csv_as_dataframe(self, filename: str) -> pd.DataFrame:
-        return pd.read_csv(join(self.data_dir, filename), header=None, names=["path"], index_col=None)
+    @property
+    def eid2name(self):
+        if self._eid2name is None:
+            self._eid2name = get_eid_to_name_map(self.dataset_name)
+        return self._eid2name
 
-    def read_single_csv_to_hf_dataset(self) -> None:
-        filename = f'paths_{self.task}_{self.sample_size}_{self.n_hop}.txt'
+    @property
+    def rid2name(self):
+        if self._rid2name is None:
+            self._rid2name = get_rid_to_name_map(self.dataset_name)
+        return self._rid2name
+
+    def read_csv_as_dataframe(self, filepath: str) -> pd.DataFrame:
+        return pd.read_csv(filepath, header=None, names=["path"], index_col=None)
 
-        df = self.read_csv_as_dataframe(filename)
+    def read_single_csv_to_hf_dataset(self) -> None:
+        # Either a single paths_*.txt file or the (possibly compressed) shards listed in its manifest
+        df = pd.concat([self.read_csv_as_dataframe(filepath) for filepath in corpus_files(self.data_dir, self.corpus_name)],
+                       ignore_index=True)
         self.dataset = Dataset.from_pandas(df)
 
+    def read_streaming_hf_dataset(self) -> None:
+        # One generator shard per corpus file, the shard order is shuffled with the buffer
+        dataset = IterableDataset.from_generator(_generate_paths, features=Features({"path": Value("string")}),
+                                                 gen_kwargs={"filepaths": corpus_files(self.data_dir, self.corpus_name)})
+        if self.shuffle_buffer > 0:
+            dataset = dataset.shuffle(seed=self.seed, buffer_size=self.shuffle_buffer)
+        self.dataset = dataset
+
+    def __len__(self) -> int:
+        if not self.streaming:
+            return len(self.dataset)
+        manifest = read_manifest(self.data_dir, self.corpus_name)
+        if manifest is not None:
+            return manifest['n_paths']
+        return sum(1 for _ in iter_paths(corpus_files(self.data_dir, self.corpus_name)))
+
+    def set_epoch(self, epoch: int) -> None:
+        """The shuffled order of a streaming dataset depends on (seed, epoch) only"""
+        self.dataset.set_epoch(epoch)
+
+    def tokenize(self, tokenizer, context_length: int):
+        """
+        Dataset of the input_ids and attention_mask of the paths, tokenized on the fly when streaming,
+        with the same ids of the tokenizer (a PreTrainedTokenizerFast over the WordLevel model)
+        """
+        mapper = WordLevelIdMapper(tokenizer.backend_tokenizer.get_vocab(), unk_token=tokenizer.unk_token)
+
+        def tokenize_batch(examples):
+            return tokenize_paths(pa.array(examples["path"], type=pa.string()), mapper,
+                                  tokenizer.bos_token_id, tokenizer.eos_token_id, tokenizer.pad_token_id,
+                                  max_length=context_length, batch_size=len(examples["path"])).to_pydict()
+
+        return self.dataset.map(tokenize_batch, batched=True, remove_columns=["path"])
+
     def show_random_examples(self) -> None:
-        print(self.dataset["path"][:10])
+        if self.streaming:
+            print([example["path"] for example in self.dataset.take(10)])
+        else:
+            print(self.dataset["path"][:10])
+
+
+def _generate_paths(filepaths):
+    for path in iter_paths(filepaths):
+        yield {"path": path}
+
+
+class TokenizedPathDataset(torch.utils.data.Dataset):
+    """
+    Pre-tokenized paths written by the sampler with a tokenizer file, the int32 token id shards
+    are memory mapped and rows are served as they are, no text parsing nor tokenization.
+    """
+    def __init__(self, dataset_name: str, base_data_dir: str = "", task: str = None, sample_size: str = None, n_hop: str = None):
+        self.dataset_name = dataset_name
+        self.data_dir = join(base_data_dir, "paths_random_walk")
+        self.shards, self.manifest = load_token_shards(self.data_dir, f'paths_{task}_{sample_size}_{n_hop}')
+        self.pad_token_id = self.manifest['pad_token_id']
+        self.offsets = np.cumsum([0] + [len(shard) for shard in self.shards])
+
+    def __len__(self) -> int:
+        return int(self.offsets[-1])
+
+    def __getitem__(self, idx: int):
+        if idx < 0:
+            idx += len(self)
+        shard_id = int(np.searchsorted(self.offsets, idx, side='right')) - 1
+        input_ids = self.shards[shard_id][idx - self.offsets[shard_id]].tolist()
+        return {"input_ids": input_ids, "attention_mask": [int(token_id != self.pad_token_id) for token_id in input_ids]}
+
+
+class PreBatchedPathDataset(torch.utils.data.Dataset):
+    """
+    Tokenized paths held in one contiguous (n_paths, width) int32 tensor, every item is a whole batch of
+    batch_size rows served as a view of it. To be used with a DataLoader (or Trainer) batch size of 1 and
+    FixedShapePathCollator. Rows are shuffled once, reproducibly, when the tensor is built, the sampler
+    shuffles the order of the batches at every epoch.
+    """
+    def __init__(self, token_ids: np.ndarray, batch_size: int, pad_token_id: int, shuffle: bool = True, seed=SEED):
+        if shuffle:
+            token_ids = token_ids[np.random.default_rng(seed).permutation(len(token_ids))]
+        self.token_ids = torch.from_numpy(np.require(token_ids, dtype=np.int32, requirements=['C', 'W']))
+        self.batch_size = batch_size
+        self.pad_token_id = pad_token_id
+
+    @classmethod
+    def from_tokenized(cls, dataset, batch_size: int, pad_token_id: int, **kwargs):
+        """From a TokenizedPathDataset or a HF dataset with an input_ids column, rows padded to the longest one"""
+        if isinstance(dataset, TokenizedPathDataset):
+            return cls(np.concatenate(dataset.shards), batch_size, pad_token_id, **kwargs)
+        input_ids = dataset.with_format('arrow')[:]['input_ids'].combine_chunks()
+        lengths = pc.list_value_length(input_ids).to_numpy(zero_copy_only=False)
+        values = input_ids.flatten().to_numpy(zero_copy_only=False)
+        width = int(lengths.max()) if len(lengths) else 0
+        if (lengths == width).all():
+            token_ids = values.reshape(len(lengths), width)
+        else:
+            token_ids = np.full((len(lengths), width), pad_token_id, dtype=np.int32)
+            token_ids[np.arange(width) < lengths[:, None]] = values
+        return cls(token_ids, batch_size, pad_token_id, **kwargs)
+
+    def __len__(self) -> int:
+        return -(-len(self.token_ids) // self.batch_size)
+
+    def __getitem__(self, idx: int) -> torch.Tensor:
+        if idx < 0:
+            idx += len(self)
+        return self.token_ids[idx * self.batch_size:(idx + 1) * self.batch_size]
@@ -0,0 +1,141 @@
+import json
+import os
+import re
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+from datasets import Dataset
+
+# Type letter followed by an integer written as str(int) would, e.g. U12, R-1, E0 (not U012)
+ID_TOKEN_PATTERN = r'^[A-Za-z](0|-?[1-9][0-9]{0,17})$'
+# Letters whose ids are this sparse are mapped through the dictionary instead of a dense array
+MAX_SPARSITY = 16
+
+
+class WordLevelIdMapper:
+    """
+    Maps tokens to the ids of a WordLevel vocabulary with vectorized arrow/numpy ops.
+    Tokens made of a type letter and an integer id are looked up in a dense array per letter,
+    the other ones (special tokens, non canonical ids) through the vocabulary dictionary.
+    Tokens missing from the vocabulary map to the unk id, as in the WordLevel model.
+    """
+    def __init__(self, vocab, unk_token='[UNK]'):
+        self.vocab = vocab
+        self.unk_token_id = vocab[unk_token]
+        by_letter = dict()
+        for token, token_id in vocab.items():
+            if re.match(ID_TOKEN_PATTERN, token):
+                by_letter.setdefault(ord(token[0]), []).append((int(token[1:]), token_id))
+        # Dense table of letter l spans ids base[l]:base[l]+size[l] of self.table, shifted by lo[l]
+        self.base = np.full(256, -1, dtype=np.int64)
+        self.lo = np.zeros(256, dtype=np.int64)
+        self.size = np.zeros(256, dtype=np.int64)
+        tables = []
+        offset = 0
+        for letter, pairs in sorted(by_letter.items()):
+            ids = np.array([i for i, _ in pairs], dtype=np.int64)
+            lo, hi = ids.min(), ids.max()
+            if hi - lo + 1 > MAX_SPARSITY * len(ids) + 1024:
+                continue
+            table = np.full(hi - lo + 1, self.unk_token_id, dtype=np.int32)
+            table[ids - lo] = [token_id for _, token_id in pairs]
+            self.base[letter], self.lo[letter], self.size[letter] = offset, lo, len(table)
+            tables.append(table)
+            offset += len(table)
+        self.table = np.concatenate(tables) if tables else np.zeros(0, dtype=np.int32)
+
+    @classmethod
+    def from_tokenizer_file(cls, tokenizer_file):
+        with open(tokenizer_file) as f:
+            model = json.load(f)['model']
+        return cls(model['vocab'], unk_token=model['unk_token'])
+
+    def token_ids(self, tokens):
+        """int32 ids of a pyarrow string array of tokens"""
+        tokens = pc.cast(tokens, pa.string())
+        ids = np.full(len(tokens), self.unk_token_id, dtype=np.int32)
+        if len(tokens) == 0:
+            return ids
+        offsets = np.frombuffer(tokens.buffers()[1], dtype=np.int32)[tokens.offset:tokens.offset + len(tokens) + 1]
+        data = np.frombuffer(tokens.buffers()[2], dtype=np.uint8)
+        letters = data[np.minimum(offsets[:-1], len(data) - 1)]
+        dense = pc.match_substring_regex(tokens, ID_TOKEN_PATTERN).to_numpy(zero_copy_only=False)
+        dense &= self.base[letters] >= 0
+        sel = np.flatnonzero(dense)
+        if len(sel):
+            values = pc.cast(pc.utf8_slice_codeunits(tokens.take(pa.array(sel)), 1), pa.int64()).to_numpy()
+            letters = letters[sel]
+            pos = values - self.lo[letters]
+            inside = (pos >= 0) & (pos < self.size[letters])
+            ids[sel[inside]] = self.table[self.base[letters[inside]] + pos[inside]]
+        rest = np.flatnonzero(~dense)
+        if len(rest):
+            encoded = pc.dictionary_encode(tokens.take(pa.array(rest)))
+            lookup = np.array([self.vocab.get(token, self.unk_token_id) for token in encoded.dictionary.to_pylist()],
+                              dtype=np.int32)
+            ids[rest] = lookup[encoded.indices.to_numpy()]
+        return ids
+
+
+def tokenize_paths(paths, mapper, bos_token_id, eos_token_id, pad_token_id, max_length=200, batch_size=1000):
+    """
+    Tokenize a pyarrow string array of whitespace separated paths into an arrow table with the input_ids and
+    attention_mask list columns of the HF tokenizer with the [BOS] $A [EOS] template, truncation=True,
+    max_length and padding=True (to the longest path) over consecutive batches of batch_size paths,
+    as Dataset.map(batched=True, batch_size=batch_size) does with a single process.
+    """
+    tokens = pc.utf8_split_whitespace(pc.cast(paths, pa.string()))
+    n_paths = len(paths)
+    split_offsets = tokens.offsets.to_numpy().astype(np.int64)
+    tokens = tokens.flatten()
+    # Leading and trailing whitespace leave empty tokens, the WhitespaceSplit pre-tokenizer drops them
+    nonempty = pc.greater(pc.binary_length(tokens), 0).to_numpy(zero_copy_only=False)
+    split_row = np.repeat(np.arange(n_paths), np.diff(split_offsets))
+    tokens = tokens.filter(pa.array(nonempty))
+    in_offsets = np.zeros(n_paths + 1, dtype=np.int64)
+    np.cumsum(np.bincount(split_row[nonempty], minlength=n_paths), out=in_offsets[1:])
+    ids = mapper.token_ids(tokens)
+    n_tokens = np.minimum(np.diff(in_offsets), max_length - 2)
+
+    # Every path is padded to the longest path of its batch
+    batch = np.arange(n_paths) // batch_size
+    widths = (np.maximum.reduceat(n_tokens, np.arange(0, n_paths, batch_size)) + 2)[batch] if n_paths else n_tokens
+    out_offsets = np.zeros(n_paths + 1, dtype=np.int64)
+    np.cumsum(widths, out=out_offsets[1:])
+    out_starts = out_offsets[:-1]
+    values = np.full(out_offsets[-1], pad_token_id, dtype=np.int32)
+    values[out_starts] = bos_token_id
+    values[out_starts + 1 + n_tokens] = eos_token_id
+    # Position of every input token in its path, the ones past max_length - 2 are truncated
+    row = np.repeat(np.arange(n_paths), np.diff(in_offsets))
+    col = np.arange(len(ids)) - in_offsets[row]
+    kept = col < n_tokens[row]
+    values[out_starts[row[kept]] + 1 + col[kept]] = ids[kept]
+    attention_mask = ((np.arange(out_offsets[-1]) - np.repeat(out_starts, widths)) <
+                      np.repeat(n_tokens + 2, widths)).astype(np.int8)
+
+    offsets = pa.array(out_offsets, type=pa.int32())
+    return pa.table(dict(input_ids=pa.ListArray.from_arrays(offsets, pa.array(values)),
+                         attention_mask=pa.ListArray.from_arrays(offsets, pa.array(attention_mask))))
+
+
+def fast_tokenize_dataset(dataset, tokenizer, cache_file, max_length=200, batch_size=1000, chunk_batches=1000):
+    """
+    Tokenize the path column of a HF dataset with tokenize_paths, chunk_batches batches at a time, into the
+    arrow file cache_file. Returns the memory mapped dataset, with the ids of tokenizer (a
+    PreTrainedTokenizerFast over the WordLevel model) and the columns and types of its Dataset.map output.
+    """
+    mapper = WordLevelIdMapper(tokenizer.backend_tokenizer.get_vocab(), unk_token=tokenizer.unk_token)
+    special_ids = dict(bos_token_id=tokenizer.bos_token_id, eos_token_id=tokenizer.eos_token_id,
+                       pad_token_id=tokenizer.pad_token_id)
+    chunk_size = batch_size * chunk_batches
+    paths = dataset.with_format('arrow')
+    os.makedirs(os.path.dirname(cache_file) or '.', exist_ok=True)
+    schema = pa.schema([('input_ids', pa.list_(pa.int32())), ('attention_mask', pa.list_(pa.int8()))])
+    with pa.OSFile(cache_file, 'wb') as sink, pa.ipc.new_stream(sink, schema) as writer:
+        for start in range(0, len(dataset), chunk_size):
+            chunk = paths[start:start + chunk_size]['path'].combine_chunks()
+            writer.write_table(tokenize_paths(chunk, mapper, max_length=max_length, batch_size=batch_size,
+                                              **special_ids))
+    return Dataset.from_file(cache_file)
@@ -0,0 +1,92 @@
+import hashlib
+import json
+import os
+
+import pandas as pd
+from datasets import Dataset, concatenate_datasets
+
+from helper.models.lm.path_tokenizer import fast_tokenize_dataset
+from helper.sampling.samplers.kg_cache import file_digest
+from helper.sampling.samplers.path_writer import corpus_files
+
+# Bump when the tokenization changes, older entries are then rebuilt
+CACHE_VERSION = 1
+
+
+class TokenizedPathCache:
+    """
+    Content addressed cache of tokenized path corpora. Every corpus shard is tokenized into its own
+    arrow file, named after the digest of the shard contents and a key of the tokenizer file contents
+    and of the context length, so a resampled corpus only tokenizes the shards that changed and a new
+    tokenizer or context length never reuses stale ids. Shard digests are only recomputed when the size
+    or mtime of a shard changes.
+    """
+    def __init__(self, cache_dir, tokenizer_file, context_length):
+        self.cache_dir = cache_dir
+        self.tokenizer_file = tokenizer_file
+        self.context_length = context_length
+
+    def tokenizer_key(self):
+        h = hashlib.blake2b(digest_size=8)
+        h.update(f'{CACHE_VERSION}-{self.context_length}-{file_digest(self.tokenizer_file)}'.encode())
+        return h.hexdigest()
+
+    def index_path(self, corpus_name):
+        return os.path.join(self.cache_dir, f'{corpus_name}.index.json')
+
+    def _read_index(self, corpus_name):
+        if not os.path.exists(self.index_path(corpus_name)):
+            return dict(shards=dict(), files=[])
+        with open(self.index_path(corpus_name)) as f:
+            return json.load(f)
+
+    def shard_digest(self, filepath, index):
+        """(stat, digest) of a corpus shard, reusing the digest in the index if the file did not change"""
+        st = os.stat(filepath)
+        stat = [st.st_size, st.st_mtime_ns]
+        cached = index['shards'].get(os.path.basename(filepath))
+        if cached is not None and cached['stat'] == stat:
+            return stat, cached['digest']
+        return stat, file_digest(filepath)
+
+    def referenced_files(self, exclude):
+        """Cache files used by the indexes of the other corpora"""
+        files = set()
+        for filename in os.listdir(self.cache_dir):
+            if filename.endswith('.index.json') and filename != os.path.basename(exclude):
+                with open(os.path.join(self.cache_dir, filename)) as f:
+                    files.update(json.load(f)['files'])
+        return files
+
+    def load(self, corpus_dir, corpus_name, tokenizer):
+        """
+        Tokenized dataset of the corpus, with the input_ids and attention_mask columns of
+        tokenize_dataset.py, tokenizing only the shards that are not cached yet
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        index = self._read_index(corpus_name)
+        key = self.tokenizer_key()
+        shards, files, datasets = dict(), [], []
+        for filepath in corpus_files(corpus_dir, corpus_name):
+            stat, digest = self.shard_digest(filepath, index)
+            shards[os.path.basename(filepath)] = dict(stat=stat, digest=digest)
+            cache_file = os.path.join(self.cache_dir, f'{digest}-{key}.arrow')
+            if not os.path.exists(cache_file):
+                print(f'Tokenizing {os.path.basename(filepath)}...')
+                paths = Dataset.from_pandas(pd.read_csv(filepath, header=None, names=["path"], index_col=None))
+                tmp_file = cache_file + '.tmp'
+                fast_tokenize_dataset(paths, tokenizer, tmp_file, max_length=self.context_length)
+                os.replace(tmp_file, cache_file)
+            files.append(os.path.basename(cache_file))
+            datasets.append(Dataset.from_file(cache_file))
+
+        # Files of the previous version of the corpus that are not used anymore
+        for filename in set(index['files']) - set(files) - self.referenced_files(self.index_path(corpus_name)):
+            if os.path.exists(os.path.join(self.cache_dir, filename)):
+                os.remove(os.path.join(self.cache_dir, filename))
+        # Written atomically, other processes may be reading it
+        tmp_path = f'{self.index_path(corpus_name)}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(dict(shards=shards, files=files), f, indent=2)
+        os.replace(tmp_path, self.index_path(corpus_name))
+        return concatenate_datasets(datasets)
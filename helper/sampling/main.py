@@ -1,10 +1,17 @@
+import json
 import os
 
 from transformers import set_seed
 
 from helper.sampling.parser import parse_sampler_args
+from helper.sampling.prune_dataset import prune_corpus
+from helper.sampling.samplers.path_encoder import (PathTokenEncoder,
+                                                   train_wordlevel_tokenizer)
+from helper.sampling.samplers.path_writer import (PathCorpusWriter,
+                                                  corpus_complete)
 from helper.sampling.samplers.sampler import KGsampler
 from helper.sampling.samplers.samplerLP import KGSamplerLinkPrediction
+from helper.sampling.samplers.telemetry import SamplingTelemetry
 from helper.utils import SEED, get_data_dir, get_dataset_info_dir
 
 if __name__ == '__main__':
@@ -31,21 +38,73 @@ if __name__ == '__main__':
     # Sample paths according to the task
     if args.task=='rec':
         kg = KGsampler(args.dataset, save_dir=SAVE_DIR, data_dir=data_dir_mapping)
-        LOGDIR = f'dataset_{args.dataset}__hops_{MAX_HOP}__npaths_{N_PATHS}'
+        TASK = 'end-to-end'
     else: 
         kg = KGSamplerLinkPrediction(args.dataset, save_dir=SAVE_DIR, data_dir=data_dir_mapping)
-        LOGDIR = f'datasetLP_{args.dataset}__hops_{MAX_HOP}__npaths_{N_PATHS}'
+        TASK = 'finetuneLP'
+    # Paths are streamed and deduplicated straight into the corpus read by PathDataset
+    CORPUS_DIR = os.path.join(ROOT_DATA_DIR, dataset_name, 'paths_random_walk')
+    CORPUS_NAME = args.corpus_name or f'paths_{TASK}_{N_PATHS}_{MAX_HOP}'
+    if args.resume and corpus_complete(CORPUS_DIR, CORPUS_NAME):
+        print(f'Nothing to resume, {CORPUS_NAME} is complete')
+        exit(0)
     
     print('Closed destination item set: ', itemset_type)
     print('Collaborative filtering: ', args.collaborative)
 
-    kg.random_walk_sampler(max_hop=MAX_HOP, 
-                           logdir=LOGDIR,
-                           ignore_rels=set(), 
-                           max_paths=N_PATHS, 
-                           itemset_type=itemset_type,
-                           collaborative=COLLABORATIVE,
-                           nproc=NPROC,
-                           with_type=WITH_TYPE,
-                           start_ent_type=args.start_type,
-                           end_ent_type=args.end_type)
+    if args.dedup == 'external' and args.tokenizer_file is not None:
+        raise ValueError('External dedup works on text corpora, use --dedup memory with --tokenizer_file')
+
+    encoder = None
+    if args.tokenizer_file is not None:
+        # Token ids are assigned here, skipping the text corpus and the tokenization pass
+        if not os.path.exists(args.tokenizer_file):
+            os.makedirs(os.path.dirname(args.tokenizer_file) or '.', exist_ok=True)
+            train_wordlevel_tokenizer(os.path.join(dirpath, KGsampler.TOKEN_INDEX_FILE), args.tokenizer_file)
+        # Rows are as wide as the longest path, [BOS] and [EOS] included
+        width = args.context_length if MAX_HOP is None else min(args.context_length, 2 * MAX_HOP + 3)
+        encoder = PathTokenEncoder.from_tokenizer_file(args.tokenizer_file, width)
+
+    if args.policy_report > 0:
+        report = kg.walk_policy_report(n_keys=args.policy_report, max_hop=MAX_HOP, max_paths=N_PATHS,
+                                       itemset_type=itemset_type, collaborative=COLLABORATIVE,
+                                       start_ent_type=args.start_type, end_ent_type=args.end_type,
+                                       relation_weights=args.relation_weights)
+        for policy, stats in report.items():
+            print(f"{policy:>10}: {stats['walks_per_path']:.2f} walks/path, {stats['draws_per_path']:.2f} draws/path, "
+                  f"{100 * stats.get('walk_savings', 0.):.1f}% walks saved, {stats['seconds']:.2f}s")
+        os.makedirs(CORPUS_DIR, exist_ok=True)
+        with open(os.path.join(CORPUS_DIR, f'{CORPUS_NAME}.policies.json'), 'w') as f:
+            json.dump(report, f, indent=2)
+
+    meta = dict(dataset=dataset_name, task=args.task, seed=SEED, max_hop=MAX_HOP, max_n_paths=N_PATHS,
+                itemset_type=itemset_type, engine=args.engine, walk_policy=args.walk_policy,
+                relation_weights=args.relation_weights,
+                # random streams are derived from (seed, key) or (seed, key shard) for the batched engine
+                rng='key_shard' if args.engine == 'batched' else 'key')
+    # Per key, hop length and worker counters, saved as {CORPUS_NAME}.telemetry.json/csv
+    telemetry = SamplingTelemetry()
+    with PathCorpusWriter(CORPUS_DIR, CORPUS_NAME, n_shards=args.n_shards, compress=args.compress,
+                          dedup=args.dedup == 'memory', meta=meta, encoder=encoder, resume=args.resume) as writer:
+        kg.random_walk_sampler(writer,
+                               max_hop=MAX_HOP,
+                               ignore_rels=set(),
+                               max_paths=N_PATHS,
+                               itemset_type=itemset_type,
+                               collaborative=COLLABORATIVE,
+                               nproc=NPROC,
+                               with_type=WITH_TYPE,
+                               start_ent_type=args.start_type,
+                               end_ent_type=args.end_type,
+                               engine=args.engine,
+                               walk_policy=args.walk_policy,
+                               relation_weights=args.relation_weights,
+                               telemetry=telemetry)
+    print(f'Sampled corpus: {writer.manifest_path}')
+    if args.dedup == 'external':
+        # The hashes of the whole corpus do not have to fit in memory
+        stats = prune_corpus(CORPUS_DIR, CORPUS_NAME)
+        print(f"Removed {stats['n_duplicates']} duplicates of {stats['n_read']} paths")
+    summary = telemetry.save(CORPUS_DIR, CORPUS_NAME)
+    print(f"{summary['paths_per_second']:.1f} paths/s, {summary['walks_per_path']:.2f} walks/path, "
+          f"{100 * summary['duplicate_rate']:.1f}% duplicates, {summary['io_seconds']:.1f}s of I/O")
@@ -1,4 +1,5 @@
 import argparse
+import json
 
 from helper.knowledge_graphs.kg_macros import ML1M, PRODUCT, USER
 
@@ -38,6 +39,28 @@ def parse_sampler_args():
                         default=USER, help="Start paths with chosen type")
     parser.add_argument("--end_type", type=none_or_str,
                         default=PRODUCT, help="End paths with chosen type")
+    parser.add_argument("--engine", type=str, default='dfs',
+                        help="Path sampling engine: recursive dfs or vectorized batched random walks {dfs,batched}")
+    parser.add_argument("--walk_policy", type=str, default='uniform',
+                        help="Neighbor draw policy of the batched engine {uniform,degree,popularity,relation}")
+    parser.add_argument("--relation_weights", type=json.loads, default=None,
+                        help='Relation weights of the relation policy as json, e.g. \'{"belong_to": 4}\', missing relations weigh 1')
+    parser.add_argument("--policy_report", type=int, default=0,
+                        help="Compare the walks spent per path by every policy on this many keys before sampling")
+    parser.add_argument("--corpus_name", type=none_or_str, default=None,
+                        help="Name of the sampled corpus in <data_dirname>/<dataset>/paths_random_walk, defaults to paths_{end-to-end,finetuneLP}_<max_n_paths>_<max_hop>")
+    parser.add_argument("--n_shards", type=int, default=1,
+                        help="Number of files the sampled corpus is split into")
+    parser.add_argument("--compress", action='store_true',
+                        help="Gzip the corpus files")
+    parser.add_argument("--tokenizer_file", type=none_or_str, default=None,
+                        help="WordLevel tokenizer json, if given paths are written as int32 token id shards instead of text (the tokenizer is trained on the kg token index if missing)")
+    parser.add_argument("--context_length", type=int, default=24,
+                        help="Max length of the token id rows, [BOS] and [EOS] included")
+    parser.add_argument("--dedup", type=str, default='memory',
+                        help="Corpus level dedup: in memory while sampling, external sort/merge after sampling (bounded memory, text corpora) or none {memory,external,none}")
+    parser.add_argument("--resume", action='store_true',
+                        help="Resume an interrupted sampling job from its journal instead of starting over")
     # Sample paths for recommendation or Link Prediction?
     parser.add_argument("--task", type=str,
                         default='rec', help="Sample paths for Recommendation or for Knowledge Completion (Link prediction)")
@@ -0,0 +1,174 @@
+import argparse
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from helper.sampling.samplers.path_writer import (MANIFEST_SUFFIX, corpus_files, iter_paths, path_hash,
+                                                  path_n_hops, read_manifest)
+
+RUN_SIZE = 1 << 22
+BLOCK_SIZE = 1 << 16
+
+
+def write_runs(filepaths, run_dir, run_size=RUN_SIZE, min_hop=None, max_hop=None):
+    """
+    Hash the paths of filepaths in sorted runs of at most run_size (hash, position) pairs, saved as .npy
+    files in run_dir. Paths outside [min_hop, max_hop] are left out of the runs, and so of the output.
+    Returns the run files, the number of paths read and the number of pruned ones.
+    """
+    hashes = np.empty(run_size, dtype=np.uint64)
+    positions = np.empty(run_size, dtype=np.int64)
+    runs, n, n_paths, n_pruned = [], 0, 0, 0
+
+    def flush():
+        order = np.lexsort((positions[:n], hashes[:n]))
+        run = os.path.join(run_dir, f'run-{len(runs):05d}')
+        np.save(run + '.hash.npy', hashes[:n][order])
+        np.save(run + '.pos.npy', positions[:n][order])
+        runs.append(run)
+
+    for pos, path in enumerate(iter_paths(filepaths)):
+        n_paths += 1
+        n_hops = path_n_hops(path)
+        if (min_hop is not None and n_hops < min_hop) or (max_hop is not None and n_hops > max_hop):
+            n_pruned += 1
+            continue
+        hashes[n], positions[n] = path_hash(path), pos
+        n += 1
+        if n == run_size:
+            flush()
+            n = 0
+    if n > 0 or not runs:
+        flush()
+    return runs, n_paths, n_pruned
+
+
+def merge_runs(runs, keep, block_size=BLOCK_SIZE):
+    """
+    k-way merge of the sorted runs, block_size pairs per run at a time. Every round takes the pairs up to
+    the smallest last hash of the run blocks, all the copies of a hash below it are then in the round.
+    Sets keep[pos] for the first position of every hash, returns the number of duplicates.
+    """
+    runs = [(np.load(run + '.hash.npy', mmap_mode='r'), np.load(run + '.pos.npy', mmap_mode='r')) for run in runs]
+    heads = [0] * len(runs)
+    prev_hash, n_duplicates = None, 0
+    while True:
+        live = [r for r, (hashes, _) in enumerate(runs) if heads[r] < len(hashes)]
+        if not live:
+            break
+        # Copies of the bound hash can continue past the block of a run, they are always after the kept one
+        bounds = [runs[r][0][heads[r] + block_size - 1] for r in live if heads[r] + block_size < len(runs[r][0])]
+        bound = min(bounds) if bounds else None
+        round_hashes, round_positions = [], []
+        for r in live:
+            hashes, positions = runs[r]
+            end = min(heads[r] + block_size, len(hashes))
+            if bound is not None:
+                end = heads[r] + int(np.searchsorted(hashes[heads[r]:end], bound, side='right'))
+            round_hashes.append(np.asarray(hashes[heads[r]:end]))
+            round_positions.append(np.asarray(positions[heads[r]:end]))
+            heads[r] = end
+        hashes, positions = np.concatenate(round_hashes), np.concatenate(round_positions)
+        order = np.lexsort((positions, hashes))
+        hashes, positions = hashes[order], positions[order]
+        first = np.ones(len(hashes), dtype=bool)
+        first[1:] = hashes[1:] != hashes[:-1]
+        if prev_hash is not None and len(hashes):
+            first[0] = hashes[0] != prev_hash
+        keep[positions[first]] = True
+        n_duplicates += int(len(hashes) - first.sum())
+        if len(hashes):
+            prev_hash = hashes[-1]
+    return n_duplicates
+
+
+def prune_files(filepaths, out_filepath, tmp_dir=None, run_size=RUN_SIZE, block_size=BLOCK_SIZE, min_hop=None,
+                max_hop=None, compress=False):
+    """
+    Stream the paths of filepaths into out_filepath dropping duplicates (by 64-bit hash, the first copy is
+    kept) and paths outside [min_hop, max_hop], in input order. Memory is bounded by run_size and
+    block_size: hashes are sorted in runs on disk and merged, the keep flags are a disk backed array.
+    Returns the stats of the removed paths.
+    """
+    start = time.time()
+    work_dir = tempfile.mkdtemp(prefix='prune-', dir=tmp_dir)
+    try:
+        runs, n_paths, n_pruned = write_runs(filepaths, work_dir, run_size, min_hop, max_hop)
+        keep = np.memmap(os.path.join(work_dir, 'keep.bin'), dtype=bool, mode='w+', shape=max(n_paths, 1))
+        n_duplicates = merge_runs(runs, keep, block_size)
+
+        hops, n_kept = dict(), 0
+        tmp_filepath = out_filepath + '.tmp'
+        with (gzip.open(tmp_filepath, 'wt', compresslevel=6) if compress else open(tmp_filepath, 'w')) as f:
+            for pos, path in enumerate(iter_paths(filepaths)):
+                if keep[pos]:
+                    f.write(path + '\n')
+                    n_hops = str(path_n_hops(path))
+                    hops[n_hops] = hops.get(n_hops, 0) + 1
+                    n_kept += 1
+        os.replace(tmp_filepath, out_filepath)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return dict(n_read=n_paths, n_paths=n_kept, n_duplicates=n_duplicates, n_pruned=n_pruned, n_runs=len(runs),
+                hops=dict(sorted(hops.items(), key=lambda kv: int(kv[0]))), seconds=time.time() - start)
+
+
+def prune_corpus(corpus_dir, corpus_name, out_name=None, compress=None, **kwargs):
+    """
+    Dedup and prune a sampled text corpus (plain file or sharded) into the single file corpus out_name,
+    in place by default. The manifest of the output records the prune stats.
+    """
+    out_name = out_name or corpus_name
+    manifest = read_manifest(corpus_dir, corpus_name) or dict()
+    filepaths = corpus_files(corpus_dir, corpus_name)
+    if compress is None:
+        compress = manifest.get('compressed', False)
+    out_file = out_name + ('.txt.gz' if compress else '.txt')
+    stats = prune_files(filepaths, os.path.join(corpus_dir, out_file), compress=compress, **kwargs)
+
+    n_duplicates = manifest.get('n_duplicates', 0) + stats['n_duplicates']
+    out_manifest = dict(manifest, name=out_name, format='text', compressed=compress, n_paths=stats['n_paths'],
+                        n_duplicates=n_duplicates,
+                        shards=[dict(file=out_file, n_paths=stats['n_paths'], n_duplicates=n_duplicates,
+                                     n_keys=manifest.get('n_keys', 0), hops=stats['hops'],
+                                     seeds=[seed for shard in manifest.get('shards', []) for seed in shard['seeds']])],
+                        prune=stats)
+    if out_name == corpus_name:
+        for filepath in filepaths:
+            if os.path.basename(filepath) != out_file:
+                os.remove(filepath)
+    with open(os.path.join(corpus_dir, out_name + MANIFEST_SUFFIX), 'w') as f:
+        json.dump(out_manifest, f, indent=2)
+    return stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--filepath', type=str, default=None,
+                        help='Text file of paths, the output is written to <filepath>_pruned.txt')
+    parser.add_argument('--corpus_dir', type=str, default=None,
+                        help='Directory of a sampled corpus, pruned in place or into --out_name')
+    parser.add_argument('--corpus_name', type=str, default=None)
+    parser.add_argument('--out_name', type=str, default=None)
+    parser.add_argument('--min_hop', type=int, default=None, help='Drop paths shorter than this')
+    parser.add_argument('--max_hop', type=int, default=None, help='Drop paths longer than this')
+    parser.add_argument('--run_size', type=int, default=RUN_SIZE,
+                        help='Paths hashed and sorted in memory at a time, 16 bytes each')
+    parser.add_argument('--tmp_dir', type=str, default=None, help='Directory of the sorted runs')
+    args = parser.parse_args()
+
+    kwargs = dict(tmp_dir=args.tmp_dir, run_size=args.run_size, min_hop=args.min_hop, max_hop=args.max_hop)
+    if args.filepath is not None:
+        out_filepath = os.path.splitext(args.filepath)[0] + '_pruned.txt'
+        stats = prune_files([args.filepath], out_filepath, **kwargs)
+        with open(os.path.splitext(out_filepath)[0] + '.stats.json', 'w') as f:
+            json.dump(stats, f, indent=2)
+    else:
+        stats = prune_corpus(args.corpus_dir, args.corpus_name, out_name=args.out_name, **kwargs)
+    print(f"Kept {stats['n_paths']} of {stats['n_read']} paths: {stats['n_duplicates']} duplicates, "
+          f"{stats['n_pruned']} pruned by hop length, {stats['n_runs']} runs, {stats['seconds']:.1f}s")
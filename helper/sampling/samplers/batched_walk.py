@@ -0,0 +1,450 @@
+import random
+import time
+
+import numpy as np
+
+from helper.knowledge_graphs.kg_macros import ENTITY, PRODUCT, USER
+
+from .constants import LiteralPath
+from .csr_graph import get_token_ent_type
+
+MAX_HOP_RANGE = 50
+NO_NODE = -1
+POLICIES = ['uniform', 'degree', 'popularity', 'relation']
+
+
+class _GroupTable:
+    """
+    Edges of each node grouped by (relation, tail type), the groups of node row are
+    gptr[row]:gptr[row+1], group g spans the edges gstart[g]:gstart[g]+glen[g].
+    """
+    def __init__(self, n_nodes, group_src, group_start, group_len):
+        self.gptr = np.zeros(n_nodes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(group_src, minlength=n_nodes), out=self.gptr[1:])
+        self.gstart = group_start
+        self.glen = group_len
+
+    def draw(self, rng, cur):
+        """Draw a (relation, tail type) group and a tail for every current node, -1 on dead ends"""
+        n_groups = self.gptr[cur + 1] - self.gptr[cur]
+        edge = np.full(len(cur), NO_NODE, dtype=np.int64)
+        alive = n_groups > 0
+        group = self.gptr[cur[alive]] + (rng.random(alive.sum()) * n_groups[alive]).astype(np.int64)
+        edge[alive] = self.gstart[group] + (rng.random(len(group)) * self.glen[group]).astype(np.int64)
+        return edge
+
+
+class _AliasTable:
+    """
+    Per node alias tables over a subset of the edges, the slots of node row are eptr[row]:eptr[row+1],
+    slot i keeps edges[i] with probability prob[i] and takes edges[alias[i]] otherwise.
+    Nodes whose edges all have zero weight have no slots.
+    """
+    def __init__(self, n_nodes, src, edges, weights):
+        weights = np.asarray(weights, dtype=np.float64)
+        totals = np.bincount(src, weights=weights, minlength=n_nodes)
+        keep = totals[src] > 0
+        src, edges, weights = src[keep], edges[keep], weights[keep]
+        self.eptr = np.zeros(n_nodes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(src, minlength=n_nodes), out=self.eptr[1:])
+        self.edges = edges
+        self.prob, self.alias = self._build(src, weights * np.diff(self.eptr)[src] / totals[src])
+
+    def _build(self, seg, p):
+        """
+        Vose tables of all the nodes at once with the sweeping construction: lights (p < 1) are
+        filled in order by the current heavy, that becomes light (and is filled by the next heavy)
+        once its excess is used up. Every round advances every node by one light or one heavy.
+        """
+        n = len(p)
+        prob, alias = np.ones(n, dtype=np.float64), np.arange(n, dtype=np.int64)
+        is_light = p < 1.
+        lights, heavies = np.flatnonzero(is_light), np.flatnonzero(~is_light)
+        n_seg = len(self.eptr) - 1
+        l_ptr = np.zeros(n_seg + 1, dtype=np.int64)
+        np.cumsum(np.bincount(seg[lights], minlength=n_seg), out=l_ptr[1:])
+        h_ptr = np.zeros(n_seg + 1, dtype=np.int64)
+        np.cumsum(np.bincount(seg[heavies], minlength=n_seg), out=h_ptr[1:])
+
+        # Nodes with lights to fill, rounding can leave nodes without heavies, their slots keep prob 1
+        active = np.flatnonzero((l_ptr[1:] > l_ptr[:-1]) & (h_ptr[1:] > h_ptr[:-1]))
+        li, hj = l_ptr[active].copy(), h_ptr[active].copy()
+        rest = p[heavies[hj]]
+        while len(active):
+            # A heavy whose excess is used up becomes light and takes its deficit from the next heavy
+            convert = (rest < 1.) & (hj + 1 < h_ptr[active + 1])
+            c = np.flatnonzero(convert)
+            cur, nxt = heavies[hj[c]], heavies[hj[c] + 1]
+            prob[cur], alias[cur] = rest[c], nxt
+            rest[c] = p[nxt] - (1. - rest[c])
+            hj[c] += 1
+            # Otherwise fill the next light
+            f = np.flatnonzero(~convert & (li < l_ptr[active + 1]))
+            light = lights[li[f]]
+            prob[light], alias[light] = p[light], heavies[hj[f]]
+            rest[f] -= 1. - p[light]
+            li[f] += 1
+            done = (li >= l_ptr[active + 1]) & ~((rest < 1.) & (hj + 1 < h_ptr[active + 1]))
+            active, li, hj, rest = active[~done], li[~done], hj[~done], rest[~done]
+        return prob, alias
+
+    def draw(self, rng, cur):
+        """Draw a tail for every current node in O(1), -1 on dead ends"""
+        n_slots = self.eptr[cur + 1] - self.eptr[cur]
+        edge = np.full(len(cur), NO_NODE, dtype=np.int64)
+        alive = n_slots > 0
+        slot = self.eptr[cur[alive]] + (rng.random(alive.sum()) * n_slots[alive]).astype(np.int64)
+        slot = np.where(rng.random(len(slot)) < self.prob[slot], slot, self.alias[slot])
+        edge[alive] = self.edges[slot]
+        return edge
+
+
+def _mix64(h, values):
+    """Combine a running uint64 hash with a column of values (splitmix64 finalizer)"""
+    h = (h ^ values.astype(np.uint64)) * np.uint64(0x9E3779B97F4A7C15)
+    h ^= h >> np.uint64(31)
+    h *= np.uint64(0xBF58476D1CE4E5B9)
+    h ^= h >> np.uint64(27)
+    return h
+
+
+class BatchedRandomWalker:
+    """
+    Vectorized random walk engine over a TypedCSRGraph.
+    All the walks of a batch advance together, one frontier array per hop. With the uniform policy a walk
+    draws a (relation, tail type) group of its current node uniformly and then a tail uniformly in the group,
+    as the DFS sampler does. The other policies draw the edge from per node alias tables, weighting it by
+    the degree of the tail (degree), by the number of interactions of the tail (popularity) or by the
+    weight of its relation, shared among the edges of the relation group (relation).
+    Walks that step back on the previous node or that end on a product outside the requested item set
+    redraw up to max_retries times, otherwise they are discarded.
+    """
+    def __init__(self, graph, ignore_rels=set(), collaborative=True, max_retries=8, non_prod_entities=(USER, ENTITY),
+                 policy='uniform', relation_weights=None):
+        if policy not in POLICIES:
+            raise ValueError(f'Unknown walk policy {policy}, expected one of {POLICIES}')
+        self.graph = graph
+        self.max_retries = max_retries
+        self.non_prod_entities = set(non_prod_entities)
+        self.policy = policy
+        self.user_code = graph.type2code.get(USER, NO_NODE)
+        self.prod_code = graph.type2code.get(PRODUCT, NO_NODE)
+        self.ext_codes = [code for code, ent_type in enumerate(graph.ent_types) if ent_type not in (USER, PRODUCT)]
+        self.stats = dict(walks=0, draws=0, paths=0)
+
+        n_nodes = graph.n_nodes
+        src = np.repeat(np.arange(n_nodes), graph.degrees())
+        rels = graph.rels
+        tail_types = graph.node_types[graph.indices]
+        # Edges are sorted by source, relation and tail type, find the group boundaries
+        new_group = np.ones(len(src), dtype=bool)
+        new_group[1:] = (src[1:] != src[:-1]) | (rels[1:] != rels[:-1]) | (tail_types[1:] != tail_types[:-1])
+        group_start = np.flatnonzero(new_group)
+        group_len = np.diff(np.r_[group_start, len(src)])
+        group_src, group_rel, group_tail_type = src[group_start], rels[group_start], tail_types[group_start]
+
+        ignore_rel_ids = [graph.rel_type2id[rel] for rel in ignore_rels if rel in graph.rel_type2id]
+        valid = ~np.isin(group_rel, ignore_rel_ids)
+        if not collaborative:
+            valid &= group_tail_type != self.user_code
+        self._group_src = group_src[valid]
+        self._group_start = group_start[valid]
+        self._group_len = group_len[valid]
+        self._group_tail_type = group_tail_type[valid]
+        if policy != 'uniform':
+            self._edge_src = src
+            self._edge_valid = np.repeat(valid, group_len)
+            self._edge_tail_type = tail_types
+            self._edge_weights = self.edge_weights(policy, group_len, relation_weights)
+        self.groups = self._table(None)
+        self._end_groups = dict()
+
+        # Token of every node row and relation id, used to format the paths
+        self.node_tokens = np.empty(n_nodes, dtype=object)
+        for code, ent_type in enumerate(graph.ent_types):
+            prefix = get_token_ent_type(ent_type)
+            start, end = graph.type_start[code], graph.type_start[code + 1]
+            self.node_tokens[start:end] = [f'{prefix}{ent_id}' for ent_id in graph.node_ids[start:end].tolist()]
+        self.rel_tokens = {int(rel_id): f'{LiteralPath.rel_type}{rel_id}' for rel_id in np.unique(rels).tolist()}
+
+    def end_type_codes(self, end_ent_type):
+        if end_ent_type is None:
+            return None
+        if end_ent_type == ENTITY:
+            return self.ext_codes
+        return [self.graph.type2code[end_ent_type]]
+
+    def edge_weights(self, policy, group_len, relation_weights=None):
+        """Unnormalized weight of every edge of the graph under a weighted policy"""
+        graph = self.graph
+        tails = graph.indices
+        if policy == 'degree':
+            return graph.degrees()[tails].astype(np.float64)
+        if policy == 'popularity':
+            if self.user_code == NO_NODE:
+                # No interactions in the graph, fall back to the kg degree
+                return graph.degrees()[tails].astype(np.float64)
+            to_user = graph.node_types[tails] == self.user_code
+            n_interactions = np.bincount(self._edge_src[to_user], minlength=graph.n_nodes)
+            return 1. + n_interactions[tails]
+        # relation: the weight of a relation is split among the edges of each (relation, tail type) group
+        rel_weight = np.ones(int(graph.rels.max()) - int(graph.rels.min()) + 1 if len(graph.rels) else 0)
+        offset = int(graph.rels.min()) if len(graph.rels) else 0
+        for rel, weight in (relation_weights or dict()).items():
+            if rel in graph.rel_type2id:
+                rel_weight[graph.rel_type2id[rel] - offset] = weight
+        return rel_weight[graph.rels.astype(np.int64) - offset] / np.repeat(group_len, group_len)
+
+    def _table(self, codes):
+        """Draw table of the valid edges, restricted to the tails of the given type codes if any"""
+        if self.policy == 'uniform':
+            valid = slice(None) if codes is None else np.isin(self._group_tail_type, codes)
+            return _GroupTable(self.graph.n_nodes, self._group_src[valid], self._group_start[valid],
+                               self._group_len[valid])
+        valid = self._edge_valid if codes is None else self._edge_valid & np.isin(self._edge_tail_type, codes)
+        edges = np.flatnonzero(valid)
+        return _AliasTable(self.graph.n_nodes, self._edge_src[edges], edges, self._edge_weights[edges])
+
+    def end_groups(self, end_ent_type):
+        """Draw table restricted to the tails of the given end type, used at the last hop"""
+        codes = self.end_type_codes(end_ent_type)
+        if codes is None:
+            return self.groups
+        key = tuple(codes)
+        if key not in self._end_groups:
+            self._end_groups[key] = self._table(codes)
+        return self._end_groups[key]
+
+    def hop_choices(self, start_ent_type, end_ent_type):
+        """Valid number of hops when max_hop is None, same parity rule of the DFS sampler"""
+        if end_ent_type is None:
+            return np.arange(1, MAX_HOP_RANGE + 1)
+        if (start_ent_type in self.non_prod_entities) != (end_ent_type in self.non_prod_entities):
+            # only odd hops
+            return np.arange(1, MAX_HOP_RANGE + 1, 2)
+        # only even hops
+        return np.arange(2, MAX_HOP_RANGE + 1, 2)
+
+    def random_start_types(self, rng, n, start_choices):
+        """Draw start types as the DFS sampler: a type among start_choices, ENTITY means any external type"""
+        picked = np.asarray(start_choices, dtype=object)[rng.integers(0, len(start_choices), n)]
+        ext_types = [ent_type for ent_type in self.graph.ent_types if ent_type not in (USER, PRODUCT)]
+        is_ext = picked == ENTITY
+        picked[is_ext] = np.asarray(ext_types, dtype=object)[rng.integers(0, len(ext_types), is_ext.sum())]
+        return picked
+
+    def random_rows(self, rng, ent_types):
+        """Uniform node row of every given type"""
+        rows = np.full(len(ent_types), NO_NODE, dtype=np.int64)
+        for ent_type in np.unique(ent_types):
+            sel = np.flatnonzero(ent_types == ent_type)
+            code = self.graph.type2code[ent_type]
+            start, end = self.graph.type_start[code], self.graph.type_start[code + 1]
+            if end > start:
+                rows[sel] = rng.integers(start, end, len(sel))
+        return rows
+
+    def walk(self, rng, start_rows, n_hops, end_ent_type=None, item_keys=None, key_ids=None, itemset_type='all',
+             telemetry=None):
+        """
+        Advance len(start_rows) walks of n_hops[i] hops. If end_ent_type is PRODUCT and itemset_type is
+        inner/outer, the last product of walk i must (not) be in the item set of key_ids[i], item_keys is the
+        sorted array of key_id * (max_pid + 1) + pid of the item sets.
+        Returns node rows (n, max_hop + 1), relation ids (n, max_hop) and the mask of completed walks.
+        Visited nodes and the nodes where walks are lost are counted per entity type in telemetry.
+        """
+        graph = self.graph
+        n, max_hop = len(start_rows), int(n_hops.max()) if len(n_hops) else 0
+        nodes = np.full((n, max_hop + 1), NO_NODE, dtype=np.int64)
+        rels = np.zeros((n, max_hop), dtype=np.int64)
+        nodes[:, 0] = start_rows
+        alive = start_rows != NO_NODE
+        end_groups = self.end_groups(end_ent_type)
+        filter_items = end_ent_type == PRODUCT and itemset_type in ('inner', 'outer') and item_keys is not None
+        span = int(graph.node_ids.max()) + 1 if graph.n_nodes else 1
+
+        for hop in range(max_hop):
+            active = np.flatnonzero(alive & (hop < n_hops))
+            if len(active) == 0:
+                break
+            is_last = n_hops[active] == hop + 1
+            cur = nodes[active, hop]
+            prev = nodes[active, hop - 1] if hop > 0 else np.full(len(active), NO_NODE)
+            edge = np.full(len(active), NO_NODE, dtype=np.int64)
+            todo = np.arange(len(active))
+            for _ in range(self.max_retries):
+                for last, groups in ((False, self.groups), (True, end_groups)):
+                    sel = todo[is_last[todo] == last]
+                    if len(sel):
+                        edge[sel] = groups.draw(rng, cur[sel])
+                        self.stats['draws'] += len(sel)
+                drawn = edge[todo] != NO_NODE
+                tail = np.where(drawn, graph.indices[np.maximum(edge[todo], 0)], NO_NODE)
+                # Do not step back on the previous node
+                bad = drawn & (tail == prev[todo])
+                if filter_items:
+                    check = drawn & ~bad & is_last[todo]
+                    keys = key_ids[active[todo[check]]] * span + graph.node_ids[tail[check]]
+                    pos = np.searchsorted(item_keys, keys)
+                    member = item_keys[np.minimum(pos, len(item_keys) - 1)] == keys if len(item_keys) else \
+                        np.zeros(len(keys), dtype=bool)
+                    bad[check] = ~member if itemset_type == 'inner' else member
+                edge[todo[bad]] = NO_NODE
+                # Dead ends cannot be recovered, only bad draws are retried
+                todo = todo[bad]
+                if len(todo) == 0:
+                    break
+            ok = edge != NO_NODE
+            alive[active[~ok]] = False
+            if telemetry is not None:
+                self.count_types(telemetry.visit, cur)
+                self.count_types(telemetry.dead_end, cur[~ok])
+            nodes[active[ok], hop + 1] = graph.indices[edge[ok]]
+            rels[active[ok], hop] = graph.rels[edge[ok]]
+        return nodes, rels, alive
+
+    def count_types(self, count, rows):
+        """Call count(ent_type, n) for the entity types of the given node rows"""
+        n_rows = np.bincount(self.graph.node_types[rows], minlength=len(self.graph.ent_types))
+        for code in np.flatnonzero(n_rows).tolist():
+            count(self.graph.ent_types[code], int(n_rows[code]))
+
+    def path_hashes(self, key_ids, nodes, rels):
+        h = _mix64(np.zeros(len(nodes), dtype=np.uint64), key_ids)
+        for col in range(nodes.shape[1]):
+            h = _mix64(h, nodes[:, col])
+            if col < rels.shape[1]:
+                h = _mix64(h, rels[:, col])
+        return h
+
+    def path_strings(self, nodes, rels, n_hops):
+        """Format walks as U/R/P/E token paths, e.g. U12 R-1 P45 R3 E900"""
+        paths = []
+        node_tokens, rel_tokens = self.node_tokens, self.rel_tokens
+        for row_nodes, row_rels, n_hop in zip(nodes.tolist(), rels.tolist(), n_hops.tolist()):
+            tokens = [node_tokens[row_nodes[0]]]
+            for hop in range(n_hop):
+                tokens.append(rel_tokens[row_rels[hop]])
+                tokens.append(node_tokens[row_nodes[hop + 1]])
+            paths.append(' '.join(tokens))
+        return paths
+
+    def sample(self, rng, keys, start_ent_type, n_hop, max_paths, end_ent_type=PRODUCT, itemset_type='inner',
+               key_items=None, start_choices=(USER, PRODUCT, ENTITY), max_attempts_per_path=100, oversample=2.,
+               telemetry=None):
+        """
+        Sample up to max_paths unique paths for every key, paths start from the key node when start_ent_type
+        is given, otherwise from random nodes as in the DFS sampler. key_items maps a key to its item set.
+        Yields (key, list of paths) once the key is completed or its attempt budget is exhausted.
+        Walks, accepted and duplicate paths are counted in telemetry (a ShardTelemetry) if given.
+        """
+        graph = self.graph
+        keys = list(keys)
+        remaining = np.full(len(keys), max_paths, dtype=np.int64)
+        attempts = np.zeros(len(keys), dtype=np.int64)
+        budget = max_paths * max_attempts_per_path
+        accepted = [dict() for _ in keys]
+
+        item_keys = None
+        if key_items is not None:
+            span = int(graph.node_ids.max()) + 1 if graph.n_nodes else 1
+            item_keys = np.sort(np.fromiter((key_id * span + item for key_id, key in enumerate(keys)
+                                             for item in key_items.get(key, ()) if item < span), dtype=np.int64))
+
+        key_rows = None
+        if start_ent_type is not None:
+            key_rows = graph.rows(start_ent_type, np.asarray(keys, dtype=np.int64))
+        fixed_hops = None if n_hop is None else n_hop
+        if fixed_hops is None and start_ent_type is not None:
+            fixed_choices = self.hop_choices(start_ent_type, end_ent_type)
+
+        pending = np.flatnonzero(remaining > 0)
+        while len(pending):
+            n_walks = np.minimum(np.ceil(remaining[pending] * oversample).astype(np.int64),
+                                 budget - attempts[pending])
+            walk_keys = np.repeat(pending, n_walks)
+            attempts[pending] += n_walks
+            self.stats['walks'] += len(walk_keys)
+            if start_ent_type is not None:
+                start_rows = key_rows[walk_keys]
+                start_types = None
+            else:
+                start_types = self.random_start_types(rng, len(walk_keys), start_choices)
+                start_rows = self.random_rows(rng, start_types)
+            if fixed_hops is not None:
+                n_hops = np.full(len(walk_keys), fixed_hops, dtype=np.int64)
+            elif start_types is None:
+                n_hops = rng.choice(fixed_choices, len(walk_keys))
+            else:
+                n_hops = np.empty(len(walk_keys), dtype=np.int64)
+                for start_type in np.unique(start_types):
+                    sel = start_types == start_type
+                    n_hops[sel] = rng.choice(self.hop_choices(start_type, end_ent_type), sel.sum())
+
+            nodes, rels, ok = self.walk(rng, start_rows, n_hops, end_ent_type, item_keys, walk_keys, itemset_type,
+                                        telemetry)
+            if telemetry is not None:
+                for key_id, n in zip(pending.tolist(), n_walks.tolist()):
+                    telemetry.keys[keys[key_id]][0] += n
+                telemetry.hop_walks.update(n_hops.tolist())
+            nodes, rels, n_hops, walk_keys = nodes[ok], rels[ok], n_hops[ok], walk_keys[ok]
+            # Padding of shorter walks does not change the hash of the path
+            rels[np.arange(rels.shape[1]) >= n_hops[:, None]] = 0
+            hashes = self.path_hashes(walk_keys, nodes, rels)
+            _, first = np.unique(hashes, return_index=True)
+            first.sort()
+            for idx, path in zip(first.tolist(), self.path_strings(nodes[first], rels[first], n_hops[first])):
+                key_id = walk_keys[idx]
+                if remaining[key_id] == 0:
+                    continue
+                if hashes[idx] in accepted[key_id]:
+                    if telemetry is not None:
+                        telemetry.duplicate(keys[key_id])
+                    continue
+                accepted[key_id][hashes[idx]] = path
+                remaining[key_id] -= 1
+                self.stats['paths'] += 1
+                if telemetry is not None:
+                    telemetry.accept(keys[key_id], int(n_hops[idx]))
+            if telemetry is not None:
+                # Walks of a batch that repeat an earlier walk of the same batch
+                n_repeats = np.bincount(walk_keys, minlength=len(keys)) - np.bincount(walk_keys[first],
+                                                                                      minlength=len(keys))
+                for key_id in np.flatnonzero(n_repeats).tolist():
+                    telemetry.duplicate(keys[key_id], int(n_repeats[key_id]))
+
+            finished = (remaining == 0) | (attempts >= budget)
+            for key_id in pending[finished[pending]].tolist():
+                yield keys[key_id], list(accepted[key_id].values())
+                accepted[key_id] = None
+            pending = pending[~finished[pending]]
+
+
+def random_walk_batched(keys, walker, start_ent_type=USER, end_ent_type=PRODUCT, n_hop=3, max_paths=100,
+                        itemset_type='inner', user_dict=None, start_choices=(USER, PRODUCT, ENTITY), **kwargs):
+    """Sample the paths of a shard of keys with the batched engine, returns the (key, paths) pairs"""
+    # Seeded from the random module, which is reseeded for every shard
+    rng = np.random.default_rng(random.getrandbits(64))
+    return list(walker.sample(rng, keys, start_ent_type, n_hop, max_paths, end_ent_type=end_ent_type,
+                              itemset_type=itemset_type, key_items=user_dict, start_choices=start_choices, **kwargs))
+
+
+def policy_report(graph, keys, policies=POLICIES, seed=0, walker_kwargs=None, **kwargs):
+    """
+    Sample the paths of keys with every policy and report the walks and edge draws spent per sampled path,
+    with the savings with respect to the uniform policy. kwargs are forwarded to BatchedRandomWalker.sample.
+    """
+    report = dict()
+    for policy in policies:
+        walker = BatchedRandomWalker(graph, policy=policy, **(walker_kwargs or dict()))
+        start = time.time()
+        for _ in walker.sample(np.random.default_rng(seed), keys, **kwargs):
+            pass
+        stats = dict(walker.stats, seconds=time.time() - start)
+        n_paths = max(stats['paths'], 1)
+        stats.update(walks_per_path=stats['walks'] / n_paths, draws_per_path=stats['draws'] / n_paths)
+        report[policy] = stats
+    if 'uniform' in report:
+        for stats in report.values():
+            stats['walk_savings'] = 1. - stats['walks_per_path'] / report['uniform']['walks_per_path']
+    return report
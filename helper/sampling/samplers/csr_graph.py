@@ -0,0 +1,248 @@
+import json
+import os
+from collections.abc import Mapping
+
+import numpy as np
+
+from helper.knowledge_graphs.kg_macros import PRODUCT, USER
+
+from .constants import LiteralPath
+
+
+def get_token_ent_type(ent_type):
+    if ent_type == USER:
+        return LiteralPath.user_type
+    elif ent_type == PRODUCT:
+        return LiteralPath.prod_type
+    return LiteralPath.ent_type
+
+
+class TypedCSRGraph:
+    """
+    Array backed augmented kg.
+    Nodes are (entity type, entity id) pairs, the nodes of each entity type are stored contiguously and
+    sorted by id, rows [type_start[t], type_start[t+1]) belong to the type self.ent_types[t].
+    The (undirected) edges of a node are indices[indptr[row]:indptr[row+1]] (node rows of the tails)
+    together with the relation ids rels[indptr[row]:indptr[row+1]], sorted by relation, tail type and tail id.
+    """
+    ID_DTYPE = np.int32
+    REL_DTYPE = np.int16
+    TYPE_DTYPE = np.int8
+
+    def __init__(self, ent_types, rel_id2type, type_start, node_ids, indptr, indices, rels):
+        self.ent_types = list(ent_types)
+        self.type2code = {ent_type: code for code, ent_type in enumerate(self.ent_types)}
+        self.rel_id2type = dict(rel_id2type)
+        self.rel_type2id = {v: k for k, v in self.rel_id2type.items()}
+        self.type_start = type_start
+        self.node_ids = node_ids
+        self.indptr = indptr
+        self.indices = indices
+        self.rels = rels
+        self.node_types = np.repeat(np.arange(len(self.ent_types), dtype=TypedCSRGraph.TYPE_DTYPE),
+                                    np.diff(self.type_start))
+        # Dense entity id -> node row lookup for each type
+        self._row_of = []
+        for code in range(len(self.ent_types)):
+            ids = self.ids(self.ent_types[code])
+            row_of = np.full(int(ids.max()) + 1 if len(ids) else 0, -1, dtype=np.int64)
+            row_of[ids] = np.arange(self.type_start[code], self.type_start[code + 1])
+            self._row_of.append(row_of)
+
+    @classmethod
+    def from_triples(cls, ent_types, rel_id2type, head_types, head_ids, rels, tail_types, tail_ids, nodes=None):
+        """
+        Build the graph from (head type code, head id, relation id, tail type code, tail id) arrays,
+        every triple is inserted in both directions and duplicated edges are dropped.
+        nodes optionally maps a type code to ids that must be in the graph even without edges.
+        """
+        src_t = np.concatenate([head_types, tail_types]).astype(np.int64)
+        src_id = np.concatenate([head_ids, tail_ids]).astype(np.int64)
+        dst_t = np.concatenate([tail_types, head_types]).astype(np.int64)
+        dst_id = np.concatenate([tail_ids, head_ids]).astype(np.int64)
+        edge_rels = np.concatenate([rels, rels]).astype(np.int64)
+
+        extra_t, extra_id = [], []
+        for code, ids in (nodes or dict()).items():
+            ids = np.asarray(list(ids), dtype=np.int64)
+            extra_t.append(np.full(len(ids), code, dtype=np.int64))
+            extra_id.append(ids)
+        all_t = np.concatenate([src_t] + extra_t)
+        all_id = np.concatenate([src_id] + extra_id)
+
+        # Node keys sorted by type and id give the node rows
+        id_span = int(all_id.max()) + 1 if len(all_id) else 1
+        node_keys = np.unique(all_t * id_span + all_id)
+        node_types = node_keys // id_span
+        node_ids = (node_keys % id_span).astype(cls.ID_DTYPE)
+        type_start = np.searchsorted(node_types, np.arange(len(ent_types) + 1)).astype(np.int64)
+
+        src = np.searchsorted(node_keys, src_t * id_span + src_id)
+        dst = np.searchsorted(node_keys, dst_t * id_span + dst_id)
+        order = np.lexsort((dst, edge_rels, src))
+        src, edge_rels, dst = src[order], edge_rels[order], dst[order]
+        keep = np.ones(len(src), dtype=bool)
+        keep[1:] = (src[1:] != src[:-1]) | (edge_rels[1:] != edge_rels[:-1]) | (dst[1:] != dst[:-1])
+        src, edge_rels, dst = src[keep], edge_rels[keep], dst[keep]
+
+        indptr = np.zeros(len(node_keys) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(src, minlength=len(node_keys)), out=indptr[1:])
+        return cls(ent_types, rel_id2type, type_start, node_ids, indptr,
+                   dst.astype(cls.ID_DTYPE), edge_rels.astype(cls.REL_DTYPE))
+
+    ARRAYS = ['type_start', 'node_ids', 'indptr', 'indices', 'rels']
+
+    def save(self, dirpath):
+        """Store the graph as .npy arrays plus a json file with the type and relation names"""
+        os.makedirs(dirpath, exist_ok=True)
+        for name in TypedCSRGraph.ARRAYS:
+            np.save(os.path.join(dirpath, f'{name}.npy'), getattr(self, name))
+        with open(os.path.join(dirpath, 'graph.json'), 'w') as f:
+            json.dump(dict(ent_types=self.ent_types, rel_id2type=list(self.rel_id2type.items())), f)
+
+    @classmethod
+    def load(cls, dirpath, mmap_mode='r'):
+        """Load a graph stored with save, the arrays are memory mapped unless mmap_mode is None"""
+        with open(os.path.join(dirpath, 'graph.json')) as f:
+            meta = json.load(f)
+        arrays = [np.load(os.path.join(dirpath, f'{name}.npy'), mmap_mode=mmap_mode) for name in cls.ARRAYS]
+        return cls(meta['ent_types'], {int(k): v for k, v in meta['rel_id2type']}, *arrays)
+
+    @property
+    def n_nodes(self):
+        return len(self.node_ids)
+
+    @property
+    def n_edges(self):
+        return len(self.indices)
+
+    @property
+    def nbytes(self):
+        return sum(arr.nbytes for arr in [self.type_start, self.node_ids, self.indptr, self.indices, self.rels,
+                                          self.node_types] + self._row_of)
+
+    def __contains__(self, ent_type):
+        return ent_type in self.type2code
+
+    def types(self):
+        return list(self.ent_types)
+
+    def ids(self, ent_type):
+        code = self.type2code[ent_type]
+        return self.node_ids[self.type_start[code]:self.type_start[code + 1]]
+
+    def row(self, ent_type, ent_id):
+        """Node row of (ent_type, ent_id), -1 if the node is not in the graph"""
+        row_of = self._row_of[self.type2code[ent_type]]
+        if ent_id < 0 or ent_id >= len(row_of):
+            return -1
+        return int(row_of[ent_id])
+
+    def rows(self, ent_type, ent_ids):
+        """Vectorized version of row"""
+        row_of = self._row_of[self.type2code[ent_type]]
+        ent_ids = np.asarray(ent_ids, dtype=np.int64)
+        valid = (ent_ids >= 0) & (ent_ids < len(row_of))
+        out = np.full(ent_ids.shape, -1, dtype=np.int64)
+        out[valid] = row_of[ent_ids[valid]]
+        return out
+
+    def degrees(self):
+        return np.diff(self.indptr)
+
+    def adjacency(self, ent_type):
+        """
+        Per type arrays: offsets (relative to the first node of the type), neighbor ids, relation ids and
+        tail type codes of all the nodes of ent_type, neighbors of ids(ent_type)[i] are in offsets[i]:offsets[i+1]
+        """
+        code = self.type2code[ent_type]
+        start, end = self.type_start[code], self.type_start[code + 1]
+        offsets = self.indptr[start:end + 1] - self.indptr[start]
+        tails = self.indices[self.indptr[start]:self.indptr[end]]
+        return offsets, self.node_ids[tails], self.rels[self.indptr[start]:self.indptr[end]], self.node_types[tails]
+
+    def neighbors(self, ent_type, ent_id):
+        """Relation ids, tail type codes and tail ids of the edges of a node (empty if the node is missing)"""
+        row = self.row(ent_type, ent_id)
+        if row < 0:
+            return (np.empty(0, dtype=self.REL_DTYPE), np.empty(0, dtype=self.TYPE_DTYPE),
+                    np.empty(0, dtype=self.ID_DTYPE))
+        tails = self.indices[self.indptr[row]:self.indptr[row + 1]]
+        return self.rels[self.indptr[row]:self.indptr[row + 1]], self.node_types[tails], self.node_ids[tails]
+
+    def relations(self, ent_type, ent_id):
+        """Relation names of the edges leaving a node"""
+        rels, _, _ = self.neighbors(ent_type, ent_id)
+        return [self.rel_id2type[int(r)] for r in np.unique(rels)]
+
+    def tails(self, ent_type, ent_id, rel, tail_type):
+        rels, tail_types, tail_ids = self.neighbors(ent_type, ent_id)
+        mask = (rels == self.rel_type2id[rel]) & (tail_types == self.type2code[tail_type])
+        return tail_ids[mask]
+
+    def node_dict(self, row):
+        """Nested {relation: {tail type: [tail ids]}} representation of a node, as in the dict based aug_kg"""
+        tails = self.indices[self.indptr[row]:self.indptr[row + 1]]
+        rels = self.rels[self.indptr[row]:self.indptr[row + 1]]
+        node = dict()
+        if len(tails) == 0:
+            return node
+        tail_types, tail_ids = self.node_types[tails], self.node_ids[tails]
+        # Edges are sorted by relation and tail type, split them on the group boundaries
+        bounds = np.flatnonzero((rels[1:] != rels[:-1]) | (tail_types[1:] != tail_types[:-1])) + 1
+        for begin, end in zip(np.r_[0, bounds], np.r_[bounds, len(rels)]):
+            rel = self.rel_id2type[int(rels[begin])]
+            node.setdefault(rel, dict())[self.ent_types[tail_types[begin]]] = tail_ids[begin:end].tolist()
+        return node
+
+    def tokens(self):
+        """Entity and relation tokens of the graph, e.g. U12, P45, E900, R3"""
+        kg_tokens = []
+        for ent_type in self.ent_types:
+            prefix = get_token_ent_type(ent_type)
+            kg_tokens.extend(f'{prefix}{ent_id}' for ent_id in self.ids(ent_type).tolist())
+        kg_tokens.extend(f'{LiteralPath.rel_type}{rel_id}' for rel_id in np.unique(self.rels).tolist())
+        return list(dict.fromkeys(kg_tokens))
+
+    def as_dict_view(self):
+        return AugmentedKGView(self)
+
+
+class _TypeView(Mapping):
+    def __init__(self, graph, ent_type):
+        self.graph = graph
+        self.ent_type = ent_type
+
+    def __getitem__(self, ent_id):
+        row = self.graph.row(self.ent_type, ent_id)
+        if row < 0:
+            raise KeyError(ent_id)
+        return self.graph.node_dict(row)
+
+    def __contains__(self, ent_id):
+        return self.graph.row(self.ent_type, ent_id) >= 0
+
+    def __iter__(self):
+        return iter(self.graph.ids(self.ent_type).tolist())
+
+    def __len__(self):
+        return len(self.graph.ids(self.ent_type))
+
+
+class AugmentedKGView(Mapping):
+    """
+    Read-only aug_kg[type][id][rel][tail_type] -> list view over a TypedCSRGraph,
+    node dicts are built on access so callers can freely modify them.
+    """
+    def __init__(self, graph):
+        self.graph = graph
+        self._types = {ent_type: _TypeView(graph, ent_type) for ent_type in graph.types()}
+
+    def __getitem__(self, ent_type):
+        return self._types[ent_type]
+
+    def __iter__(self):
+        return iter(self._types)
+
+    def __len__(self):
+        return len(self._types)
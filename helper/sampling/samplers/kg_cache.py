@@ -0,0 +1,88 @@
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+
+from .csr_graph import TypedCSRGraph
+
+# Bump when the way the graph is built changes, older caches are then rebuilt
+CACHE_VERSION = 1
+
+
+def file_digest(filepath):
+    h = hashlib.blake2b(digest_size=16)
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _stat(filepath):
+    st = os.stat(filepath)
+    return [st.st_size, st.st_mtime_ns]
+
+
+class GraphCache:
+    """
+    On disk cache of a built TypedCSRGraph and of extra arrays (e.g. the kg triples), stored as .npy files
+    that are memory mapped on load. Entries are keyed on the dataset name and a fingerprint of the contents
+    of the source files, the fingerprint is only recomputed when the size or mtime of a source changes.
+    """
+    def __init__(self, cache_dir, name, sources):
+        self.cache_dir = cache_dir
+        self.name = name
+        self.sources = sorted(sources)
+
+    @property
+    def stamp_path(self):
+        return os.path.join(self.cache_dir, f'{self.name}.stamp.json')
+
+    def entry_dir(self, fingerprint):
+        return os.path.join(self.cache_dir, f'{self.name}-{fingerprint}')
+
+    def fingerprint(self):
+        """Fingerprint of the current sources, reusing the stamp when the files did not change"""
+        stats = {filepath: _stat(filepath) for filepath in self.sources}
+        if os.path.exists(self.stamp_path):
+            with open(self.stamp_path) as f:
+                stamp = json.load(f)
+            if stamp['version'] == CACHE_VERSION and stamp['stats'] == stats:
+                return stamp['fingerprint']
+        h = hashlib.blake2b(digest_size=8)
+        h.update(f'{CACHE_VERSION}-{self.name}'.encode())
+        for filepath in self.sources:
+            h.update(f'{os.path.basename(filepath)}:{file_digest(filepath)}'.encode())
+        fingerprint = h.hexdigest()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(self.stamp_path, 'w') as f:
+            json.dump(dict(version=CACHE_VERSION, fingerprint=fingerprint, stats=stats), f)
+        return fingerprint
+
+    def load(self):
+        """(graph, arrays) of the current sources, None if they are not cached"""
+        dirpath = self.entry_dir(self.fingerprint())
+        if not os.path.exists(os.path.join(dirpath, 'arrays.json')):
+            return None
+        with open(os.path.join(dirpath, 'arrays.json')) as f:
+            names = json.load(f)
+        arrays = {name: np.load(os.path.join(dirpath, f'{name}.npy'), mmap_mode='r') for name in names}
+        return TypedCSRGraph.load(dirpath), arrays
+
+    def save(self, graph, **arrays):
+        """Store the graph and the named arrays for the current sources, replacing older entries"""
+        fingerprint = self.fingerprint()
+        dirpath = self.entry_dir(fingerprint)
+        tmp_dirpath = dirpath + '.tmp'
+        shutil.rmtree(tmp_dirpath, ignore_errors=True)
+        graph.save(tmp_dirpath)
+        for name, arr in arrays.items():
+            np.save(os.path.join(tmp_dirpath, f'{name}.npy'), arr)
+        # Written last, an entry without it is incomplete
+        with open(os.path.join(tmp_dirpath, 'arrays.json'), 'w') as f:
+            json.dump(sorted(arrays), f)
+        for entry in os.listdir(self.cache_dir):
+            if entry.startswith(f'{self.name}-') and entry != os.path.basename(tmp_dirpath):
+                shutil.rmtree(os.path.join(self.cache_dir, entry), ignore_errors=True)
+        os.replace(tmp_dirpath, dirpath)
@@ -0,0 +1,117 @@
+import gc
+import math
+import multiprocessing as mp
+import random
+import time
+
+from tqdm import tqdm
+
+from helper.utils import SEED
+
+from .telemetry import ShardTelemetry
+
+# Read-only state shared with the sampling workers. It is filled in before the
+# pool is created, so with the 'fork' start method the workers inherit it
+# copy-on-write instead of receiving a pickled copy of the augmented KG per task.
+_SHARED = dict()
+
+
+def _init_worker(shared):
+    # Only used when 'fork' is not available: the state is pickled once per worker
+    _SHARED.update(shared)
+
+
+def shard_keys(keys, shard_size):
+    """
+    Split keys (users or LP heads) in contiguous shards of shard_size elements.
+    The split does not depend on the number of processes, so a shard always
+    covers the same keys whatever the size of the pool.
+    """
+    keys = list(keys)
+    n_shards = max(1, math.ceil(len(keys) / shard_size))
+    return [(shard_id, keys[shard_id * shard_size:(shard_id + 1) * shard_size]) for shard_id in range(n_shards)]
+
+
+def _sample_shard(shard):
+    shard_id, keys = shard
+    func, seed, kwargs = _SHARED['func'], _SHARED['seed'], _SHARED['kwargs']
+    telemetry = ShardTelemetry()
+    # Forked workers start from the same random state, reseed to get different and
+    # reproducible walks: one stream per key, or per shard for the batched samplers
+    if _SHARED['batched']:
+        random.seed(shard_seed(seed, shard_id))
+        key_paths = list(func(keys, telemetry=telemetry, **kwargs))
+    else:
+        key_paths = []
+        for key in keys:
+            random.seed(key_seed(seed, key))
+            key_paths.append((key, func(key, telemetry=telemetry, **kwargs)))
+    return shard_id, len(keys), key_paths, telemetry.to_dict()
+
+
+def shard_seed(seed, shard_id):
+    return f'{seed}-{shard_id}'
+
+
+def key_seed(seed, key):
+    return f'{seed}-key-{key}'
+
+
+def _stream_seed(seed, shard_id, batched):
+    # Seed of the shard recorded in the corpus manifest, keys have their own streams otherwise
+    return shard_seed(seed, shard_id) if batched else None
+
+
+def _write(writer, telemetry, shard_id, key_paths, shard_telemetry, seed, batched):
+    start = time.time()
+    writer.write_shard(key_paths, seed=_stream_seed(seed, shard_id, batched))
+    if telemetry is not None:
+        telemetry.add(shard_telemetry, io_seconds=time.time() - start)
+
+
+def sample_in_parallel(func, keys, writer, nproc=1, seed=SEED, shard_size=64, desc='Sampling paths', batched=False,
+                       telemetry=None, **kwargs):
+    """
+    Call func(key, **kwargs) -> paths for every key using a pool of nproc processes,
+    or func(keys, **kwargs) -> [(key, paths)] once per shard if batched.
+    Keys are grouped in shards that are scheduled dynamically on the workers,
+    kwargs (e.g. the augmented kg) are shared with the workers without being
+    pickled for every shard. The paths of every shard are streamed to writer
+    in shard order, whatever the number of processes, the shards already in
+    the writer (resumed jobs) are skipped.
+    func also receives a ShardTelemetry of its shard, the shard counters and the time
+    spent writing them are collected in telemetry (a SamplingTelemetry) if given.
+    """
+    shards = shard_keys(keys, shard_size)
+    n_keys = sum(len(shard) for _, shard in shards)
+    n_done = sum(len(shard) for _, shard in shards[:writer.n_key_shards])
+    shards = shards[writer.n_key_shards:]
+    if not shards:
+        return
+
+    _SHARED.clear()
+    _SHARED.update(func=func, seed=seed, batched=batched, kwargs=kwargs)
+    try:
+        with tqdm(total=n_keys, initial=n_done, desc=desc) as pbar:
+            if nproc is None or nproc <= 1:
+                for shard in shards:
+                    shard_id, n_shard_keys, key_paths, shard_telemetry = _sample_shard(shard)
+                    _write(writer, telemetry, shard_id, key_paths, shard_telemetry, seed, batched)
+                    pbar.update(n_shard_keys)
+                return
+
+            if 'fork' in mp.get_all_start_methods():
+                ctx, pool_kwargs = mp.get_context('fork'), dict()
+                # Move the objects created so far out of the gc generations, the
+                # collector would otherwise touch (and copy) the inherited pages
+                gc.freeze()
+            else:
+                ctx, pool_kwargs = mp.get_context(), dict(initializer=_init_worker, initargs=(dict(_SHARED),))
+            with ctx.Pool(min(nproc, len(shards)), **pool_kwargs) as pool:
+                # Shards still run as soon as a worker is free, imap only orders their results
+                for shard_id, n_shard_keys, key_paths, shard_telemetry in pool.imap(_sample_shard, shards):
+                    _write(writer, telemetry, shard_id, key_paths, shard_telemetry, seed, batched)
+                    pbar.update(n_shard_keys)
+    finally:
+        gc.unfreeze()
+        _SHARED.clear()
@@ -0,0 +1,65 @@
+import json
+
+import numpy as np
+
+SPECIAL_TOKENS = ["[UNK]", "[PAD]", "[CLS]", "[SEP]", "[MASK]", "[BOS]", "[EOS]"]
+TOKEN_DTYPE = np.int32
+
+
+def train_wordlevel_tokenizer(token_index_path, tokenizer_file):
+    """Train the WordLevel path tokenizer on the kg tokens of token_index_path and save it to tokenizer_file"""
+    from tokenizers import Tokenizer, models, pre_tokenizers, processors, trainers
+
+    tokenizer = Tokenizer(models.WordLevel(unk_token="[UNK]"))
+    tokenizer.pre_tokenizer = pre_tokenizers.WhitespaceSplit()
+    trainer = trainers.WordLevelTrainer(special_tokens=SPECIAL_TOKENS)
+
+    tokens = []
+    with open(token_index_path) as f:
+        for line in f:
+            tokens.append(line.rstrip())
+    tokenizer.train_from_iterator(tokens, trainer=trainer)
+    tokenizer.post_processor = processors.TemplateProcessing(
+        single="[BOS]:0 $A:0 [EOS]:0",
+        special_tokens=[("[BOS]", tokenizer.token_to_id("[BOS]")), ("[EOS]", tokenizer.token_to_id("[EOS]"))]
+    )
+    tokenizer.save(tokenizer_file)
+    return tokenizer
+
+
+class PathTokenEncoder:
+    """
+    Maps path strings to fixed width rows of token ids, [BOS] path [EOS] followed by [PAD],
+    with the ids of the WordLevel tokenizer file. Paths longer than width are truncated
+    before [EOS], as the tokenizer does with truncation=True and max_length=width.
+    """
+    def __init__(self, vocab, width, unk_token="[UNK]", pad_token="[PAD]", bos_token="[BOS]", eos_token="[EOS]"):
+        if width < 2:
+            raise ValueError(f'Width {width} cannot fit [BOS] and [EOS]')
+        self.vocab = vocab
+        self.width = width
+        self.unk_token_id = vocab[unk_token]
+        self.pad_token_id = vocab[pad_token]
+        self.bos_token_id = vocab[bos_token]
+        self.eos_token_id = vocab[eos_token]
+
+    @classmethod
+    def from_tokenizer_file(cls, tokenizer_file, width):
+        with open(tokenizer_file) as f:
+            model = json.load(f)['model']
+        return cls(model['vocab'], width, unk_token=model['unk_token'])
+
+    def encode(self, paths):
+        rows = np.full((len(paths), self.width), self.pad_token_id, dtype=TOKEN_DTYPE)
+        vocab, unk = self.vocab, self.unk_token_id
+        max_tokens = self.width - 2
+        for i, path in enumerate(paths):
+            ids = [vocab.get(token, unk) for token in path.split()[:max_tokens]]
+            rows[i, 0] = self.bos_token_id
+            rows[i, 1:len(ids) + 1] = ids
+            rows[i, len(ids) + 1] = self.eos_token_id
+        return rows
+
+    def special_token_ids(self):
+        return dict(unk_token_id=self.unk_token_id, pad_token_id=self.pad_token_id,
+                    bos_token_id=self.bos_token_id, eos_token_id=self.eos_token_id)
@@ -0,0 +1,257 @@
+import gzip
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from .path_encoder import TOKEN_DTYPE
+
+MANIFEST_SUFFIX = '.manifest.json'
+JOURNAL_SUFFIX = '.journal.jsonl'
+HASHES_SUFFIX = '.hashes.bin'
+
+
+def path_hash(path):
+    """Stable 64-bit hash of a path string, used for the corpus level dedup"""
+    return int.from_bytes(hashlib.blake2b(path.encode(), digest_size=8).digest(), 'little')
+
+
+def path_n_hops(path):
+    # Paths alternate entities and relations: e0 r1 e1 ... rk ek
+    return path.count(' ') // 2
+
+
+def read_manifest(corpus_dir, corpus_name):
+    """Manifest of a sampled corpus, None if the corpus is a plain text file"""
+    manifest_path = os.path.join(corpus_dir, corpus_name + MANIFEST_SUFFIX)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def corpus_files(corpus_dir, corpus_name):
+    """
+    Text files of a sampled corpus: the shards listed in its manifest if there is one,
+    otherwise the single plain text file {corpus_name}.txt
+    """
+    manifest = read_manifest(corpus_dir, corpus_name)
+    if manifest is None:
+        return [os.path.join(corpus_dir, corpus_name + '.txt')]
+    if manifest.get('format', 'text') != 'text':
+        raise ValueError(f'{corpus_name} is a pre-tokenized corpus, load it with load_token_shards')
+    return [os.path.join(corpus_dir, shard['file']) for shard in manifest['shards']]
+
+
+def iter_paths(filepaths):
+    """Stream the paths of (possibly gzip compressed) text corpus files, one line at a time"""
+    for filepath in filepaths:
+        with (gzip.open(filepath, 'rt') if filepath.endswith('.gz') else open(filepath)) as f:
+            for line in f:
+                path = line.rstrip('\n')
+                if path:
+                    yield path
+
+
+def corpus_complete(corpus_dir, corpus_name):
+    """Whether a sampling job wrote its manifest and has nothing left to resume"""
+    return (os.path.exists(os.path.join(corpus_dir, corpus_name + MANIFEST_SUFFIX)) and
+            not os.path.exists(os.path.join(corpus_dir, corpus_name + JOURNAL_SUFFIX)))
+
+
+def load_token_shards(corpus_dir, corpus_name):
+    """Read-only memory maps of the (n_paths, width) token id shards of a pre-tokenized corpus and its manifest"""
+    manifest = read_manifest(corpus_dir, corpus_name)
+    if manifest is None or manifest.get('format') != 'int32':
+        raise FileNotFoundError(f'No pre-tokenized corpus {corpus_name} in {corpus_dir}')
+    shards = [np.memmap(os.path.join(corpus_dir, shard['file']), dtype=TOKEN_DTYPE, mode='r',
+                        shape=(shard['n_paths'], manifest['width']))
+              for shard in manifest['shards'] if shard['n_paths'] > 0]
+    return shards, manifest
+
+
+class PathCorpusWriter:
+    """
+    Streams the sampled paths into n_shards (optionally gzip compressed) corpus files, dropping the paths
+    already written, and records counts, hop lengths and sampling seeds of each shard in a manifest.
+    Key shards are assigned round robin to the corpus shards, so the output only depends on the order
+    in which the key shards are written.
+    With an encoder (PathTokenEncoder) the shards are raw int32 (n_paths, encoder.width) token id arrays
+    that can be memory mapped with load_token_shards, instead of text.
+    Every written key shard is recorded in a journal, with resume=True an interrupted job restarts after
+    the last journaled key shard and produces the same corpus as an uninterrupted one.
+    """
+    def __init__(self, corpus_dir, corpus_name, n_shards=1, compress=False, dedup=True, meta=None, encoder=None,
+                 resume=False):
+        if encoder is not None and compress:
+            raise ValueError('Pre-tokenized shards are memory mapped and cannot be compressed')
+        self.corpus_dir = corpus_dir
+        self.corpus_name = corpus_name
+        self.n_shards = n_shards
+        self.compress = compress
+        self.encoder = encoder
+        self.dedup = dedup
+        self.meta = dict(meta or dict())
+        self.n_key_shards = 0
+        self._seen = set()
+        self._shards = [dict(file=self.shard_filename(shard_id), n_paths=0, n_duplicates=0, n_keys=0, hops=dict(),
+                             seeds=[]) for shard_id in range(n_shards)]
+        os.makedirs(corpus_dir, exist_ok=True)
+
+        journal = self._read_journal() if resume else None
+        if journal is not None:
+            self._restore(*journal)
+        else:
+            for shard in self._shards:
+                open(os.path.join(corpus_dir, shard['file']), 'wb').close()
+            open(self.hashes_path, 'wb').close()
+            with open(self.journal_path, 'w') as f:
+                f.write(json.dumps(self._header()) + '\n')
+        if os.path.exists(self.manifest_path):
+            os.remove(self.manifest_path)
+        self._files = [open(os.path.join(corpus_dir, shard['file']), 'ab') for shard in self._shards]
+        self._hashes = open(self.hashes_path, 'ab')
+        self._journal = open(self.journal_path, 'a')
+
+    def shard_filename(self, shard_id):
+        if self.encoder is not None:
+            ext = '.bin'
+        else:
+            ext = '.txt.gz' if self.compress else '.txt'
+        if self.n_shards == 1:
+            return self.corpus_name + ext
+        return f'{self.corpus_name}-{shard_id:05d}-of-{self.n_shards:05d}{ext}'
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.corpus_dir, self.corpus_name + MANIFEST_SUFFIX)
+
+    @property
+    def journal_path(self):
+        return os.path.join(self.corpus_dir, self.corpus_name + JOURNAL_SUFFIX)
+
+    @property
+    def hashes_path(self):
+        return os.path.join(self.corpus_dir, self.corpus_name + HASHES_SUFFIX)
+
+    def _header(self):
+        return dict(self.meta, n_shards=self.n_shards, compress=self.compress, dedup=self.dedup,
+                    width=None if self.encoder is None else self.encoder.width)
+
+    def _read_journal(self):
+        """Header and complete entries of the journal, None if there is nothing to resume"""
+        if not os.path.exists(self.journal_path):
+            return None
+        with open(self.journal_path) as f:
+            lines = f.read().split('\n')
+        # The last line is either empty or an entry cut by the interruption
+        header, *entries = [json.loads(line) for line in lines[:-1]]
+        if header != json.loads(json.dumps(self._header())):
+            raise ValueError(f'Cannot resume {self.corpus_name}, it was sampled with different settings: {header}')
+        return header, entries
+
+    def _restore(self, header, entries):
+        # Replay the journaled key shards
+        for entry in entries:
+            self._apply(entry)
+        # Drop what was written after the last journaled key shard
+        sizes = [0] * self.n_shards
+        for entry in entries:
+            sizes[entry['shard']] = entry['size']
+        for shard, size in zip(self._shards, sizes):
+            with open(os.path.join(self.corpus_dir, shard['file']), 'ab') as f:
+                f.truncate(size)
+        n_hashes = entries[-1]['n_hashes'] if entries else 0
+        with open(self.hashes_path, 'ab') as f:
+            f.truncate(n_hashes * 8)
+        self._seen = set(np.fromfile(self.hashes_path, dtype=np.uint64).tolist())
+        with open(self.journal_path, 'w') as f:
+            f.writelines(json.dumps(line) + '\n' for line in [header] + entries)
+
+    def write_shard(self, key_paths, seed=None):
+        """Write the (key, paths) pairs sampled for a shard of keys, returns the number of paths written"""
+        shard_id = self.n_key_shards % self.n_shards
+        fp = self._files[shard_id]
+        entry = dict(shard=shard_id, seed=seed, n_keys=0, n_paths=0, n_duplicates=0, hops=dict())
+        written, hashes = [], []
+        for _, paths in key_paths:
+            entry['n_keys'] += 1
+            for path in paths:
+                if self.dedup:
+                    h = path_hash(path)
+                    if h in self._seen:
+                        entry['n_duplicates'] += 1
+                        continue
+                    self._seen.add(h)
+                    hashes.append(h)
+                n_hops = str(path_n_hops(path))
+                entry['hops'][n_hops] = entry['hops'].get(n_hops, 0) + 1
+                written.append(path)
+        entry['n_paths'] = len(written)
+
+        if self.encoder is not None:
+            data = self.encoder.encode(written).tobytes()
+        else:
+            data = ''.join(path + '\n' for path in written).encode('utf-8')
+            if self.compress:
+                # One gzip member per key shard, a multi member file is still a valid gzip file
+                data = gzip.compress(data, mtime=0)
+        fp.write(data)
+        fp.flush()
+        self._hashes.write(np.asarray(hashes, dtype=np.uint64).tobytes())
+        self._hashes.flush()
+        # Journal last, a key shard only counts as written once its entry is complete
+        entry.update(size=fp.tell(), n_hashes=len(self._seen))
+        self._journal.write(json.dumps(entry) + '\n')
+        self._journal.flush()
+
+        self._apply(entry)
+        return len(written)
+
+    def _apply(self, entry):
+        """Add the counts of a written key shard to its corpus shard"""
+        shard = self._shards[entry['shard']]
+        for k in ['n_keys', 'n_paths', 'n_duplicates']:
+            shard[k] += entry[k]
+        for n_hops, count in entry['hops'].items():
+            shard['hops'][n_hops] = shard['hops'].get(n_hops, 0) + count
+        if entry['seed'] is not None:
+            shard['seeds'].append(entry['seed'])
+        self.n_key_shards += 1
+
+    def _close_files(self):
+        for fp in self._files + [self._hashes, self._journal]:
+            fp.close()
+
+    def close(self):
+        self._close_files()
+        shards = [dict(shard, hops=dict(sorted(shard['hops'].items(), key=lambda kv: int(kv[0]))))
+                  for shard in self._shards]
+        if self.encoder is not None:
+            corpus_format = dict(format='int32', width=self.encoder.width, **self.encoder.special_token_ids())
+        else:
+            corpus_format = dict(format='text', compressed=self.compress)
+        manifest = dict(self.meta,
+                        name=self.corpus_name,
+                        **corpus_format,
+                        n_paths=sum(shard['n_paths'] for shard in shards),
+                        n_duplicates=sum(shard['n_duplicates'] for shard in shards),
+                        n_keys=sum(shard['n_keys'] for shard in shards),
+                        shards=shards)
+        with open(self.manifest_path, 'w') as f:
+            json.dump(manifest, f, indent=2)
+        # The job is complete, nothing left to resume
+        os.remove(self.journal_path)
+        os.remove(self.hashes_path)
+        return manifest
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            # Leave the partial corpus and its journal, without a manifest
+            self._close_files()
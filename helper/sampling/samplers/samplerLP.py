@@ -1,30 +1,34 @@
 import os
 import random
-from collections import defaultdict
 
 import numpy as np
 import pandas as pd
-from tqdm import tqdm
 from helper.datasets.KARSDataset import KARSDataset
-from helper.knowledge_graphs._kg_utils import (KG_RELATION,
+from helper.knowledge_graphs.kg_utils import (KG_RELATION,
                                                MAIN_PRODUCT_INTERACTION)
 from helper.knowledge_graphs.kg_macros import ENTITY, PRODUCT, USER
 from helper.utils import get_data_dir
 
+from .batched_walk import (BatchedRandomWalker, policy_report,
+                           random_walk_batched)
 from .constants import LiteralPath
+from .csr_graph import TypedCSRGraph
+from .kg_cache import GraphCache
+from .parallel import sample_in_parallel
+from .telemetry import ShardTelemetry
 
 
-def random_walk_typified(head, dataset_name, kg, items, n_hop, KG2T, R2T, USER_ENT, PROD_ENT, EXT_ENT, U2P_REL, logdir,
+def random_walk_typified(head, dataset_name, kg, items, n_hop, KG2T, R2T, USER_ENT, PROD_ENT, EXT_ENT, U2P_REL,
                          ignore_rels=set(), max_paths=None, itemset_type='inner', REL_TYPE2ID=None,
                          collaborative=True,
                          num_beams=10, scorer=None,
                          dataset_info=None,
                          with_type=True,
                          start_ent_type=ENTITY,
-                         end_ent_type=PRODUCT):
-    dirpath = logdir
-    os.makedirs(dirpath, exist_ok=True)
-
+                         end_ent_type=PRODUCT,
+                         telemetry=None):
+    if telemetry is None:
+        telemetry = ShardTelemetry()
     REL_TYPE2ID[U2P_REL] = LiteralPath.interaction_rel_id
     unique_path_set = set()
 
@@ -36,25 +40,29 @@ def random_walk_typified(head, dataset_name, kg, items, n_hop, KG2T, R2T, USER_E
             path = [str(x) for x in path]
             path_str = ' '.join(path)
             if path_str in unique_path_set:
+                telemetry.duplicate(head)
                 return False
             else:
                 unique_path_set.add(path_str)
-            fp.write(path_str + '\n')
+            paths.append(path_str)
             return True
+        telemetry.visit(cur_ent_t)
         if cur_ent_id not in kg[cur_ent_t]:
+            telemetry.dead_end(cur_ent_t)
             return False
-        valid_rels = list(kg[cur_ent_t][cur_ent_id].keys())
+        node = kg[cur_ent_t][cur_ent_id]
+        valid_rels = list(node.keys())
         random.shuffle(valid_rels)
         for rel in valid_rels:
             if rel in ignore_rels:
                 continue
             rel_id = REL_TYPE2ID[rel]
-            candidate_types = kg[cur_ent_t][cur_ent_id][rel]
+            candidate_types = list(node[rel])
             random.shuffle(candidate_types)
             for cand_type in candidate_types:
                 if not collaborative and cand_type == USER_ENT:
                     continue
-                candidates = kg[cur_ent_t][cur_ent_id][rel][cand_type]
+                candidates = node[rel][cand_type]
 
                 if cur_hop == n_hop - 1:
                     cache_key = (head, rel, cand_type)
@@ -74,7 +82,8 @@ def random_walk_typified(head, dataset_name, kg, items, n_hop, KG2T, R2T, USER_E
                     else:
                         path.append(LiteralPath.fw_rel)
                 path.append(f'{LiteralPath.rel_type}{rel_id}')
-                random.shuffle(candidates)
+                # aug_kg is shared copy-on-write by the sampling workers, do not shuffle it in place
+                candidates = random.sample(candidates, len(candidates))
 
                 for next_ent_id in candidates:
                     if next_ent_id == prev_ent_id and prev_ent_t == cand_type:
@@ -101,6 +110,7 @@ def random_walk_typified(head, dataset_name, kg, items, n_hop, KG2T, R2T, USER_E
                     else:
                         cur_attempts[0] += 1
                     if cur_attempts[0] >= max_attempts:
+                        telemetry.exhausted += 1
                         return True
                     if with_type:
                         path.pop()
@@ -109,71 +119,78 @@ def random_walk_typified(head, dataset_name, kg, items, n_hop, KG2T, R2T, USER_E
                 if with_type:
                     path.pop()
                 path.pop()
+        # No completed path through this node
+        telemetry.dead_end(cur_ent_t)
         return False
 
     non_prod_entities = set([EXT_ENT])
-    with open(os.path.join(dirpath, f'paths_{head}.txt'), 'w') as fp:
-        cnt = 0
+    paths = []
+    cnt = 0
 
-        while cnt < max_paths:
+    while cnt < max_paths:
 
-            if start_ent_type is None:
+        if start_ent_type is None:
 
-                cur_start_ent_type = random.choice([PRODUCT, ENTITY])
+            cur_start_ent_type = random.choice([PRODUCT, ENTITY])
 
-                if cur_start_ent_type == ENTITY:
-                    non_ext_entity = set([PRODUCT])
-                    candidate_ext_ent_types = [x for x in kg if x not in non_ext_entity]
-                    cur_start_ent_type = random.choice(candidate_ext_ent_types)
+            if cur_start_ent_type == ENTITY:
+                non_ext_entity = set([PRODUCT])
+                candidate_ext_ent_types = [x for x in kg if x not in non_ext_entity]
+                cur_start_ent_type = random.choice(candidate_ext_ent_types)
 
-                id = random.choice(list(kg[cur_start_ent_type]))
+            id = random.choice(list(kg[cur_start_ent_type]))
+        else:
+            cur_start_ent_type = start_ent_type
+            id = head
+        if n_hop is None:
+            valid_hop_range = []
+            if end_ent_type is None:
+                valid_hop_range = [i for i in range(1, 50 + 1)]
             else:
-                cur_start_ent_type = start_ent_type
-                id = head
-            if n_hop is None:
-                valid_hop_range = []
-                if end_ent_type is None:
-                    valid_hop_range = [i for i in range(1, 50 + 1)]
-                else:
 
-                    if (cur_start_ent_type in non_prod_entities and end_ent_type not in non_prod_entities) or \
-                            (cur_start_ent_type not in non_prod_entities and end_ent_type in non_prod_entities):
-                        # only odd hops
-                        valid_hop_range = [i for i in range(1, 50 + 1, 2)]
-                    else:
-                        # only even hops
-                        valid_hop_range = [i for i in range(2, 50 + 1, 2)]
+                if (cur_start_ent_type in non_prod_entities and end_ent_type not in non_prod_entities) or \
+                        (cur_start_ent_type not in non_prod_entities and end_ent_type in non_prod_entities):
+                    # only odd hops
+                    valid_hop_range = [i for i in range(1, 50 + 1, 2)]
+                else:
+                    # only even hops
+                    valid_hop_range = [i for i in range(2, 50 + 1, 2)]
 
-                cur_n_hop = random.choice(valid_hop_range)
-            else:
-                cur_n_hop = n_hop
+            cur_n_hop = random.choice(valid_hop_range)
+        else:
+            cur_n_hop = n_hop
 
-            path = []
-            cur_hop = 0
+        path = []
+        cur_hop = 0
 
-            if cur_start_ent_type == PROD_ENT:
-                prefix = LiteralPath.prod
-                type_prefix = LiteralPath.prod_type
-            else:
-                prefix = LiteralPath.ent
-                type_prefix = LiteralPath.ent_type
-            if with_type:
-                path.append(prefix)
+        if cur_start_ent_type == PROD_ENT:
+            prefix = LiteralPath.prod
+            type_prefix = LiteralPath.prod_type
+        else:
+            prefix = LiteralPath.ent
+            type_prefix = LiteralPath.ent_type
+        if with_type:
+            path.append(prefix)
 
-            path.append(f'{type_prefix}{id}')
+        path.append(f'{type_prefix}{id}')
 
-            prev_ent_t = cur_start_ent_type
-            cur_ent_t = cur_start_ent_type
+        prev_ent_t = cur_start_ent_type
+        cur_ent_t = cur_start_ent_type
 
-            dfs(head, cur_start_ent_type, cur_start_ent_type, id, id, cur_hop, path, -100, cur_n_hop, cur_start_ent_type,
-                end_ent_type, [0])
-            cnt += 1
+        n_paths, cur_attempts = len(paths), [0]
+        dfs(head, cur_start_ent_type, cur_start_ent_type, id, id, cur_hop, path, -100, cur_n_hop, cur_start_ent_type,
+            end_ent_type, cur_attempts)
+        telemetry.walk(head, cur_n_hop)
+        telemetry.accept(head, cur_n_hop, len(paths) - n_paths)
+        telemetry.backtracks += cur_attempts[0]
+        cnt += 1
+    return paths
 
 
 class KGSamplerLinkPrediction:
     TOKEN_INDEX_FILE = 'token_index.txt'
 
-    def __init__(self, dataset_name: str, save_dir='statistics', data_dir=None):
+    def __init__(self, dataset_name: str, save_dir='statistics', data_dir=None, use_cache=True):
         path = get_data_dir(dataset_name)
         os.makedirs(save_dir, exist_ok=True)
         self.save_dir = os.path.join(save_dir, dataset_name)
@@ -205,96 +222,75 @@ class KGSamplerLinkPrediction:
 
         self.items =self.load_items(item_list_file)
 
-        # kg in h,r,t format
-        self.kg, self.kg_np =self.load_kg(kg_filepath)
-        self.graph_level_stats()
-        # self.load_augmented_kg()
-        self.load_augmented_kg_V2()
-
-    def load_augmented_kg_V2(self):
+        # The built graph is cached next to the dataset, keyed on the files it is built from
+        kg_cache = GraphCache(os.path.join(path, 'cache'), f'aug_kg_lp_{dataset_name}',
+                              [kg_filepath, eid_mapping_filepath, pid_mapping_filepath, rel_mapping_filepath])
+        cached = kg_cache.load() if use_cache else None
+        if cached is not None:
+            self.csr_kg, arrays = cached
+            self.kg_np = arrays['kg']
+            self.graph_level_stats()
+            self.aug_kg = self.csr_kg.as_dict_view()
+            if not os.path.exists(self.token_index_filepath):
+                self.build_token_index()
+        else:
+            # kg in h,r,t format
+            self.kg_np = self.load_kg(kg_filepath)
+            self.graph_level_stats()
+            # self.load_augmented_kg()
+            # self.load_augmented_kg_V2()
+            self.load_augmented_kg_csr()
+            if use_cache:
+                kg_cache.save(self.csr_kg, kg=self.kg_np)
+
+    def walk_policy_report(self, n_keys=256, ignore_rels=set(), max_hop=None, max_paths=4000, itemset_type='inner',
+                           collaborative=True, start_ent_type=ENTITY, end_ent_type=PRODUCT, relation_weights=None):
+        """Walks and draws per sampled path of every walk policy on the first n_keys keys"""
+        return policy_report(self.csr_kg, sorted(self.eids)[:n_keys],
+                             walker_kwargs=dict(ignore_rels=ignore_rels, collaborative=collaborative,
+                                                non_prod_entities=(ENTITY,), relation_weights=relation_weights),
+                             start_ent_type=start_ent_type, n_hop=max_hop, max_paths=max_paths,
+                             end_ent_type=end_ent_type, itemset_type=itemset_type, start_choices=(PRODUCT, ENTITY))
+
+    def load_augmented_kg_csr(self):
         R2T = self.rel_id2type
         KG2T = KG_RELATION[self.dataset_name]
         print(R2T)
 
         PROD_ENT, U2P_REL = MAIN_PRODUCT_INTERACTION[self.dataset_name]
-        self.aug_kg = dict()
-        self.aug_kg[PROD_ENT] = dict()
-        self.aug_kg[ENTITY] = dict()
-
-        for h in self.eids:
-            if h in set(self.pid2eid.values()):
-                self.aug_kg[PROD_ENT][h] = dict()
-            else:
-                self.aug_kg[ENTITY][h] = dict()
-
-        for h in self.eids:
-            if h not in self.kg: continue
-            for rel, tails in self.kg[h].items():
-                for t in tails:
-                    # get tail entity type, uniquely determined by head_ent + rel_type
-                    # kg is composed only of (h, REL, t)  where either of (h,t) can be PROD or EXTERNAL_ENT
-                    TAIL_ENT = KG2T[PROD_ENT][R2T[rel]]
-
-                    h1, t1 = h, t
-                    # to simplify the code, assume h is PROD, if it is not, swap it with the tail
-                    if t in self.aug_kg[PROD_ENT]:
-                        # swap them , to have product as head, just to reduce amount of code below
-                        h1, t1 = t, h
-                    # print(rel, h1, t1, '::::',h,t)
-                    if h1 not in self.aug_kg[PROD_ENT]:
-                        self.aug_kg[PROD_ENT][h1] = dict()
-                    if R2T[rel] not in self.aug_kg[PROD_ENT][h1]:
-                        self.aug_kg[PROD_ENT][h1][R2T[rel]] = defaultdict(list)
-
-                    if TAIL_ENT not in self.aug_kg:
-                        self.aug_kg[TAIL_ENT] = dict()
-                    if t1 not in self.aug_kg[TAIL_ENT]:
-                        self.aug_kg[TAIL_ENT][t1] = dict()
-
-                    if R2T[rel] not in self.aug_kg[TAIL_ENT][t1]:
-                        self.aug_kg[TAIL_ENT][t1][R2T[rel]] = defaultdict(list)
-
-                    self.aug_kg[PROD_ENT][h1][R2T[rel]][TAIL_ENT].append(t1)
-                    self.aug_kg[TAIL_ENT][t1][R2T[rel]][PROD_ENT].append(h1)
+        ent_types = [PROD_ENT, ENTITY] + sorted(set(KG2T[PROD_ENT].values()) - {USER, PROD_ENT})
+        type2code = {ent_type: code for code, ent_type in enumerate(ent_types)}
+
+        # every eid is a node, either a product or a generic entity
+        eids = np.fromiter(self.eids, dtype=np.int64, count=len(self.eids))
+        product_eids = np.fromiter(set(self.pid2eid.values()), dtype=np.int64)
+        is_product = np.isin(eids, product_eids)
+
+        # kg is composed only of (h, REL, t) where either of (h,t) can be PROD or EXTERNAL_ENT
+        # to simplify the code, assume h is PROD, if it is not, swap it with the tail
+        h, r, t = self.kg_np[:, 0], self.kg_np[:, 1], self.kg_np[:, 2]
+        swap = np.isin(t, eids[is_product])
+        h, t = np.where(swap, t, h), np.where(swap, h, t)
+        # tail entity type, uniquely determined by head_ent + rel_type
+        rel_tail_type = np.zeros(self.n_relations, dtype=np.int64)
+        for rel_id in range(self.n_relations):
+            rel_tail_type[rel_id] = type2code[KG2T[PROD_ENT][R2T[rel_id]]]
+
+        self.csr_kg = TypedCSRGraph.from_triples(
+            ent_types, R2T,
+            head_types=np.full(len(h), type2code[PROD_ENT]), head_ids=h, rels=r,
+            tail_types=rel_tail_type[r], tail_ids=t,
+            nodes={type2code[PROD_ENT]: eids[is_product], type2code[ENTITY]: eids[~is_product]})
+        # aug_kg[type][id][rel][tail_type] -> list of tail ids, backed by csr_kg
+        self.aug_kg = self.csr_kg.as_dict_view()
         print('Created augmented kg')
         print('Creating token index')
         self.build_token_index()
         print('Created token index')
 
     def build_token_index(self):
-
-        aug_kg = self.aug_kg
-        REL_TYPE2ID = self.rel_type2id
-        kg_tokens = set()
-
-        def get_token_ent_type(ent_type):
-            token_type = None
-            if ent_type == USER:
-                token_type = LiteralPath.user_type
-            elif ent_type == PRODUCT:
-                token_type = LiteralPath.prod_type
-            else:
-                token_type = LiteralPath.ent_type
-            return token_type
-
-        for head_type in aug_kg:
-
-            h_token_type = get_token_ent_type(head_type)
-
-            for head_id in aug_kg[head_type]:
-                head_token = f'{h_token_type}{head_id}'
-                kg_tokens.add(head_token)
-                for rel in aug_kg[head_type][head_id]:
-                    rel_id = REL_TYPE2ID[rel]
-                    rel_token = f'{LiteralPath.rel_type}{rel_id}'
-                    kg_tokens.add(rel_token)
-                    for tail_type in aug_kg[head_type][head_id][rel]:
-                        t_token_type = get_token_ent_type(tail_type)
-                        for tail_id in aug_kg[head_type][head_id][rel][tail_type]:
-                            tail_token = f'{t_token_type}{tail_id}'
-                            kg_tokens.add(tail_token)
         with open(self.token_index_filepath, 'w') as f:
-            for token in kg_tokens:
+            for token in self.csr_kg.tokens():
                 f.write(token + '\n')
 
     def load_items(self,item_file):
@@ -311,32 +307,18 @@ class KGSamplerLinkPrediction:
         return item_ids
 
     def deg(self):
-        degs = defaultdict(int)
-        for h, rels in self.kg.items():
-            for r, tails in rels.items():
-                for tail in tails:
-                    degs[h] += 1
-        return degs
-
-    def load_kg(self,kg_filepath, undirected=True):
-        kg = defaultdict()
+        degs = np.bincount(self.kg_np[:, 0], minlength=self.n_entities) + \
+            np.bincount(self.kg_np[:, 2], minlength=self.n_entities)
+        return {h: int(deg) for h, deg in enumerate(degs) if deg > 0}
+
+    def load_kg(self,kg_filepath):
         # kg_np = np.loadtxt(kg_filepath, np.uint32)
         kg_np = pd.read_csv(kg_filepath, sep='\t').to_numpy()
         print(kg_np.shape)
         kg_np = np.unique(kg_np, axis=0)
         print(kg_np.shape)
-        for triple in kg_np:
-            h, r, t = triple
-            if h not in kg:
-                kg[h] = defaultdict(set)
-            if t not in kg:
-                kg[t] = defaultdict(set)
-            assert h != t, 'Self loop detected'
-            kg[h][r].add(t)
-            if undirected:
-                kg[t][r].add(h)
-
-        return kg, kg_np
+        assert (kg_np[:, 0] != kg_np[:, 2]).all(), 'Self loop detected'
+        return kg_np
 
     def graph_level_stats(self):
         self.n_relations, self.n_entities, self.n_triples = 0, 0, 0
@@ -344,34 +326,53 @@ class KGSamplerLinkPrediction:
         self.n_entities = max(max(self.kg_np[:, 0]), max(self.kg_np[:, 2])) + 1
         self.n_triples = len(self.kg_np)
 
-    def random_walk_sampler(self, ignore_rels=set(), max_hop=None, max_paths=4000, logdir='paths_rand_walk',
+    def random_walk_sampler(self, writer, ignore_rels=set(), max_hop=None, max_paths=4000,
                             itemset_type='inner',
                             collaborative=True,
                             nproc=8,
                             with_type=True,
                             start_ent_type=ENTITY,
-                            end_ent_type=PRODUCT):
+                            end_ent_type=PRODUCT,
+                            engine='dfs',
+                            walk_policy='uniform',
+                            relation_weights=None,
+                            telemetry=None):
         PROD_ENT, U2P_REL = MAIN_PRODUCT_INTERACTION[self.dataset_name]
 
+        if engine == 'batched':
+            # walks of a whole shard of heads advance together on the csr graph
+            walker = BatchedRandomWalker(self.csr_kg, ignore_rels=ignore_rels, collaborative=collaborative,
+                                         non_prod_entities=(ENTITY,),
+                                         policy=walk_policy, relation_weights=relation_weights)
+            sample_in_parallel(random_walk_batched, sorted(self.eids), writer, nproc=nproc, batched=True,
+                               telemetry=telemetry,
+                               walker=walker,
+                               start_ent_type=start_ent_type,
+                               end_ent_type=end_ent_type,
+                               n_hop=max_hop,
+                               max_paths=max_paths,
+                               itemset_type=itemset_type,
+                               start_choices=(PRODUCT, ENTITY))
+            return
+        if walk_policy != 'uniform':
+            raise ValueError(f'The {walk_policy} walk policy needs the batched engine')
+
         func = random_walk_typified
 
         # undirected knowledge graph hypotesis (for each relation, there exists its inverse)
-
-        # with mp.Pool(nproc) as pool:
-        #    pool.starmap( functools.partial(func,
-        for eid in tqdm(self.eids):
-            func(eid,
-                 dataset_name=self.dataset_name,
-                 kg=self.aug_kg,
-                 items=self.items, n_hop=max_hop, KG2T=self.kg2t, R2T=self.rel_id2type,
-                 USER_ENT=USER, PROD_ENT=PROD_ENT, EXT_ENT=ENTITY,
-                 U2P_REL=U2P_REL,
-                 logdir=os.path.join(self.save_dir, logdir),
-                 ignore_rels=ignore_rels,
-                 max_paths=max_paths,
-                 itemset_type=itemset_type,
-                 REL_TYPE2ID=self.rel_type2id,
-                 collaborative=collaborative,
-                 with_type=with_type,
-                 start_ent_type=start_ent_type,
-                 end_ent_type=end_ent_type)
+        # heads are split in shards sampled by nproc workers sharing the augmented kg
+        sample_in_parallel(func, sorted(self.eids), writer, nproc=nproc,
+                           telemetry=telemetry,
+                           dataset_name=self.dataset_name,
+                           kg=self.aug_kg,
+                           items=self.items, n_hop=max_hop, KG2T=self.kg2t, R2T=self.rel_id2type,
+                           USER_ENT=USER, PROD_ENT=PROD_ENT, EXT_ENT=ENTITY,
+                           U2P_REL=U2P_REL,
+                           ignore_rels=ignore_rels,
+                           max_paths=max_paths,
+                           itemset_type=itemset_type,
+                           REL_TYPE2ID=self.rel_type2id,
+                           collaborative=collaborative,
+                           with_type=with_type,
+                           start_ent_type=start_ent_type,
+                           end_ent_type=end_ent_type)
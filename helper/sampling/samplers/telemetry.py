@@ -0,0 +1,112 @@
+import csv
+import json
+import os
+import time
+from collections import Counter, defaultdict
+
+
+class ShardTelemetry:
+    """
+    Counters of a shard of keys, filled by the sampling functions in the workers.
+    A walk is an attempt to sample a path, it is accepted, rejected as a duplicate or lost
+    (dead end, attempt budget, item set). Visits and dead ends are counted per entity type
+    of the node being expanded, a dead end is a visited node from which no path was completed.
+    """
+    def __init__(self):
+        self.start = time.time()
+        self.keys = defaultdict(lambda: [0, 0, 0])
+        self.hop_walks = Counter()
+        self.hop_paths = Counter()
+        self.visits = Counter()
+        self.dead_ends = Counter()
+        self.backtracks = 0
+        self.exhausted = 0
+
+    def walk(self, key, n_hop, n=1):
+        self.keys[key][0] += n
+        self.hop_walks[n_hop] += n
+
+    def accept(self, key, n_hop, n=1):
+        self.keys[key][1] += n
+        self.hop_paths[n_hop] += n
+
+    def duplicate(self, key, n=1):
+        self.keys[key][2] += n
+
+    def visit(self, ent_type, n=1):
+        self.visits[ent_type] += n
+
+    def dead_end(self, ent_type, n=1):
+        self.dead_ends[ent_type] += n
+
+    def to_dict(self):
+        return dict(worker=os.getpid(), seconds=time.time() - self.start, keys=dict(self.keys),
+                    hop_walks=dict(self.hop_walks), hop_paths=dict(self.hop_paths), visits=dict(self.visits),
+                    dead_ends=dict(self.dead_ends), backtracks=self.backtracks, exhausted=self.exhausted)
+
+
+def _rate(num, den):
+    return num / den if den else 0.
+
+
+class SamplingTelemetry:
+    """Aggregates the shard counters of a sampling job and writes them as json and csv next to the corpus"""
+    def __init__(self):
+        self.start = time.time()
+        self.shards = []
+        self.io_seconds = 0.
+
+    def add(self, shard, io_seconds=0.):
+        self.shards.append(shard)
+        self.io_seconds += io_seconds
+
+    def summary(self):
+        wall = time.time() - self.start
+        keys = [counts for shard in self.shards for counts in shard['keys'].values()]
+        walks, paths, duplicates = (sum(counts[i] for counts in keys) for i in range(3))
+        visits, dead_ends, hop_walks, hop_paths = Counter(), Counter(), Counter(), Counter()
+        workers = defaultdict(lambda: dict(shards=0, keys=0, paths=0, seconds=0.))
+        for shard in self.shards:
+            visits.update(shard['visits'])
+            dead_ends.update(shard['dead_ends'])
+            hop_walks.update(shard['hop_walks'])
+            hop_paths.update(shard['hop_paths'])
+            worker = workers[shard['worker']]
+            worker['shards'] += 1
+            worker['keys'] += len(shard['keys'])
+            worker['paths'] += sum(counts[1] for counts in shard['keys'].values())
+            worker['seconds'] += shard['seconds']
+        for worker in workers.values():
+            worker['paths_per_second'] = _rate(worker['paths'], worker['seconds'])
+        return dict(
+            wall_seconds=wall,
+            io_seconds=self.io_seconds,
+            keys=len(keys),
+            walks=walks,
+            paths=paths,
+            duplicates=duplicates,
+            paths_per_second=_rate(paths, wall),
+            walks_per_path=_rate(walks, paths),
+            duplicate_rate=_rate(duplicates, paths + duplicates),
+            backtracks_per_path=_rate(sum(shard['backtracks'] for shard in self.shards), paths),
+            exhausted_budgets=sum(shard['exhausted'] for shard in self.shards),
+            dead_end_rate={ent_type: _rate(dead_ends[ent_type], n) for ent_type, n in sorted(visits.items())},
+            hops={str(n_hop): dict(walks=hop_walks[n_hop], paths=hop_paths[n_hop],
+                                   walks_per_path=_rate(hop_walks[n_hop], hop_paths[n_hop]))
+                  for n_hop in sorted(hop_walks)},
+            workers={str(pid): worker for pid, worker in workers.items()},
+        )
+
+    def save(self, dirpath, name):
+        """Write {name}.telemetry.json (summary) and {name}.telemetry.csv (one row per key)"""
+        os.makedirs(dirpath, exist_ok=True)
+        summary = self.summary()
+        with open(os.path.join(dirpath, f'{name}.telemetry.json'), 'w') as f:
+            json.dump(summary, f, indent=2)
+        with open(os.path.join(dirpath, f'{name}.telemetry.csv'), 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['key', 'worker', 'walks', 'paths', 'duplicates', 'walks_per_path'])
+            for shard in self.shards:
+                for key, (walks, paths, duplicates) in shard['keys'].items():
+                    writer.writerow([key, shard['worker'], walks, paths, duplicates, _rate(walks, paths)])
+        return summary
@@ -1,4 +1,5 @@
 #!/bin/bash
+# tokenize_dataset.py fills the tokenized path cache main.py reads, with the same --task, --sample_size and --n_hop
 
 echo -e "\n\n Pretrain LFM1M\n\n"
 echo -e "\n[+] Tokenizing pretrain dataset" 
@@ -1,9 +1,10 @@
 #!/bin/bash
+# tokenize_dataset.py fills the tokenized path cache main.py reads, with the same --task, --sample_size and --n_hop
 
 echo -e "\n\n Training PLM-Rec on ML1M\n\n"
-export CUDA_VISIBLE_DEVICES=1 && python helper/models/lm/PLM/tokenize_dataset.py --dataset ml1m --task end-to-end --sample_size 500 --nproc 2 --n_hop 5
-export CUDA_VISIBLE_DEVICES=1 && python helper/models/lm/PLM/main.py --validation_interval 5895 --num_epochs 20 --logit_processor_type plm --dataset ml1m
+export CUDA_VISIBLE_DEVICES=1 && python helper/models/lm/PLM/tokenize_dataset.py --dataset ml1m --task end-to-end --sample_size 250 --n_hop 3 --train_tokenizer True
+export CUDA_VISIBLE_DEVICES=1 && python helper/models/lm/PLM/main.py --task end-to-end --sample_size 250 --n_hop 3 --validation_interval 5895 --num_epochs 20 --logit_processor_type plm --dataset ml1m
 
 echo -e "\n\n Training PLM-Rec on LFM1M\n\n"
-export CUDA_VISIBLE_DEVICES=1 && python helper/models/lm/PLM/tokenize_dataset.py --dataset lfm1m --task end-to-end --sample_size 500 --nproc 2 --n_hop 5
-export CUDA_VISIBLE_DEVICES=1 && python helper/models/lm/PLM/main.py --validation_interval 4658 --num_epochs 20 --logit_processor_type plm --dataset lfm1m
\ No newline at end of file
+export CUDA_VISIBLE_DEVICES=1 && python helper/models/lm/PLM/tokenize_dataset.py --dataset lfm1m --task end-to-end --sample_size 250 --n_hop 3 --train_tokenizer True
+export CUDA_VISIBLE_DEVICES=1 && python helper/models/lm/PLM/main.py --task end-to-end --sample_size 250 --n_hop 3 --validation_interval 4658 --num_epochs 20 --logit_processor_type plm --dataset lfm1m
\ No newline at end of file